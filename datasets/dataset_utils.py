@@ -1,15 +1,298 @@
+import os
+import re
+import json
+import glob
+import zipfile
+import hashlib
+import logging
+from collections import OrderedDict
+
+import gdown
+import numpy as np
+import pandas as pd
+import torch
 from PIL import Image
 from torchvision import transforms
+from transformers import BatchEncoding, PreTrainedTokenizerBase
+
+_logger = logging.getLogger(__name__)
+
+IMAGE_ROOT = "../datasets/images"
+PREPROCESSED_CACHE_ROOT = os.path.join(IMAGE_ROOT, "preprocessed")
+
+NORMALIZE_MEAN = (0.48145466, 0.4578275, 0.40821073)
+NORMALIZE_STD = (0.26862954, 0.26130258, 0.27577711)
+
+_PUNCTUATION = re.compile(r"([,.'!?\"()*#:;~])")
+_MULTIPLE_SPACES = re.compile(r"\s{2,}")
+
+_image_indexes = {}  # image folder -> {file name: path}, so that each folder is scanned once per process
+_dataset_frames = {}  # dataset file -> dataframe, so that each file is parsed once per process
+
+""" Parse a dataset file (a JSON object of samples keyed by their id) into a dataframe, once per process: every
+    dataset object built from the same file shares it, and filters it into a new dataframe instead of modifying it """
+def read_dataset_file(dataset_file):
+    key = os.path.abspath(dataset_file)
+    if(key not in _dataset_frames):
+        _dataset_frames[key] = pd.read_json(dataset_file, orient='index')
+    return _dataset_frames[key]
+
+""" Function that downloads the appropriate image folder if not found in the project, and returns its path """
+def get_image_folder(dataset_name, general_config):
+    """ Create local image folders if they do not exist """
+    if(not os.path.exists(IMAGE_ROOT)):
+        os.mkdir(IMAGE_ROOT)
+    dataset_img_folder = os.path.join(IMAGE_ROOT, dataset_name+"_images")
+    if(not os.path.exists(dataset_img_folder)):
+        img_url = general_config[dataset_name+"_image_folder_url"]
+        downloaded_zip_path = os.path.join(IMAGE_ROOT, dataset_name + "_images.zip")
+        gdown.download(img_url, output=downloaded_zip_path, fuzzy=True) # download image folder zip associated with the desired dataset
+        with zipfile.ZipFile(downloaded_zip_path, 'r') as zip_ref: # unzip the downloaded file
+            zip_ref.extractall(IMAGE_ROOT)
+        os.remove(downloaded_zip_path) # delete the zip file
+    return dataset_img_folder
+
+""" Map every file name of an image folder to its path with a single directory scan.
+    The index is kept in memory for the whole run and, if persist is True, saved next to the folder as
+    <folder>.index.json so that later runs can reuse it as long as the modification time of the folder is unchanged. """
+def build_image_index(image_folder, persist=True):
+    image_folder = os.path.normpath(image_folder)
+    if(image_folder in _image_indexes):
+        return _image_indexes[image_folder]
+
+    index_file = image_folder + ".index.json"
+    folder_mtime = os.stat(image_folder).st_mtime_ns
+    file_names = None
+    if(persist and os.path.exists(index_file)):
+        try:
+            with open(index_file) as f:
+                saved_index = json.load(f)
+            if(saved_index['mtime'] == folder_mtime):
+                file_names = saved_index['files']
+        except (OSError, ValueError, KeyError):
+            file_names = None # unreadable index, scan the folder again
+    if(file_names is None):
+        file_names = [entry.name for entry in os.scandir(image_folder) if entry.is_file()]
+        if(persist):
+            tmp_file = index_file + ".tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump({'mtime': folder_mtime, 'files': file_names}, f)
+            os.replace(tmp_file, index_file)
+
+    index = {name: os.path.join(image_folder, name) for name in file_names}
+    _image_indexes[image_folder] = index
+    return index
+
+""" Resolve the image file names of a dataset to their paths. Names that are not in the folder are reported in one
+    go and get None as path, so that the caller can drop the corresponding samples. """
+def find_images(dataset_name, image_file_names, general_config):
+    image_folder = get_image_folder(dataset_name, general_config)
+    index = build_image_index(image_folder)
+    image_paths = [index.get(f) for f in image_file_names]
+    missing = sorted({str(f) for f, p in zip(image_file_names, image_paths) if p is None})
+    if(len(missing) > 0):
+        _logger.warning(f" {len(missing)} images of the {dataset_name} dataset were not found in {image_folder}, "
+                        f"the corresponding samples will be skipped: {', '.join(missing)}")
+    return image_paths
+
+""" Fingerprint of the images of a folder (its modification time and file names) as given to a model by a
+    preprocessing (a dict describing it), identifying the preprocessed images and the vision embeddings computed from
+    them across runs """
+def image_fingerprint(image_folder, preprocessing):
+    image_folder = os.path.normpath(image_folder)
+    return hashlib.sha1(json.dumps({
+        'folder_mtime': os.stat(image_folder).st_mtime_ns,
+        'files': sorted(build_image_index(image_folder)),
+        'preprocessing': preprocessing
+    }, sort_keys=True).encode()).hexdigest()[:16]
+
+""" Size-bounded LRU cache of decoded RGB images keyed by image id.
+    Images are opened lazily, decoded once and the file is closed right away; the least recently used images are
+    evicted as soon as the decoded pixels exceed max_mb megabytes. """
+class ImageCache:
+    def __init__(self, max_mb=512):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.images = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, image_id, path):
+        if(image_id in self.images):
+            self.images.move_to_end(image_id)
+            self.hits += 1
+            return self.images[image_id]
+        self.misses += 1
+        with Image.open(path) as image:
+            image = image.convert('RGB')
+        image_bytes = image.width * image.height * 3
+        if(image_bytes <= self.max_bytes):
+            self.images[image_id] = image
+            self.num_bytes += image_bytes
+            self._evict()
+        return image
+
+    def resize(self, max_mb):
+        self.max_bytes = max_mb * 1024 * 1024
+        self._evict()
+
+    def _evict(self):
+        while(self.num_bytes > self.max_bytes):
+            _, evicted = self.images.popitem(last=False)
+            self.num_bytes -= evicted.width * evicted.height * 3
+
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests > 0 else 0.
+
+    def report(self):
+        return (f"{self.hits} hits, {self.misses} misses (hit rate {self.hit_rate():.1%}), "
+                f"{len(self.images)} images / {self.num_bytes / 2**20:.1f} MB held")
+
+image_cache = ImageCache()  # shared by all the datasets of a run, so the same image is decoded once across splits
+
+""" Persistent cache of the images of a folder preprocessed for one (image_res, normalization) pair.
+    The bicubic-resized pixels are stored as uint8 in a memory-mapped array with one row per image of the folder
+    (plus a 'filled' flag per row), so that a row is written the first time the image is needed and read back as a
+    zero-copy slice in every later run. Only ToTensor and the normalization, which are cheap element-wise operations,
+    are applied on access; storing uint8 instead of float16 keeps the result identical to preprocess_images.
+    The file name contains a fingerprint of the folder content and of the preprocessing, so the cache is rebuilt
+    automatically when either changes. """
+class PreprocessedImageCache:
+    def __init__(self, image_folder, image_res, mean=NORMALIZE_MEAN, std=NORMALIZE_STD, cache_root=PREPROCESSED_CACHE_ROOT):
+        image_folder = os.path.normpath(image_folder)
+        self.image_res = image_res
+        self.mean = torch.tensor(mean).view(-1, 1, 1)
+        self.std = torch.tensor(std).view(-1, 1, 1)
+        self.rows = {name: row for row, name in enumerate(sorted(build_image_index(image_folder)))}
+
+        preprocessing = {'image_res': image_res, 'interpolation': 'bicubic', 'mean': list(mean), 'std': list(std)}
+        self.fingerprint = image_fingerprint(image_folder, preprocessing)
+        prefix = os.path.join(cache_root, f"{os.path.basename(image_folder)}_{image_res}px_")
+        path = prefix + self.fingerprint
+
+        os.makedirs(cache_root, exist_ok=True)
+        if(os.path.exists(path + ".json")):
+            mode = 'r+'
+        else:
+            self._remove_stale(prefix, preprocessing)
+            mode = 'w+'
+        shape = (len(self.rows), image_res, image_res, 3)
+        self.pixels = np.lib.format.open_memmap(path + ".pixels.npy", mode=mode, dtype=np.uint8, shape=shape if mode == 'w+' else None)
+        self.filled = np.lib.format.open_memmap(path + ".filled.npy", mode=mode, dtype=np.bool_, shape=shape[:1] if mode == 'w+' else None)
+        if(mode == 'w+'):
+            with open(path + ".json", 'w') as f: # written last: its presence marks the arrays as complete
+                json.dump({'preprocessing': preprocessing, 'rows': self.rows}, f)
+
+    """ Delete the cache files of older versions of the folder for the same preprocessing """
+    def _remove_stale(self, prefix, preprocessing):
+        for meta_file in glob.glob(prefix + "*.json"):
+            try:
+                with open(meta_file) as f:
+                    stale = json.load(f)['preprocessing'] == preprocessing
+            except (OSError, ValueError, KeyError):
+                stale = True
+            if(stale):
+                for f in glob.glob(meta_file[:-len(".json")] + ".*"):
+                    os.remove(f)
+
+    def _to_tensor(self, pixels):
+        return (torch.from_numpy(pixels).permute(2, 0, 1).float().div(255) - self.mean) / self.std
+
+    """ Return the preprocessed image tensor, or None if the image has not been cached yet """
+    def get(self, image_id):
+        row = self.rows[image_id]
+        if(not self.filled[row]):
+            return None
+        return self._to_tensor(self.pixels[row])
+
+    """ Resize a decoded RGB image, store it in the cache and return the preprocessed tensor """
+    def put(self, image_id, image):
+        row = self.rows[image_id]
+        self.pixels[row] = np.asarray(image.resize((self.image_res, self.image_res), Image.BICUBIC))
+        self.filled[row] = True
+        return self._to_tensor(self.pixels[row])
+
+_preprocessed_caches = {}
+
+""" Return the preprocessed image cache of a folder for the given resolution, opening it once per process """
+def get_preprocessed_cache(image_folder, image_res):
+    key = (os.path.normpath(image_folder), image_res)
+    if(key not in _preprocessed_caches):
+        _preprocessed_caches[key] = PreprocessedImageCache(image_folder, image_res)
+    return _preprocessed_caches[key]
 
 """ Taken from the original ALBEF """
 def preprocess_images(config, images, model_name):
     if(model_name == 'ALBEF' or model_name == 'XVLM' or model_name== 'BLIP' or model_name == 'X2VLM'):
         images = images.convert('RGB')
-        normalize = transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
+        normalize = transforms.Normalize(NORMALIZE_MEAN, NORMALIZE_STD)
         transform = transforms.Compose([
             transforms.Resize((config['image_res'], config['image_res']), interpolation=Image.BICUBIC),
             transforms.ToTensor(),
             normalize,
         ])
 
-    return transform(images)
\ No newline at end of file
+    return transform(images)
+
+""" Caption normalization taken from the original ALBEF """
+def pre_caption(caption, max_words):
+    caption = _PUNCTUATION.sub('', caption.lower()).replace('-', ' ').replace('/', ' ').replace('<person>', 'person')
+    caption = _MULTIPLE_SPACES.sub(' ', caption)
+    caption = caption.rstrip('\n')
+    caption = caption.strip(' ')
+
+    # truncate caption
+    caption_words = caption.split(' ')
+    if len(caption_words) > max_words:
+        caption = ' '.join(caption_words[:max_words])
+
+    return caption
+
+_token_memo = {}  # (tokenizer, max_words) -> {text: int32 token ids}, shared by every split and experiment of the run
+
+""" Texts of a dataset column normalized and tokenized once at construction.
+    The token ids of all the texts are concatenated in one int32 array, with the offset of each text in a second array,
+    so that an item is a slice of the first array. HuggingFace tokenizers are called once on the whole column through
+    the batch API (with the ALBEF caption normalization when max_words is given); open_clip tokenizers produce
+    fixed-length rows that are stored the same way. Texts already seen by the same tokenizer are not tokenized again. """
+class TokenizedTexts:
+    def __init__(self, texts, tokenizer, max_words=None, max_length=40):
+        self.is_clip = not isinstance(tokenizer, PreTrainedTokenizerBase)
+        if(max_words is not None):
+            texts = [pre_caption(t, max_words) for t in texts]
+        memo_key = (getattr(tokenizer, 'name_or_path', None) or id(tokenizer), max_words)
+        if(memo_key not in _token_memo):
+            _token_memo[memo_key] = {'tokenizer': tokenizer, 'ids': {}}  # the tokenizer is kept alive so that its id is not reused
+        memo = _token_memo[memo_key]['ids']
+
+        new_texts = list(dict.fromkeys(t for t in texts if t not in memo))
+        if(len(new_texts) > 0):
+            if(self.is_clip):
+                new_ids = tokenizer(new_texts).to(torch.int32).numpy()
+            else:
+                new_ids = tokenizer(new_texts, truncation=True, max_length=max_length)['input_ids']
+            for text, ids in zip(new_texts, new_ids):
+                memo[text] = np.asarray(ids, dtype=np.int32)
+
+        token_ids = [memo[t] for t in texts]
+        self.lengths = np.array([len(ids) for ids in token_ids], dtype=np.int32)
+        self.offsets = np.zeros(len(token_ids) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+        self.ids = np.concatenate(token_ids) if len(token_ids) > 0 else np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    """ int32 token ids of one text, as a view on the shared array """
+    def __getitem__(self, idx):
+        return torch.from_numpy(self.ids[self.offsets[idx]:self.offsets[idx + 1]])
+
+""" Pad the token ids of a batch of texts to the longest one. The attention mask marks the real tokens of each text. """
+def pad_token_ids(token_ids, pad_token_id=0):
+    lengths = torch.tensor([len(ids) for ids in token_ids])
+    input_ids = torch.full((len(token_ids), int(lengths.max())), pad_token_id, dtype=torch.long)
+    for i, ids in enumerate(token_ids):
+        input_ids[i, :len(ids)] = ids
+    attention_mask = (torch.arange(input_ids.size(1)).unsqueeze(0) < lengths.unsqueeze(1)).long()
+    return BatchEncoding({'input_ids': input_ids, 'attention_mask': attention_mask})
@@ -4,16 +4,52 @@ import torch.nn as nn
 
 from sklearn.utils import shuffle
 
-import pandas as pd
-import gdown
-import os
-import zipfile
-from PIL import Image
+from transformers import BatchEncoding
+from datasets.dataset_utils import find_images, get_image_folder, get_preprocessed_cache, image_cache, image_fingerprint, read_dataset_file, TokenizedTexts, pad_token_ids
+
+""" Base of the datasets of samples with an image: reading the dataset file, finding the images of the samples and
+    decoding them (through the shared image cache), and the preprocessed image and vision-embedding key of a sample.
+    The subclasses set df, dataset_name, general_config, images and image_ids (and preprocessed_images if they use
+    the preprocessed image cache). """
+class ImageSamplesDataset(data.Dataset):
+    def _jsonl_to_df(self, file):
+        return read_dataset_file(file)
+
+    """ Function that finds the images of the dataset (downloading the image folder if not found in the project) and returns their paths.
+        Samples whose image is missing are reported and removed from the dataframe. Images are decoded lazily in __getitem__. """
+    def _get_images(self, dataset_name, image_file_names):
+        image_paths = find_images(dataset_name, image_file_names, self.general_config)
+        self.df = self.df[[p is not None for p in image_paths]]
+        return [p for p in image_paths if p is not None]
+
+    def _load_image(self, idx):
+        return image_cache.load((self.dataset_name, self.image_ids[idx]), self.images[idx])
+
+    """ Fingerprint of the images of the dataset as preprocessed for a model: that of the preprocessed image cache
+        of image_res, or of the folder and the model's own image_preprocess """
+    def _image_fingerprint(self, image_preprocess=None, image_res=None):
+        image_folder = get_image_folder(self.dataset_name, self.general_config)
+        if(image_preprocess == None):
+            return get_preprocessed_cache(image_folder, image_res).fingerprint
+        return image_fingerprint(image_folder, {'image_preprocess': repr(image_preprocess)})
+
+    """ Identifier of the image of a sample across datasets, used to reuse its vision embeddings across runs: it
+        includes the fingerprint of the images and of their preprocessing, so that the embeddings of an image that
+        changed, or was preprocessed differently, are not reused """
+    def _image_key(self, idx, fingerprint):
+        return f"{self.dataset_name}/{self.image_ids[idx]}/{fingerprint}"
+
+    """ Preprocessed image tensor, read from the on-disk cache and computed from the decoded image only on a miss """
+    def _get_image_tensor(self, idx):
+        image = self.preprocessed_images.get(self.image_ids[idx])
+        if(image is None):
+            image = self.preprocessed_images.put(self.image_ids[idx], self._load_image(idx))
+        return image
 
-from datasets.dataset_utils import preprocess_images
-import re
+    def __len__(self):
+        return len(self.images)
 
-class ITMDataset(data.Dataset):
+class ITMDataset(ImageSamplesDataset):
     """ Here for 'dataset' we mean 'VALSE' or 'ARO'.
         For 'split' we mean 'active' or 'passive'. """
     def __init__(self, dataset_file, dataset_name, split, tokenizer, model_name, model_config, general_config, image_preprocess=None):
@@ -27,86 +63,141 @@ class ITMDataset(data.Dataset):
 
         image_file_names = self.df['image_id'].tolist()
         self.images = self._get_images(self.dataset_name, image_file_names)
+        self.image_ids = self.df['image_id'].tolist()
+        if(self.image_preprocess == None):
+            self.preprocessed_images = get_preprocessed_cache(get_image_folder(self.dataset_name, self.general_config), self.model_config['image_res'])
+        self.image_fingerprint = self._image_fingerprint(self.image_preprocess, self.model_config.get('image_res'))
         self.categories = self.df['category'].tolist()
+        self.sample_ids = self.df.index.astype(str).tolist() # keys of the samples in the dataset file
+        self.verbs = self.df['verb'].tolist()
 
         self.captions = self.df[self.df['dataset'] == self.dataset_name]['true_'+split].tolist()
         self.foils = self.df[self.df['dataset'] == self.dataset_name]['foil_'+split].tolist()
 
         self.tokenizer = tokenizer
-    def _jsonl_to_df(self, file):
-        df = pd.read_json(file, orient='index')
-        return df
-
-    """ Function that downloads the appropriate image folder if not found in the project, and it converts images to Python-readable objects """
-    def _get_images(self, dataset_name, image_file_names):
-        """ Create local image folders if they do not exist """
-        image_folder = os.path.join("../datasets/images")
-        if(not os.path.exists(image_folder)):
-            os.mkdir(image_folder)
-        dataset_img_folder = os.path.join(image_folder,dataset_name+"_images")
-        if(not os.path.exists(dataset_img_folder)):
-            img_url = self.general_config[dataset_name+"_image_folder_url"]
-            downloaded_zip_path = os.path.join(image_folder, dataset_name + "_images.zip")
-            gdown.download(img_url, output=downloaded_zip_path, fuzzy=True) # download image folder zip associated with the desired dataset
-            with zipfile.ZipFile(downloaded_zip_path, 'r') as zip_ref: # unzip the downloaded file
-                zip_ref.extractall(image_folder)
-            os.remove(downloaded_zip_path) # delete the zip file
-
-        image_list= []
-        # open the images and save them within the list
-        for f in image_file_names:
-            for filename in os.listdir(dataset_img_folder):
-                if(filename==f):
-                    image_list.append(Image.open(os.path.join(dataset_img_folder,filename)))
-        return image_list
-
-    def __len__(self):
-        return len(self.images)
-
-    def _pre_caption(self, caption, max_words):
-        caption = re.sub(
-            r"([,.'!?\"()*#:;~])",
-            '',
-            caption.lower(),
-        ).replace('-', ' ').replace('/', ' ').replace('<person>', 'person')
-
-        caption = re.sub(
-            r"\s{2,}",
-            ' ',
-            caption,
-        )
-        caption = caption.rstrip('\n')
-        caption = caption.strip(' ')
-
-        # truncate caption
-        caption_words = caption.split(' ')
-        if len(caption_words) > max_words:
-            caption = ' '.join(caption_words[:max_words])
-
-        return caption
+        max_words = self.model_config['max_tokens'] if self.image_preprocess == None else None # open_clip tokenizes the raw captions
+        self.caption_tokens = TokenizedTexts(self.captions, tokenizer, max_words)
+        self.foil_tokens = TokenizedTexts(self.foils, tokenizer, max_words)
 
     def __getitem__(self, idx):
-        image = self.images[idx]
         if(self.image_preprocess == None):
-            image = preprocess_images(config=self.model_config, model_name=self.model_name, images=image)
-            caption, foil = self._pre_caption(self.captions[idx], self.model_config['max_tokens']), self._pre_caption(
-                self.foils[idx], self.model_config['max_tokens'])
-            caption = self.tokenizer(caption, padding='longest', max_length=40,
-                                     return_tensors='pt')
-            foil = self.tokenizer(foil, padding='longest', max_length=40,
-                                  return_tensors='pt')
+            image = self._get_image_tensor(idx)
         else:
-            image = self.image_preprocess(image)
-            caption = self.tokenizer(self.captions[idx])
-            foil = self.tokenizer(self.foils[idx])
+            image = self.image_preprocess(self._load_image(idx))
+        caption = self.caption_tokens[idx]
+        foil = self.foil_tokens[idx]
 
         category = self.categories[idx]
+        image_key = self._image_key(idx, self.image_fingerprint)
+
+        return image, caption, foil, category, image_key
+
+""" Collate function for the datasets of this module, to be given to the DataLoader: images are stacked, the token ids
+    of each text field (1-D tensors) are padded into input_ids/attention_mask and the other fields are kept as lists """
+def collate_fn(batch):
+    collated = []
+    for field in zip(*batch):
+        if(isinstance(field[0], torch.Tensor) and field[0].dim() == 1):
+            collated.append(pad_token_ids(field))
+        elif(isinstance(field[0], torch.Tensor)):
+            collated.append(torch.stack(field))
+        else:
+            collated.append(list(field))
+    return collated
+
+""" ITM samples of one dataset and split prepared for several models at once, for the multi-model runs.
+    'models' maps each model name to a dict with its 'tokenizer', 'model_config' and 'image_preprocess' (as given to
+    ITMDataset). The image of a sample is decoded once and resized once per resolution: the models preprocessed here
+    with the same image_res share the same tensor, and the models with their own image_preprocess (NegCLIP) get it
+    from the same decoded image. The texts are tokenized once per tokenizer family (same tokenizer and max_words).
+    An item is (index, images by group, (caption, foil) tokens by family, category), batches are built by
+    multi_model_collate_fn and split into the batch of each model by model_batch. """
+class MultiModelITMDataset(ImageSamplesDataset):
+    def __init__(self, dataset_file, dataset_name, split, models, general_config):
+        self.dataset_name = dataset_name
+        self.general_config = general_config
+        self.df = self._jsonl_to_df(dataset_file)
+        self.df = self.df[self.df['dataset'] == self.dataset_name] # get only the dataset we want from our merged json file
 
+        image_file_names = self.df['image_id'].tolist()
+        self.images = self._get_images(self.dataset_name, image_file_names)
+        self.image_ids = self.df['image_id'].tolist()
+        self.categories = self.df['category'].tolist()
+        self.sample_ids = self.df.index.astype(str).tolist() # keys of the samples in the dataset file
+        self.verbs = self.df['verb'].tolist()
+        self.captions = self.df['true_'+split].tolist()
+        self.foils = self.df['foil_'+split].tolist()
+
+        self.image_groups = {} # model name -> image_res, or the model name itself if it has its own image_preprocess
+        self.image_fingerprints = {} # model name -> fingerprint of its images, see _image_key
+        self.preprocessed_images = {}
+        self.image_preprocesses = {}
+        self.text_families = {} # model name -> (tokenizer name, max_words)
+        self.tokens = {}
+        image_folder = get_image_folder(self.dataset_name, self.general_config)
+        for model_name, model in models.items():
+            if(model['image_preprocess'] == None):
+                image_res = model['model_config']['image_res']
+                self.image_groups[model_name] = image_res
+                if(image_res not in self.preprocessed_images):
+                    self.preprocessed_images[image_res] = get_preprocessed_cache(image_folder, image_res)
+            else:
+                self.image_groups[model_name] = model_name
+                self.image_preprocesses[model_name] = model['image_preprocess']
+            self.image_fingerprints[model_name] = self._image_fingerprint(model['image_preprocess'], model['model_config'].get('image_res'))
+
+            tokenizer = model['tokenizer']
+            max_words = model['model_config']['max_tokens'] if model['image_preprocess'] == None else None # open_clip tokenizes the raw captions
+            family = (getattr(tokenizer, 'name_or_path', None) or model_name, max_words)
+            self.text_families[model_name] = family
+            if(family not in self.tokens):
+                self.tokens[family] = (TokenizedTexts(self.captions, tokenizer, max_words),
+                                       TokenizedTexts(self.foils, tokenizer, max_words))
+
+    def __getitem__(self, idx):
+        image_id = self.image_ids[idx]
+        decoded = None
+        images = {}
+        for image_res, preprocessed_images in self.preprocessed_images.items():
+            images[image_res] = preprocessed_images.get(image_id)
+            if(images[image_res] is None):
+                if(decoded is None):
+                    decoded = self._load_image(idx)
+                images[image_res] = preprocessed_images.put(image_id, decoded)
+        for model_name, image_preprocess in self.image_preprocesses.items():
+            if(decoded is None):
+                decoded = self._load_image(idx)
+            images[model_name] = image_preprocess(decoded)
+        tokens = {family: (caption_tokens[idx], foil_tokens[idx]) for family, (caption_tokens, foil_tokens) in self.tokens.items()}
+
+        return idx, images, tokens, self.categories[idx]
+
+    """ The batch of one model, (images, captions, foils, categories, image_keys) as collate_fn builds it for
+        ITMDataset, optionally restricted to the given rows of the batch """
+    def model_batch(self, batch, model_name, rows=None):
+        indices, images, tokens, categories = batch
+        image_keys = [self._image_key(idx, self.image_fingerprints[model_name]) for idx in indices]
+        images = images[self.image_groups[model_name]]
+        captions, foils = tokens[self.text_families[model_name]]
+        if(rows is not None):
+            images = images[rows]
+            captions = BatchEncoding({key: value[rows] for key, value in captions.items()})
+            foils = BatchEncoding({key: value[rows] for key, value in foils.items()})
+            categories = [categories[row] for row in rows]
+            image_keys = [image_keys[row] for row in rows]
+        return images, captions, foils, categories, image_keys
+
+""" Collate function of MultiModelITMDataset: the images of each group are stacked and the texts of each tokenizer
+    family padded once, whatever the number of models sharing them """
+def multi_model_collate_fn(batch):
+    indices, images, tokens, categories = zip(*batch)
+    images = {group: torch.stack([item[group] for item in images]) for group in images[0]}
+    tokens = {family: (pad_token_ids([item[family][0] for item in tokens]), pad_token_ids([item[family][1] for item in tokens]))
+              for family in tokens[0]}
+    return list(indices), images, tokens, list(categories)
 
-        return image, caption, foil, category
-    
 #class for 3rd experiment: return image and the three needed captions
-class SimilaritiesDataset(data.Dataset):
+class SimilaritiesDataset(ImageSamplesDataset):
     """ Here for 'dataset' we mean 'VALSE' or 'ARO'."""
     def __init__(self, dataset_file, dataset_name, tokenizer, general_config, model_name, model_config, image_preprocess=None):
         self.general_config = general_config
@@ -119,90 +210,40 @@ class SimilaritiesDataset(data.Dataset):
 
         image_file_names = self.df['image_id'].tolist()
         self.images = self._get_images(self.dataset_name, image_file_names)
+        self.image_ids = self.df['image_id'].tolist()
+        if(self.image_preprocess == None):
+            self.preprocessed_images = get_preprocessed_cache(get_image_folder(self.dataset_name, self.general_config), self.model_config['image_res'])
+        self.image_fingerprint = self._image_fingerprint(self.image_preprocess, self.model_config.get('image_res'))
         self.categories = self.df['category'].tolist()
+        self.sample_ids = self.df.index.astype(str).tolist() # keys of the samples in the dataset file
+        self.verbs = self.df['verb'].tolist()
 
         self.true_actives = self.df[self.df['dataset'] == self.dataset_name]['true_active'].tolist()
         self.foil_actives = self.df[self.df['dataset'] == self.dataset_name]['foil_active'].tolist()
         self.true_passives = self.df[self.df['dataset'] == self.dataset_name]['true_passive'].tolist()
 
         self.tokenizer = tokenizer
-    def _jsonl_to_df(self, file):
-        df = pd.read_json(file, orient='index')
-        return df
-
-    """ Function that downloads the appropriate image folder if not found in the project, and it converts images to Python-readable objects """
-    def _get_images(self, dataset_name, image_file_names):
-        """ Create local image folders if they do not exist """
-        image_folder = os.path.join("../datasets/images")
-        if(not os.path.exists(image_folder)):
-            os.mkdir(image_folder)
-        dataset_img_folder = os.path.join(image_folder,dataset_name+"_images")
-        if(not os.path.exists(dataset_img_folder)):
-            img_url = self.general_config[dataset_name+"_image_folder_url"]
-            downloaded_zip_path = os.path.join(image_folder, dataset_name + "_images.zip")
-            gdown.download(img_url, output=downloaded_zip_path, fuzzy=True) # download image folder zip associated with the desired dataset
-            with zipfile.ZipFile(downloaded_zip_path, 'r') as zip_ref: # unzip the downloaded file
-                zip_ref.extractall(image_folder)
-            os.remove(downloaded_zip_path) # delete the zip file
-
-        image_list= []
-        # open the images and save them within the list
-        for f in image_file_names:
-            for filename in os.listdir(dataset_img_folder):
-                if(filename==f):
-                    image_list.append(Image.open(os.path.join(dataset_img_folder,filename)))
-        return image_list
-
-    def __len__(self):
-        return len(self.images)
-
-    def _pre_caption(self, caption, max_words):
-        caption = re.sub(
-            r"([,.'!?\"()*#:;~])",
-            '',
-            caption.lower(),
-        ).replace('-', ' ').replace('/', ' ').replace('<person>', 'person')
-
-        caption = re.sub(
-            r"\s{2,}",
-            ' ',
-            caption,
-        )
-        caption = caption.rstrip('\n')
-        caption = caption.strip(' ')
-
-        # truncate caption
-        caption_words = caption.split(' ')
-        if len(caption_words) > max_words:
-            caption = ' '.join(caption_words[:max_words])
-
-        return caption
+        max_words = self.model_config['max_tokens'] if self.image_preprocess == None else None # open_clip tokenizes the raw captions
+        self.true_active_tokens = TokenizedTexts(self.true_actives, tokenizer, max_words)
+        self.foil_active_tokens = TokenizedTexts(self.foil_actives, tokenizer, max_words)
+        self.true_passive_tokens = TokenizedTexts(self.true_passives, tokenizer, max_words)
 
     def __getitem__(self, idx):
-        image = self.images[idx]
         if(self.image_preprocess == None):
-            image = preprocess_images(config=self.model_config, model_name=self.model_name, images=image)
-            true_active, foil_active, true_passive = (self._pre_caption(self.true_actives[idx], self.model_config['max_tokens']),
-                                        self._pre_caption(self.foil_actives[idx], self.model_config['max_tokens']),
-                                        self._pre_caption(self.true_passives[idx], self.model_config['max_tokens']))
-            true_active = self.tokenizer(true_active, padding='longest', max_length=40,
-                                     return_tensors='pt')
-            foil_active = self.tokenizer(foil_active, padding='longest', max_length=40,
-                                  return_tensors='pt')
-            true_passive = self.tokenizer(true_passive, padding='longest', max_length=40,
-                                         return_tensors='pt')
+            image = self._get_image_tensor(idx)
         else:
-            image = self.image_preprocess(image)
-            true_active = self.tokenizer(self.true_actives[idx])
-            foil_active = self.tokenizer(self.foil_actives[idx])
-            true_passive = self.tokenizer(self.true_passives[idx])
+            image = self.image_preprocess(self._load_image(idx))
+        true_active = self.true_active_tokens[idx]
+        foil_active = self.foil_active_tokens[idx]
+        true_passive = self.true_passive_tokens[idx]
 
         category = self.categories[idx]
+        image_key = self._image_key(idx, self.image_fingerprint)
 
-        return image, true_active, foil_active, true_passive, category
+        return image, true_active, foil_active, true_passive, category, image_key
 
 #class for testing with the original VALSE
-class OriginalValseDataset(data.Dataset):
+class OriginalValseDataset(ImageSamplesDataset):
     """ Here for 'dataset' we mean 'VALSE' or 'ARO'."""
     def __init__(self, dataset_file, dataset_name, tokenizer, general_config, model_name, model_config, image_preprocess=None):
         self.general_config = general_config
@@ -215,76 +256,28 @@ class OriginalValseDataset(data.Dataset):
 
         image_file_names = self.df['dataset_idx'].tolist()
         self.images = self._get_images(self.dataset_name, image_file_names)
+        self.image_ids = self.df['dataset_idx'].tolist()
+        if(self.image_preprocess == None):
+            self.preprocessed_images = get_preprocessed_cache(get_image_folder(self.dataset_name, self.general_config), self.model_config['image_res'])
+        self.image_fingerprint = self._image_fingerprint(self.image_preprocess, self.model_config.get('image_res'))
 
         self.captions = self.df['caption'].tolist()
         self.foils = self.df['foil'].tolist()
         self.good_caption = [c['caption'] for c in self.df['mturk']]
         self.tokenizer = tokenizer
-    def _jsonl_to_df(self, file):
-        df = pd.read_json(file, orient='index')
-        return df
-
-    """ Function that downloads the appropriate image folder if not found in the project, and it converts images to Python-readable objects """
-    def _get_images(self, dataset_name, image_file_names):
-        """ Create local image folders if they do not exist """
-        image_folder = os.path.join("../datasets/images")
-        if(not os.path.exists(image_folder)):
-            os.mkdir(image_folder)
-        dataset_img_folder = os.path.join(image_folder,dataset_name+"_images")
-        if(not os.path.exists(dataset_img_folder)):
-            img_url = self.general_config[dataset_name+"_image_folder_url"]
-            downloaded_zip_path = os.path.join(image_folder, dataset_name + "_images.zip")
-            gdown.download(img_url, output=downloaded_zip_path, fuzzy=True) # download image folder zip associated with the desired dataset
-            with zipfile.ZipFile(downloaded_zip_path, 'r') as zip_ref: # unzip the downloaded file
-                zip_ref.extractall(image_folder)
-            os.remove(downloaded_zip_path) # delete the zip file
-
-        image_list= []
-        # open the images and save them within the list
-        for f in image_file_names:
-            for filename in os.listdir(dataset_img_folder):
-                if(filename==f):
-                    image_list.append(Image.open(os.path.join(dataset_img_folder,filename)))
-        return image_list
-
-    def _pre_caption(self, caption, max_words):
-        caption = re.sub(
-            r"([,.'!?\"()*#:;~])",
-            '',
-            caption.lower(),
-        ).replace('-', ' ').replace('/', ' ').replace('<person>', 'person')
-
-        caption = re.sub(
-            r"\s{2,}",
-            ' ',
-            caption,
-        )
-        caption = caption.rstrip('\n')
-        caption = caption.strip(' ')
-
-        # truncate caption
-        caption_words = caption.split(' ')
-        if len(caption_words) > max_words:
-            caption = ' '.join(caption_words[:max_words])
-
-        return caption
-    def __len__(self):
-        return len(self.images)
+        max_words = self.model_config['max_tokens'] if self.image_preprocess == None else None # open_clip tokenizes the raw captions
+        self.caption_tokens = TokenizedTexts(self.captions, tokenizer, max_words)
+        self.foil_tokens = TokenizedTexts(self.foils, tokenizer, max_words)
 
     def __getitem__(self, idx):
-        image = self.images[idx]
         if (self.image_preprocess == None):
-            image = preprocess_images(config=self.model_config, model_name=self.model_name, images=image)
-            caption, foil = self._pre_caption(self.captions[idx], self.model_config['max_tokens']), self._pre_caption(self.foils[idx], self.model_config['max_tokens'])
-            caption = self.tokenizer(caption, padding='longest', max_length=40,
-                                     return_tensors='pt')
-            foil = self.tokenizer(foil, padding='longest', max_length=40,
-                                  return_tensors='pt')
+            image = self._get_image_tensor(idx)
         else:
-            image = self.image_preprocess(image)
-            caption = self.tokenizer(self.captions[idx])
-            foil = self.tokenizer(self.foils[idx])
+            image = self.image_preprocess(self._load_image(idx))
+        caption = self.caption_tokens[idx]
+        foil = self.foil_tokens[idx]
 
         #category = self.categories[idx]
         good_caption = self.good_caption[idx]
-        return image, caption, foil, good_caption
+        image_key = self._image_key(idx, self.image_fingerprint)
+        return image, caption, foil, good_caption, image_key
@@ -1,109 +1,42 @@
 from tqdm import tqdm
+from models.AdaptedModels.vision_store import vision_store
+from experiments.metrics import ITMScores
 
 import torch
 import torch.nn.functional as F
 import numpy as np
 
-def eval(model, loader):
+""" Put the model in evaluation mode (its weights are loaded when it is created) """
+def load(model):
     model.model.eval()
-
-    c_scores = []
-    f_scores = []
-    scores_by_cat = dict()
-    total_num_samples = 0
+    return model
+
+""" Softmax over (caption, foil) of the similarities of each image with its own caption and foil, as the matching
+    probabilities of the captions and of the foils of a batch """
+def score(model, images, captions, foils, image_keys=None):
+    image_features = vision_store.encode(model.model.encode_image, images, image_keys,
+                                        vision_store.model_key('NegCLIP', model))
+    caption_features = model.model.encode_text(captions.input_ids)
+    foil_features = model.model.encode_text(foils.input_ids)
+    image_features /= image_features.norm(dim=-1, keepdim=True)
+    caption_features /= caption_features.norm(dim=-1, keepdim=True)
+    foil_features /= foil_features.norm(dim=-1, keepdim=True)
+    # each image is compared with its own caption and foil
+    similarity = (100.0 * torch.stack([(image_features * caption_features).sum(dim=-1),
+                                       (image_features * foil_features).sum(dim=-1)], dim=-1)).softmax(dim=-1)
+    return similarity[:, 0], similarity[:, 1]
+
+def eval(model, loader, journal=None):
+    model = load(model)
+
+    scores = ITMScores()
     with torch.no_grad():
-        for images, captions, foils, categories in tqdm(loader):
-            for image, caption, foil, category in zip(images,captions,foils,categories):
-                image_features = model.model.encode_image(image.unsqueeze(0))
-                text_input = torch.stack([caption.squeeze(0),foil.squeeze(0)], dim=0)
-                text_features = model.model.encode_text(text_input)
-                image_features /= image_features.norm(dim=-1, keepdim=True)
-                text_features /= text_features.norm(dim=-1, keepdim=True)
-                similarity = (100.0 * image_features @ text_features.T).softmax(dim=-1)
-
-                caption_score = similarity[0][0]
-                foil_score = similarity[0][1]
-                c_scores.extend([caption_score])
-                f_scores.extend([foil_score])
-                # this is to iterate multiple lists together
-                try:
-                    scores_by_cat[category]['caption_scores'].append(caption_score)
-                    scores_by_cat[category]['foil_scores'].append(foil_score)
-                except:
-                    scores_by_cat[category] = {
-                        'caption_scores': [caption_score],
-                        'foil_scores': [foil_score]
-                    }
-                total_num_samples += 1
-
-    pairwise_acc = sum(
-        [1 if c_scores[i].item() > f_scores[i].item() else 0 for i in
-         range(len(c_scores))]) / total_num_samples
-    pairwise_acc_50 = sum(
-        [1 if c_scores[i].item() > f_scores[i].item() and c_scores[i].item() > 0.5 else 0 for i in
-         range(len(c_scores))]) / total_num_samples
-    pairwise_acc_60 = sum(
-        [1 if c_scores[i].item() > f_scores[i].item() and c_scores[i].item() > 0.6 else 0 for i in
-         range(len(c_scores))]) / total_num_samples
-    pairwise_acc_70 = sum(
-        [1 if c_scores[i].item() > f_scores[i].item() and c_scores[i].item() > 0.7 else 0 for i in
-         range(len(c_scores))]) / total_num_samples
-    precision_caption = -1
-    precision_foil =-1
-    acc = -1
-
-    # Now performance aggregated by verb category
-    perf_by_category = {}
-    for key, value in scores_by_cat.items():
-        cat_c_scores = value['caption_scores']
-        cat_f_scores = value['foil_scores']
-        num_samples_by_cat = len(cat_f_scores)
-        try:
-            perf_by_category[key]['pairwise_acc'] = sum(
-                [1 if cat_c_scores[i].item() > cat_f_scores[i].item() else 0 for i in
-                 range(len(cat_c_scores))]) / num_samples_by_cat
-            perf_by_category[key]['pairwise_acc_50'] = sum(
-                [1 if cat_c_scores[i].item() > cat_f_scores[i].item() and cat_c_scores[i].item() > 0.5 else 0
-                 for i in
-                 range(len(cat_c_scores))]) / num_samples_by_cat
-            perf_by_category[key]['pairwise_acc_60'] = sum(
-                [1 if cat_c_scores[i][1].item() > cat_f_scores[i][1].item() and cat_c_scores[i].item() > 0.6 else 0
-                 for i in
-                 range(len(cat_c_scores))]) / num_samples_by_cat
-            perf_by_category[key]['pairwise_acc_70'] = sum(
-                [1 if cat_c_scores[i][1].item() > cat_f_scores[i][1].item() and cat_c_scores[i].item() > 0.7 else 0
-                 for i in
-                 range(len(cat_c_scores))]) / num_samples_by_cat
-            perf_by_category[key]['precision_caption'] = -1
-            perf_by_category[key]['precision_foil'] = -1
-
-            perf_by_category[key]['acc'] = -1
-        except:
-            perf_by_category[key] = {'pairwise_acc': float()}
-            perf_by_category[key]['pairwise_acc'] = sum(
-                [1 if cat_c_scores[i].item() > cat_f_scores[i].item() else 0 for i in
-                 range(len(cat_c_scores))]) / num_samples_by_cat
-            perf_by_category[key]['pairwise_acc_50'] = sum(
-                [1 if cat_c_scores[i].item() > cat_f_scores[i].item() and cat_c_scores[i].item() > 0.5 else 0
-                 for i in
-                 range(len(cat_c_scores))]) / num_samples_by_cat
-            perf_by_category[key]['pairwise_acc_60'] = sum(
-                [1 if cat_c_scores[i].item() > cat_f_scores[i].item() and cat_c_scores[i].item() > 0.6 else 0
-                 for i in
-                 range(len(cat_c_scores))]) / num_samples_by_cat
-            perf_by_category[key]['pairwise_acc_70'] = sum(
-                [1 if cat_c_scores[i].item() > cat_f_scores[i].item() and cat_c_scores[i].item() > 0.7 else 0
-                 for i in
-                 range(len(cat_c_scores))]) / num_samples_by_cat
-            perf_by_category[key]['precision_caption'] = -1
-            perf_by_category[key]['precision_foil'] = -1
-            perf_by_category[key]['acc'] = -1
-
-    return (acc,
-            pairwise_acc,
-            pairwise_acc_50,
-            pairwise_acc_60,
-            pairwise_acc_70,
-            precision_caption,
-            precision_foil,
-            perf_by_category)
\ No newline at end of file
+        for images, captions, foils, categories, image_keys in tqdm(loader):
+            caption_scores, foil_scores = score(model, images, captions, foils, image_keys)
+            scores.add(caption_scores, foil_scores, categories)
+            if(journal is not None):
+                journal.append(caption_scores=caption_scores, foil_scores=foil_scores)
+
+    # the metrics (overall and by verb category) are computed by the caller; a contrastive model has no ITM decision,
+    # so its acc and precisions are -1
+    return scores
@@ -0,0 +1,143 @@
+import logging
+import argparse
+import sys
+import os
+import json
+import time
+import resource
+import subprocess
+import statistics
+import yaml
+
+_logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--log_level', type=str, default='INFO')
+FLAGS, FIRE_FLAGS = parser.parse_known_args()
+logging.basicConfig(stream=sys.stdout, level=logging.getLevelName(FLAGS.log_level))
+
+ENCODERS = ['ALBEF', 'BLIP', 'XVLM', 'X2VLM', 'CLIP-ViT']
+MODES = ['baseline', 'fast']
+""" Switches of the inference fast paths of the attention layers: fused attention (use_sdpa) and cached relative
+    position biases and window masks (cache_bias) """
+FAST_PATHS = ['use_sdpa', 'cache_bias']
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Compare the attention of the vision encoders with and without their fast paths on CPU', add_help=False)
+    parser.add_argument('--encoders', default=ENCODERS, nargs='+', type=str, choices=ENCODERS)
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--repeats', default=5, type=int, help='timed forward passes (after one warm-up pass)')
+    parser.add_argument('--threads', default=None, type=int, help='torch threads, all the cores by default')
+    parser.add_argument('--output', default='../scores/attention_benchmark.jsonl', type=str, help='one line is appended per benchmark run')
+    parser.add_argument('--child', default=None, type=str, help=argparse.SUPPRESS) # encoder:mode measured in this process
+
+    return parser
+
+# Function to load yaml configuration file
+def load_config(config_path, config_name):
+    with open(os.path.join(config_path, config_name)) as file:
+        config = yaml.safe_load(file)
+
+    return config
+
+""" Vision encoder of a model, randomly initialized (the attention cost does not depend on the weights), with the
+    resolution of its config, and its forward function """
+def build_encoder(encoder_name):
+    import torch.nn as nn
+    from functools import partial
+    if(encoder_name == 'ALBEF'):
+        from models.ALBEF.models.vit import VisionTransformer
+        image_res = load_config('../config/ALBEF', 'config.yaml')['image_res']
+        encoder = VisionTransformer(img_size=image_res, patch_size=16, embed_dim=768, depth=12, num_heads=12,
+                                    mlp_ratio=4, qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6))
+        return encoder, image_res, encoder
+    elif(encoder_name == 'BLIP'):
+        from models.BLIP.models.blip import create_vit
+        config = load_config('../config/BLIP', 'config.yaml')
+        encoder, _ = create_vit(config['vit'], config['image_res'])
+        return encoder, config['image_res'], encoder
+    elif(encoder_name == 'XVLM'):
+        from models.XVLM.models.xvlm import build_vision_encoder
+        config = load_config('../config/XVLM', 'config.yaml')
+        encoder = build_vision_encoder(config, load_params=False)[0] # Swin-B
+        return encoder, config['image_res'], encoder
+    elif(encoder_name == 'X2VLM'):
+        from models.X2VLM.models.xvlm import build_vision_encoder
+        config = load_config('../config/X2VLM', 'config.yaml')
+        encoder = build_vision_encoder(config, load_params=False)
+        return encoder, config['image_res'], encoder
+    elif(encoder_name == 'CLIP-ViT'):
+        from models.X2VLM.models.clip_vit import CLIPVisionTransformer
+        encoder = CLIPVisionTransformer(image_size=224, patch_size=16, hidden_size=768, hidden_act='quick_gelu',
+                                        num_attention_heads=12, attention_dropout=0.0, intermediate_size=3072,
+                                        num_hidden_layers=12, local_attn_depth=0)
+        return encoder, 224, lambda images: encoder(images)[0]
+
+def set_attention(encoder, mode):
+    for module in encoder.modules():
+        for fast_path in FAST_PATHS:
+            if(hasattr(module, fast_path)):
+                setattr(module, fast_path, mode == 'fast')
+
+""" Measure one encoder with one attention implementation, in its own process so the peak memory (maximum resident
+    set size) is its own: the peak of the forward passes is the increase of the maximum RSS over the one after the
+    encoder is built. The fast run also reports the largest difference with the baseline. """
+def measure(encoder_name, mode, batch_size, repeats):
+    import torch
+    torch.manual_seed(0)
+    encoder, image_res, forward = build_encoder(encoder_name)
+    encoder.eval()
+    images = torch.randn(batch_size, 3, image_res, image_res)
+    set_attention(encoder, mode)
+    result = {}
+    with torch.no_grad():
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        output = forward(images)
+        result['peak_mb'] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+        seconds = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            forward(images)
+            seconds.append(time.perf_counter() - start)
+        result['ms_per_image'] = 1000 * statistics.median(seconds) / batch_size
+        if(mode == 'fast'):
+            set_attention(encoder, 'baseline')
+            result['max_abs_diff'] = (output - forward(images)).abs().max().item()
+    return result
+
+def main(args):
+    if(args.child is not None):
+        encoder_name, mode = args.child.split(':')
+        if(args.threads is not None):
+            import torch
+            torch.set_num_threads(args.threads)
+        print(json.dumps(measure(encoder_name, mode, args.batch_size, args.repeats)))
+        return
+
+    record = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'batch_size': args.batch_size, 'threads': args.threads, 'encoders': {}}
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.abspath('..'), os.environ.get('PYTHONPATH', '')]))
+    for encoder_name in args.encoders:
+        record['encoders'][encoder_name] = {}
+        for mode in MODES:
+            command = [sys.executable, '-m', 'attention_benchmark', '--child', f'{encoder_name}:{mode}',
+                       '--batch_size', str(args.batch_size), '--repeats', str(args.repeats)]
+            if(args.threads is not None):
+                command += ['--threads', str(args.threads)]
+            output = subprocess.run(command, capture_output=True, text=True, env=env, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            record['encoders'][encoder_name][mode] = result
+            _logger.info(f" {encoder_name} {mode:<8}: {result['ms_per_image']:.1f} ms/image, peak {result['peak_mb']:.0f} MB"
+                         + (f", max abs diff {result['max_abs_diff']:.2e}" if 'max_abs_diff' in result else ''))
+        baseline, fast = record['encoders'][encoder_name]['baseline'], record['encoders'][encoder_name]['fast']
+        _logger.info(f" {encoder_name}: {baseline['ms_per_image'] / fast['ms_per_image']:.2f}x faster, "
+                     f"{baseline['peak_mb'] - fast['peak_mb']:.0f} MB less at peak")
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+    _logger.info(f" Benchmark saved at location {args.output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('GLP Project', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
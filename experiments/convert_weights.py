@@ -0,0 +1,64 @@
+import logging
+import argparse
+import sys
+import os
+import json
+import yaml
+
+from utils.utils import download_weights, convert_weights, converted_weights_path, manifest_path
+
+_logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--log_level', type=str, default='INFO')
+FLAGS, FIRE_FLAGS = parser.parse_known_args()
+logging.basicConfig(stream=sys.stdout, level=logging.getLevelName(FLAGS.log_level))
+
+""" Models whose checkpoint is loaded by utils.utils.load_weights or X2VLM.load_pretrained (NegCLIP is loaded by
+    open_clip) """
+MODEL_NAMES = ['ALBEF', 'XVLM', 'BLIP', 'X2VLM']
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Convert the pretrained weights to safetensors', add_help=False)
+    parser.add_argument('--models', default=MODEL_NAMES, nargs='+', type=str, choices=MODEL_NAMES)
+    parser.add_argument('--overwrite', action='store_true', help='convert the checkpoints already converted again')
+
+    return parser
+
+# Function to load yaml configuration file
+def load_config(config_path, config_name):
+    with open(os.path.join(config_path, config_name)) as file:
+        config = yaml.safe_load(file)
+
+    return config
+
+""" Convert the checkpoint of each model to a safetensors file with only the model tensors, next to it, with its
+    manifest. Once converted, the evaluations load the safetensors file (memory-mapped, one module at a time, checked
+    against the manifest) instead of the .pth one, which can then be removed. """
+def main(args):
+    general_config = load_config('../config/general', 'general_config.yaml')
+    for model_name in args.models:
+        if(model_name == 'X2VLM'):
+            path = load_config('../config/X2VLM', 'config.yaml')['pretrained_weights']
+        else:
+            path = '../pretrained_weights/'+model_name+"_weights.pth"
+        if(os.path.exists(converted_weights_path(path)) and not args.overwrite):
+            _logger.info(f" {model_name}: already converted at location {converted_weights_path(path)}")
+            continue
+        if(not os.path.exists(path)):
+            download_weights(model_name, general_config)
+        expected_sha256 = general_config.get(model_name+'_weights_sha256')
+        if(expected_sha256 is None):
+            _logger.warning(f" {model_name}: no {model_name}_weights_sha256 in the general config, the download is not checked")
+        converted_path = convert_weights(path, expected_sha256)
+        _logger.info(f" {model_name}: {path} ({os.path.getsize(path) / 2**20:.0f} MB) converted to {converted_path} "
+                     f"({os.path.getsize(converted_path) / 2**20:.0f} MB), manifest at location {manifest_path(path)}")
+        if(expected_sha256 is None):
+            with open(manifest_path(path)) as file:
+                _logger.info(f" {model_name}: SHA-256 of {path} to pin as {model_name}_weights_sha256: {json.load(file)['source_sha256']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('GLP Project', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,101 @@
+import logging
+import argparse
+import sys
+import os
+import json
+import time
+import statistics
+import yaml
+
+from experiments.registry import MODEL_NAMES, eval_module, config_args
+from experiments.model_loading import load_tokenizer, build_model
+
+_logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--log_level', type=str, default='INFO')
+FLAGS, FIRE_FLAGS = parser.parse_known_args()
+logging.basicConfig(stream=sys.stdout, level=logging.getLevelName(FLAGS.log_level))
+
+BERT_MODELS = ['ALBEF', 'XVLM', 'BLIP', 'X2VLM']
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Check the packed query/key/value projections of the BERT encoders against the unpacked ones', add_help=False)
+    parser.add_argument('--models', default=BERT_MODELS, nargs='+', type=str, choices=BERT_MODELS)
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--text_tokens', default=40, type=int)
+    parser.add_argument('--image_tokens', default=257, type=int, help='length of the encoder states of the cross-attention layers')
+    parser.add_argument('--repeats', default=5, type=int, help='timed forward passes of each layer')
+    parser.add_argument('--rtol', default=1e-4, type=float)
+    parser.add_argument('--atol', default=1e-5, type=float)
+    parser.add_argument('--output', default='../scores/fused_qkv_check.jsonl', type=str, help='one line is appended per run')
+
+    return parser
+
+# Function to load yaml configuration file
+def load_config(config_path, config_name):
+    with open(os.path.join(config_path, config_name)) as file:
+        config = yaml.safe_load(file)
+
+    return config
+
+""" Median time of the forward passes of a layer, in ms, and its output """
+def time_layer(layer, hidden_states, encoder_hidden_states, repeats):
+    output = layer(hidden_states, encoder_hidden_states=encoder_hidden_states)[0]
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        layer(hidden_states, encoder_hidden_states=encoder_hidden_states)
+        seconds.append(time.perf_counter() - start)
+    return 1000 * statistics.median(seconds), output
+
+""" Run every attention layer of the text and fusion encoders of a model loaded with its checkpoint on the same random
+    inputs with the packed projections (fuse_qkv) and without, and compare the outputs """
+def check_model(model, args):
+    import torch
+    torch.manual_seed(0)
+    layers = [module for module in model.modules() if hasattr(module, 'packed_qkv')]
+    result = {'layers': len(layers), 'max_abs_diff': 0.0, 'fused_ms': 0.0, 'unfused_ms': 0.0, 'close': True}
+    with torch.no_grad():
+        for layer in layers:
+            hidden_states = torch.randn(args.batch_size, args.text_tokens, layer.query.in_features)
+            encoder_hidden_states = torch.randn(args.batch_size, args.image_tokens, layer.key.in_features) if layer.is_cross_attention else None
+            layer.fuse_qkv = True
+            fused_ms, fused = time_layer(layer, hidden_states, encoder_hidden_states, args.repeats)
+            layer.fuse_qkv = False
+            unfused_ms, unfused = time_layer(layer, hidden_states, encoder_hidden_states, args.repeats)
+            layer.fuse_qkv = True
+            result['max_abs_diff'] = max(result['max_abs_diff'], (fused - unfused).abs().max().item())
+            result['fused_ms'] += fused_ms
+            result['unfused_ms'] += unfused_ms
+            result['close'] = result['close'] and torch.allclose(fused, unfused, rtol=args.rtol, atol=args.atol)
+    return result
+
+def main(args):
+    configs = {'general': load_config('../config/general', 'general_config.yaml')}
+    for model_name in MODEL_NAMES:
+        configs[model_name] = load_config('../config/'+model_name, 'config.yaml')
+
+    record = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'batch_size': args.batch_size, 'models': {}}
+    for model_name in args.models:
+        tokenizer = load_tokenizer(model_name, configs)
+        model, _ = build_model(model_name, configs, tokenizer)
+        eval_module(model_name).load(model, *config_args(model_name, configs)) # loads the weights, in eval mode
+        result = check_model(model, args)
+        record['models'][model_name] = result
+        _logger.info(f" {model_name}: {result['layers']} attention layers, max abs diff {result['max_abs_diff']:.2e}, "
+                     f"{result['unfused_ms']:.1f} ms unpacked, {result['fused_ms']:.1f} ms packed")
+        if(not result['close']):
+            _logger.error(f" {model_name}: the packed projections do not match the unpacked ones")
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+    _logger.info(f" Check saved at location {args.output}")
+    if(not all(result['close'] for result in record['models'].values())):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('GLP Project', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
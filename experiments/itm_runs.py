@@ -0,0 +1,148 @@
+import gc
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from tqdm import tqdm
+from torch.utils.data import DataLoader, Subset
+
+from datasets.datasets import MultiModelITMDataset, collate_fn, multi_model_collate_fn
+from experiments.metrics import ITMScores, itm_rows, raw_scores_path
+from experiments.journal import ScoreJournal, journal_path
+from experiments.model_loading import MODEL_NAMES, load_tokenizer, build_model, model_size_mb, estimate_model_mb, scores_context
+from experiments.registry import eval_module, config_args
+
+_logger = logging.getLogger(__name__)
+
+""" Dataset file (key of dataset_files in zero_shot.py) and caption column of each split of the ITM experiments """
+SPLIT_SOURCES = {
+    'correct': ('correct_subset', 'active'),
+    'wrong': ('wrong_subset', 'active'),
+    'active': ('combined', 'active'),
+    'passive': ('combined', 'passive'),
+}
+
+""" The splits evaluated by an experiment """
+def get_splits(experiment, split):
+    if(experiment == 'pre'):
+        return ['correct', 'wrong']
+    return ['active', 'passive'] if split == 'all' else [split]
+
+""" Wrap a model for ITM and load its weights, as the eval function of the model does """
+def load_for_itm(model_name, model, configs):
+    return eval_module(model_name).load(model, *config_args(model_name, configs))
+
+""" The journal of an evaluation, or None if journaling is disabled. It lists the samples still to score, those a
+    previous (killed) run did not journal. """
+def open_split_journal(configs, model_name, experiment, dataset, split, split_dataset):
+    if(configs['general']['journal_dir'] is None):
+        return None
+    journal = ScoreJournal(journal_path(configs['general']['journal_dir'], model_name, experiment, dataset, split),
+                           split_dataset.sample_ids, fsync_every=configs['general']['journal_fsync_every'],
+                           context=scores_context(model_name, configs))
+    if(journal.records):
+        _logger.info(f" {model_name}: resuming from the journal, {len(journal.records)} of {len(split_dataset)} samples already scored")
+    return journal
+
+""" Save the results of an evaluation: the raw per-sample scores, from which experiments/recompute.py can rebuild the
+    scores files, and the metrics in the results store. With a journal, the scores are those of the whole journal (the
+    resumed and the new samples), and the journal is removed once they are saved. """
+def save_itm_split(configs, results_store, model_name, experiment, dataset, split, split_dataset, scores, journal=None):
+    if(journal is not None):
+        scores = ITMScores.from_records(journal.merged(), split_dataset.categories)
+    raw_path = raw_scores_path(configs['general']['raw_scores_dir'], model_name, experiment, dataset, split)
+    scores.save(raw_path, sample_ids=split_dataset.sample_ids, verbs=split_dataset.verbs,
+                model=model_name, experiment=experiment, dataset=dataset, split=split)
+    _logger.info(f" Raw scores saved at location {raw_path}")
+    if(journal is not None):
+        journal.close(remove=True) # the raw scores file now holds every sample
+    results_store.append(experiment, itm_rows(model_name, experiment, dataset, split, scores.metrics()))
+    _logger.info(f" Split \"{split}\" for model \"{model_name}\" and \"{dataset}\" dataset complete. Scores saved in the results store {results_store.path}")
+
+""" Evaluate a model on one split of an ITM experiment, journaling the scores as they are computed and skipping the
+    samples a previous (killed) run already scored, then save the results. Returns the number of samples scored. """
+def evaluate_itm_split(configs, results_store, model_name, model, experiment, dataset, split, split_dataset, batch_size):
+    journal = open_split_journal(configs, model_name, experiment, dataset, split, split_dataset)
+    samples = split_dataset if journal is None else Subset(split_dataset, journal.pending)
+    loader = DataLoader(samples, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+    scores = eval_module(model_name).eval(model, loader, *config_args(model_name, configs), journal=journal)
+    save_itm_split(configs, results_store, model_name, experiment, dataset, split, split_dataset, scores, journal)
+    return len(samples)
+
+""" Evaluate all the models (--model all) with one data pipeline: for each dataset and split, the images are decoded
+    once and resized once per resolution, the texts tokenized once per tokenizer family (MultiModelITMDataset), and
+    every batch is scored by all the models loaded, one after the other or, with multi_model_parallel, in one thread
+    each. The models are built one at a time and grouped while their parameters fit in multi_model_memory_mb (null
+    for no limit): each group goes through the pipeline and is freed before a model that would not fit with it is
+    built, so a tight budget runs the models in turn and a large one runs them all together. Whether the next model
+    fits is decided before building it, from the size of its checkpoint (estimate_model_mb), so the models in memory
+    stay within the budget; a model whose checkpoint is not downloaded yet is built after freeing the group. A model
+    bigger than the budget runs alone. """
+def run_all_models(configs, dataset_files, experiment, datasets, splits, batch_size, results_store):
+    memory_mb = configs['general']['multi_model_memory_mb']
+    group = {}
+    group_mb = 0.
+    for model_name in MODEL_NAMES:
+        if(group and memory_mb is not None):
+            estimate_mb = estimate_model_mb(model_name, configs)
+            if(estimate_mb is None or group_mb + estimate_mb > memory_mb):
+                _run_model_group(configs, group, dataset_files, experiment, datasets, splits, batch_size, results_store)
+                group = {}
+                group_mb = 0.
+                gc.collect()
+        tokenizer = load_tokenizer(model_name, configs)
+        model, image_preprocess = build_model(model_name, configs, tokenizer)
+        size_mb = model_size_mb(model)
+        _logger.info(f" {model_name} built ({size_mb:.0f} MB of parameters)")
+        group[model_name] = {'model': load_for_itm(model_name, model, configs), 'tokenizer': tokenizer,
+                             'model_config': configs[model_name], 'image_preprocess': image_preprocess}
+        group_mb += size_mb
+        del model # only the group holds the models, so they are freed with it
+    _run_model_group(configs, group, dataset_files, experiment, datasets, splits, batch_size, results_store)
+
+def _run_model_group(configs, group, dataset_files, experiment, datasets, splits, batch_size, results_store):
+    _logger.info(f" Evaluating {', '.join(group)} together")
+    parallel = configs['general']['multi_model_parallel'] and len(group) > 1
+    executor = ThreadPoolExecutor(max_workers=len(group)) if parallel else None
+    for dataset in datasets:
+        for split in splits:
+            _logger.info(f" Zero-shot Evaluation on the {dataset} benchmark - \"{split}\" mode. Models evaluated: {', '.join(group)}")
+            dataset_file, caption_split = SPLIT_SOURCES[split]
+            split_dataset = MultiModelITMDataset(dataset_file=dataset_files[dataset_file], dataset_name=dataset,
+                                                 split=caption_split, models=group, general_config=configs['general'])
+            journals = {model_name: open_split_journal(configs, model_name, experiment, dataset, split, split_dataset)
+                        for model_name in group}
+            pending = {model_name: set(journal.pending) if journal is not None else None for model_name, journal in journals.items()}
+            scores = {model_name: ITMScores() for model_name in group}
+            # the samples still to score by at least one model; each model then scores the rows it has not journaled
+            indices = sorted(set.union(*[p if p is not None else set(range(len(split_dataset))) for p in pending.values()]))
+            loader = DataLoader(Subset(split_dataset, indices), batch_size=batch_size, shuffle=False, collate_fn=multi_model_collate_fn)
+
+            def score_model(model_name, batch):
+                rows = None
+                if(pending[model_name] is not None):
+                    rows = [row for row, idx in enumerate(batch[0]) if idx in pending[model_name]]
+                    if(not rows):
+                        return None
+                images, captions, foils, categories, image_keys = split_dataset.model_batch(batch, model_name, rows)
+                with torch.no_grad(): # grad mode is per thread
+                    return eval_module(model_name).score(group[model_name]['model'], images, captions, foils, image_keys), categories
+
+            for batch in tqdm(loader):
+                if(executor is not None):
+                    outputs = dict(zip(group, executor.map(lambda model_name: score_model(model_name, batch), group)))
+                else:
+                    outputs = {model_name: score_model(model_name, batch) for model_name in group}
+                for model_name, output in outputs.items():
+                    if(output is None):
+                        continue
+                    (caption_scores, foil_scores), categories = output
+                    scores[model_name].add(caption_scores, foil_scores, categories)
+                    if(journals[model_name] is not None):
+                        journals[model_name].append(caption_scores=caption_scores, foil_scores=foil_scores)
+
+            for model_name in group:
+                save_itm_split(configs, results_store, model_name, experiment, dataset, split, split_dataset,
+                               scores[model_name], journals[model_name])
+    if(executor is not None):
+        executor.shutdown()
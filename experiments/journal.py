@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+""" Append-only journal of the per-sample scores of one evaluation (model, experiment, dataset, split), so that a run
+    killed halfway resumes from the samples it already scored instead of starting over.
+    The first line identifies the samples (their number and a hash of their ids) and what their scores depend on
+    (context, see scores_context in experiments/model_loading.py): a journal written for other samples, or by a model with other weights or another
+    config, is discarded. Every other line holds the scores of one sample index. The file is flushed and fsync'd every
+    fsync_every samples, so a crash loses at most that many; a partially written last line is dropped on reopening.
+    The samples still to score are `pending`, in dataset order, and append() assigns them to the scores it receives
+    in that order, so the loader must iterate Subset(dataset, journal.pending) without shuffling. """
+class ScoreJournal:
+    def __init__(self, path, sample_ids, fsync_every=64, context=None):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.header = {'num_samples': len(sample_ids),
+                       'samples': hashlib.sha1('\n'.join(map(str, sample_ids)).encode()).hexdigest(),
+                       'context': context}
+        self.records = {}
+        self._read()
+        self.pending = [idx for idx in range(len(sample_ids)) if idx not in self.records]
+        self.cursor = 0
+        self.unsynced = 0
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.file = open(self.path, 'a')
+        if(self.file.tell() == 0):
+            self.file.write(json.dumps(self.header) + '\n')
+            self._sync()
+
+    def _read(self):
+        if(not os.path.exists(self.path)):
+            return
+        with open(self.path, 'rb') as file:
+            lines = file.read().split(b'\n')
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            header = None
+        if(header != self.header):
+            logger.warning(f" The journal {self.path} was written for other samples, weights or config, discarding it")
+            os.remove(self.path)
+            return
+        valid_bytes = len(lines[0]) + 1
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break # the last line of a killed run, and the empty string after the final newline
+            self.records[record.pop('index')] = record
+            valid_bytes += len(line) + 1
+        with open(self.path, 'r+b') as file:
+            file.truncate(valid_bytes)
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    """ Journal the scores of the next samples of `pending`: each keyword is a per-sample array (or tensor) whose
+        first dimension is the batch """
+    def append(self, **scores):
+        num_samples = len(next(iter(scores.values())))
+        indices = self.pending[self.cursor:self.cursor + num_samples]
+        self.cursor += num_samples
+        for row, idx in enumerate(indices):
+            record = {name: values[row].tolist() for name, values in scores.items()}
+            self.file.write(json.dumps({'index': idx, **record}) + '\n')
+            self.records[idx] = record
+        self.unsynced += num_samples
+        if(self.unsynced >= self.fsync_every):
+            self._sync()
+
+    def is_complete(self):
+        return len(self.records) == self.header['num_samples']
+
+    """ The journaled scores of all the samples, in dataset order, as one array per score name """
+    def merged(self):
+        assert self.is_complete(), f"{self.header['num_samples'] - len(self.records)} samples missing from {self.path}"
+        names = self.records[0].keys() if self.records else []
+        return {name: np.array([self.records[idx][name] for idx in range(len(self.records))], dtype=np.float32)
+                for name in names}
+
+    def close(self, remove=False):
+        self._sync()
+        self.file.close()
+        if(remove):
+            os.remove(self.path)
+
+""" Path of the journal of a (model, experiment, dataset, split) """
+def journal_path(journal_dir, model, experiment, dataset, split):
+    return os.path.join(journal_dir, f"{model}_{experiment}_{dataset}_{split}.jsonl")
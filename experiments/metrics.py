@@ -0,0 +1,272 @@
+import os
+
+import numpy as np
+import torch
+
+
+SIMILARITY_METRICS = ['true_foil_text', 'active_passive_text', 'difference_text',
+                      'true_foil_vl', 'active_passive_vl', 'difference_vl']
+ITM_METRICS = ['acc', 'pairwise_acc', 'pairwise_acc_50', 'pairwise_acc_60', 'pairwise_acc_70',
+               'precision_caption', 'precision_foil']
+SCORES_COLUMNS = {
+    'pre': ['model', 'split', 'dataset'] + ITM_METRICS,
+    'itm': ['model', 'split', 'category', 'dataset'] + ITM_METRICS,
+    'third': ['model', 'dataset', 'category'] + [name + suffix for name in SIMILARITY_METRICS for suffix in ('_mean', '_std')],
+}
+CURVES_COLUMNS = ['model', 'experiment', 'dataset', 'split', 'category', 'threshold',
+                  'pairwise_acc', 'precision_caption', 'precision_foil']
+
+""" Per-sample indicators (0/1 as float) of every ITM metric, from the caption and foil scores of N samples.
+    The scores are either ITM probabilities of shape (N, 2), ordered as [no match, match], or the (N,) matching
+    probabilities of a contrastive model, which has no match/no-match decision: its acc and precisions are -1. """
+def itm_indicators(caption_scores, foil_scores):
+    if(caption_scores.dim() == 2):
+        caption_match, foil_match = caption_scores[:, 1], foil_scores[:, 1]
+    else:
+        caption_match, foil_match = caption_scores, foil_scores
+    pairwise = caption_match > foil_match
+    indicators = {
+        'pairwise_acc': pairwise,
+        'pairwise_acc_50': pairwise & (caption_match > 0.5),
+        'pairwise_acc_60': pairwise & (caption_match > 0.6),
+        'pairwise_acc_70': pairwise & (caption_match > 0.7),
+    }
+    if(caption_scores.dim() == 2):
+        indicators['precision_caption'] = caption_scores[:, 0] < caption_scores[:, 1] # "the caption fits the image well (VALSE)"
+        indicators['precision_foil'] = foil_scores[:, 0] >= foil_scores[:, 1] # the foil doesn't fit the image well
+        indicators['acc'] = (indicators['precision_caption'].double() + indicators['precision_foil'].double()) / 2
+    return {name: indicator.double() for name, indicator in indicators.items()}
+
+""" Collects the ITM scores of an evaluation batch by batch and computes all the metrics at the end, overall and by
+    category, with vectorized comparisons over contiguous tensors. Categories are coded as integers in order of
+    appearance, so the per-category metrics are a single bincount (a scatter-add) per metric. """
+class ITMScores:
+    def __init__(self):
+        self.caption_scores = []
+        self.foil_scores = []
+        self.category_codes = []
+        self.categories = {}
+
+    def add(self, caption_scores, foil_scores, categories):
+        self.caption_scores.append(caption_scores.detach().float().cpu())
+        self.foil_scores.append(foil_scores.detach().float().cpu())
+        self.category_codes.append(torch.tensor([self.categories.setdefault(category, len(self.categories))
+                                                 for category in categories], dtype=torch.long))
+
+    def __len__(self):
+        return sum(len(codes) for codes in self.category_codes)
+
+    """ Returns (acc, pairwise_acc, pairwise_acc_50, pairwise_acc_60, pairwise_acc_70, precision_caption, precision_foil,
+        perf_by_category), where perf_by_category maps each category to a dict of the same metrics """
+    def metrics(self):
+        if(len(self) == 0):
+            return tuple([-1] * len(ITM_METRICS)) + ({},)
+        indicators = itm_indicators(torch.cat(self.caption_scores), torch.cat(self.foil_scores))
+        codes = torch.cat(self.category_codes)
+        num_categories = len(self.categories)
+        counts = torch.bincount(codes, minlength=num_categories).double()
+
+        overall = {}
+        by_category = {}
+        for name in ITM_METRICS:
+            if(name in indicators):
+                overall[name] = indicators[name].mean().item()
+                by_category[name] = (torch.bincount(codes, weights=indicators[name], minlength=num_categories) / counts).tolist()
+            else:
+                overall[name] = -1
+                by_category[name] = [-1] * num_categories
+
+        perf_by_category = {category: {name: by_category[name][code] for name in ITM_METRICS}
+                            for category, code in self.categories.items()}
+        return tuple(overall[name] for name in ITM_METRICS) + (perf_by_category,)
+
+    """ ITMScores of a whole dataset from the merged records of its score journal """
+    @classmethod
+    def from_records(cls, records, categories):
+        scores = cls()
+        scores.add(torch.from_numpy(records['caption_scores']), torch.from_numpy(records['foil_scores']), categories)
+        return scores
+
+    """ Rows of the threshold curves (see threshold_curves) of all the samples (category None) and of each category """
+    def threshold_curve_rows(self, thresholds):
+        caption_scores = torch.cat(self.caption_scores).numpy()
+        foil_scores = torch.cat(self.foil_scores).numpy()
+        is_itm = caption_scores.ndim == 2
+        caption_match = caption_scores[:, 1] if is_itm else caption_scores
+        foil_match = foil_scores[:, 1] if is_itm else foil_scores
+        codes = torch.cat(self.category_codes).numpy()
+        # group the samples by category with a single stable sort of the codes
+        order = np.argsort(codes, kind='stable')
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(self.categories)))])
+        groups = [(None, slice(None))] + [(category, order[bounds[code]:bounds[code + 1]])
+                                          for category, code in self.categories.items()]
+        rows = []
+        for category, samples in groups:
+            curves = threshold_curves(caption_match[samples], foil_match[samples], thresholds, with_precision=is_itm)
+            for i, threshold in enumerate(thresholds):
+                row = {'category': category, 'threshold': round(float(threshold), 6)}
+                row.update({name: float(curve[i]) for name, curve in curves.items()})
+                rows.append(row)
+        return rows
+
+    """ Write the raw per-sample scores to a compressed .npz file, with the sample ids and verbs of the dataset (the
+        scores are in dataset order) and the (model, experiment, dataset, split) they belong to, so that every metric
+        can be recomputed offline with load(). Contrastive scores have no no-match probabilities (stored as NaN). """
+    def save(self, path, sample_ids, verbs, model, experiment, dataset, split):
+        caption_scores = torch.cat(self.caption_scores).numpy()
+        foil_scores = torch.cat(self.foil_scores).numpy()
+        if(caption_scores.ndim == 2):
+            caption_no_match, caption_match = caption_scores[:, 0], caption_scores[:, 1]
+            foil_no_match, foil_match = foil_scores[:, 0], foil_scores[:, 1]
+        else:
+            caption_match, foil_match = caption_scores, foil_scores
+            caption_no_match = foil_no_match = np.full(len(caption_scores), np.nan, dtype=np.float32)
+        names = np.array(list(self.categories), dtype=str)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path,
+                            sample_id=np.array(sample_ids, dtype=str),
+                            category=names[torch.cat(self.category_codes).numpy()],
+                            verb=np.array(verbs, dtype=str),
+                            caption_match=caption_match, caption_no_match=caption_no_match,
+                            foil_match=foil_match, foil_no_match=foil_no_match,
+                            model=model, experiment=experiment, dataset=dataset, split=split)
+        os.replace(tmp_path, path)
+
+    """ ITMScores and (model, experiment, dataset, split) of a file written by save() """
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as raw:
+            scores = cls()
+            if(np.isnan(raw['caption_no_match']).all()):
+                caption_scores, foil_scores = raw['caption_match'], raw['foil_match']
+            else:
+                caption_scores = np.stack([raw['caption_no_match'], raw['caption_match']], axis=1)
+                foil_scores = np.stack([raw['foil_no_match'], raw['foil_match']], axis=1)
+            scores.add(torch.from_numpy(caption_scores), torch.from_numpy(foil_scores), raw['category'].tolist())
+            return scores, (str(raw['model']), str(raw['experiment']), str(raw['dataset']), str(raw['split']))
+
+""" Pairwise accuracy and caption/foil precision as functions of the threshold t on the match probability:
+    pairwise_acc(t) = P(caption > foil and caption > t) (pairwise_acc_50/60/70 are three points of it),
+    precision_caption(t) = P(caption > t) and precision_foil(t) = P(foil <= t).
+    Each score array is sorted once, and the count above/below every threshold is read from the sorted order with a
+    binary search, so the whole curve costs O(N log N) instead of one pass over the samples per threshold.
+    Without a no-match decision (contrastive scores), the precisions are NaN. """
+def threshold_curves(caption_match, foil_match, thresholds, with_precision=True):
+    num_samples = max(len(caption_match), 1)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    pairwise_correct = np.sort(caption_match[caption_match > foil_match])
+    curves = {'pairwise_acc': (len(pairwise_correct) - np.searchsorted(pairwise_correct, thresholds, side='right')) / num_samples}
+    if(with_precision):
+        curves['precision_caption'] = (len(caption_match) - np.searchsorted(np.sort(caption_match), thresholds, side='right')) / num_samples
+        curves['precision_foil'] = np.searchsorted(np.sort(foil_match), thresholds, side='right') / num_samples
+    else:
+        curves['precision_caption'] = np.full(len(thresholds), np.nan)
+        curves['precision_foil'] = np.full(len(thresholds), np.nan)
+    return curves
+
+""" Path of the raw scores of a (model, experiment, dataset, split) """
+def raw_scores_path(raw_scores_dir, model, experiment, dataset, split):
+    return os.path.join(raw_scores_dir, f"{model}_{experiment}_{dataset}_{split}.npz")
+
+""" Rows of the scores CSV of an ITM experiment, from the output of ITMScores.metrics(): the overall metrics of the
+    (model, dataset, split) and, for the 'itm' experiment, one row per category """
+def itm_rows(model, experiment, dataset, split, metrics):
+    overall, perf_by_category = metrics[:-1], metrics[-1]
+    row = {'model': model, 'dataset': dataset, 'split': split}
+    if(experiment == 'itm'):
+        row['category'] = None # because this is the row with the general results
+    row.update({name: round(value, 3) for name, value in zip(ITM_METRICS, overall)})
+    rows = [row]
+    if(experiment == 'itm'):
+        for category, values in perf_by_category.items():
+            row = {'model': model, 'dataset': dataset, 'split': split, 'category': category}
+            row.update({name: round(values[name], 3) for name in ITM_METRICS})
+            rows.append(row)
+    return rows
+
+""" Streaming mean and (population) standard deviation of the similarity scores, overall and by category.
+    Each batch is reduced to per-category count, mean and M2 (sum of squared deviations) and merged into the running
+    ones with Welford's update in its pairwise form, so the cost is O(1) per sample and nothing is kept per sample.
+    Only the given metrics are tracked (e.g. no textual similarities for BLIP, no multimodal ones for NegCLIP);
+    the others are reported as None. """
+class SimilarityStats:
+    def __init__(self, metrics=SIMILARITY_METRICS):
+        self.metrics = list(metrics)
+        self.categories = {}
+        self.count = np.zeros(0)
+        self.mean = np.zeros((0, len(self.metrics)))
+        self.m2 = np.zeros((0, len(self.metrics)))
+
+    def add(self, categories, **scores):
+        codes = np.array([self.categories.setdefault(category, len(self.categories)) for category in categories], dtype=np.int64)
+        num_categories = len(self.categories)
+        if(num_categories > len(self.count)):
+            new = num_categories - len(self.count)
+            self.count = np.concatenate([self.count, np.zeros(new)])
+            self.mean = np.concatenate([self.mean, np.zeros((new, len(self.metrics)))])
+            self.m2 = np.concatenate([self.m2, np.zeros((new, len(self.metrics)))])
+        values = np.stack([_to_numpy(scores[name]) for name in self.metrics], axis=1)
+
+        batch_count = np.bincount(codes, minlength=num_categories).astype(np.float64)
+        batch_sum = np.zeros((num_categories, len(self.metrics)))
+        np.add.at(batch_sum, codes, values)
+        batch_mean = batch_sum / np.maximum(batch_count, 1)[:, None]
+        batch_m2 = np.zeros((num_categories, len(self.metrics)))
+        np.add.at(batch_m2, codes, (values - batch_mean[codes]) ** 2)
+
+        total = self.count + batch_count
+        ratio = batch_count / np.maximum(total, 1)
+        delta = batch_mean - self.mean
+        self.mean += delta * ratio[:, None]
+        self.m2 += batch_m2 + delta ** 2 * (self.count * ratio)[:, None]
+        self.count = total
+
+    """ SimilarityStats of a whole dataset from the merged records of its score journal """
+    @classmethod
+    def from_records(cls, records, categories, metrics=SIMILARITY_METRICS):
+        stats = cls(metrics)
+        stats.add(categories, **records)
+        return stats
+
+    def _summary(self, count, mean, m2):
+        summary = {}
+        for name in SIMILARITY_METRICS:
+            if(name in self.metrics and count > 0):
+                summary[name + '_mean'] = float(mean[self.metrics.index(name)])
+                summary[name + '_std'] = float(np.sqrt(m2[self.metrics.index(name)] / count))
+            else:
+                summary[name + '_mean'] = None
+                summary[name + '_std'] = None
+        return summary
+
+    """ Returns the means and stds of SIMILARITY_METRICS (in that order, mean before std) followed by perf_by_category,
+        which maps each category to a dict with the same '<metric>_mean'/'<metric>_std' entries """
+    def results(self):
+        # the overall statistics are the per-category ones merged together
+        count = self.count.sum()
+        mean = (self.mean * self.count[:, None]).sum(axis=0) / max(count, 1)
+        m2 = (self.m2 + (self.mean - mean) ** 2 * self.count[:, None]).sum(axis=0)
+        overall = self._summary(count, mean, m2)
+        perf_by_category = {category: self._summary(self.count[code], self.mean[code], self.m2[code])
+                            for category, code in self.categories.items()}
+        return tuple(overall[name + suffix] for name in SIMILARITY_METRICS for suffix in ('_mean', '_std')) + (perf_by_category,)
+
+def _to_numpy(scores):
+    if(isinstance(scores, torch.Tensor)):
+        return scores.detach().cpu().double().numpy()
+    return np.asarray(scores, dtype=np.float64)
+
+""" Rows of the scores CSV of the third experiment, from the output of SimilarityStats.results(): the overall
+    statistics of the (model, dataset) and one row per category """
+def similarity_rows(model, dataset, results):
+    overall, perf_by_category = results[:-1], results[-1]
+    names = [name + suffix for name in SIMILARITY_METRICS for suffix in ('_mean', '_std')]
+    row = {'model': model, 'dataset': dataset, 'category': None} # because this is the row with the general results
+    row.update(zip(names, overall))
+    rows = [row]
+    for category, values in perf_by_category.items():
+        row = {'model': model, 'dataset': dataset, 'category': category}
+        row.update({name: values[name] for name in names})
+        rows.append(row)
+    return rows
@@ -0,0 +1,95 @@
+import os
+import time
+import json
+import hashlib
+import logging
+import contextlib
+
+from experiments.registry import MODEL_NAMES, model_class
+from utils.utils import weights_fingerprint, skip_init, converted_weights_path
+
+_logger = logging.getLogger(__name__)
+
+""" Tokenizer of a model: the one of the text encoder specified in its config file, or the open_clip one for NegCLIP.
+    The cached tokenizer files are used without checking online for a newer version; they are downloaded only when
+    they are not cached yet. """
+def load_tokenizer(model_name, configs):
+    if(model_name=='NegCLIP'):
+        import open_clip
+        return open_clip.get_tokenizer('ViT-B-32')
+    from transformers import AutoTokenizer
+    try:
+        return AutoTokenizer.from_pretrained(configs[model_name]['text_encoder'], local_files_only=True)
+    except (OSError, ValueError):
+        return AutoTokenizer.from_pretrained(configs[model_name]['text_encoder'])
+
+""" Create a model for inference: only the modules used by the ITM and similarity adapters are built, without the
+    momentum encoders, queues and training heads, and without initializing them from their pretrained parts, since
+    all their weights come from the checkpoint the evaluation functions load next (NegCLIP is loaded here). With
+    skip_init in the general config, their weights are not even randomly initialized, and the checkpoint tensors
+    become the parameters when it is loaded (see utils.utils.skip_init and load_weights). Returns it with its
+    image_preprocess, None for the models whose images are preprocessed by the datasets. """
+def build_model(model_name, configs, tokenizer):
+    start = time.perf_counter()
+    init_context = skip_init() if configs['general']['skip_init'] and model_name != 'NegCLIP' else contextlib.nullcontext()
+    with init_context:
+        model, image_preprocess = _build_model(model_name, configs, tokenizer)
+    _logger.info(f" {model_name} built in {time.perf_counter() - start:.1f}s")
+    return model, image_preprocess
+
+def _build_model(model_name, configs, tokenizer):
+    image_preprocess = None
+    if(model_name == 'ALBEF'):
+        model = model_class('ALBEF')(config=configs['ALBEF'], text_encoder=configs['ALBEF']['text_encoder'], tokenizer=tokenizer, inference=True)
+    elif(model_name == 'BLIP'):
+        model = model_class('BLIP')(image_size=configs['BLIP']['image_res'], vit=configs['BLIP']['vit'],
+                      vit_grad_ckpt=configs['BLIP']['vit_grad_ckpt'],
+                      vit_ckpt_layer=configs['BLIP']['vit_ckpt_layer'], queue_size=configs['BLIP']['queue_size'],
+                      med_config=configs['BLIP']['bert_config'], inference=True)
+    elif(model_name == 'XVLM'):
+        model = model_class('XVLM')(config=configs['XVLM'], inference=True)
+    elif(model_name == 'X2VLM'):
+        model = model_class('X2VLM')(config=configs['X2VLM'], load_text_params=True, load_vision_params=True, pretraining=False, inference=True)
+    elif(model_name=='NegCLIP'):
+        path = weights_path('NegCLIP', configs)
+        if not os.path.exists(path):
+            print("Downloading the NegCLIP model...")
+            import gdown
+            gdown.download(id="1ooVVPxB-tvptgmHlIMMFGV3Cg-IrhbRZ", output=path, quiet=False)
+        import open_clip
+        model, _, image_preprocess = open_clip.create_model_and_transforms('ViT-B-32', pretrained=path, device='cpu')
+        model = model_class('NegCLIP')(model, 'cpu')
+        model.weights_fingerprint = weights_fingerprint(path)
+    return model, image_preprocess
+
+""" Checkpoint a model is loaded from """
+def weights_path(model_name, configs):
+    if(model_name == 'X2VLM'):
+        return configs['X2VLM']['pretrained_weights']
+    return os.path.join('../pretrained_weights', model_name+"_weights.pth")
+
+""" Estimate of the memory a model takes once built, in MB, before building it: the size of its checkpoint (of its
+    safetensors conversion if it has one). It is an upper bound for the training checkpoints, which also hold the
+    momentum encoders and heads the inference models do not build. None when the checkpoint is not downloaded yet. """
+def estimate_model_mb(model_name, configs):
+    path = weights_path(model_name, configs)
+    for candidate in (converted_weights_path(path), path):
+        if(os.path.exists(candidate)):
+            return os.path.getsize(candidate) / 2**20
+    return None
+
+""" What the scores of a model depend on besides the samples, identifying them in the score journals: the
+    fingerprint of its checkpoint (None if not downloaded yet) and a hash of its config """
+def scores_context(model_name, configs):
+    path = weights_path(model_name, configs)
+    fingerprint = weights_fingerprint(path) if os.path.exists(path) or os.path.exists(converted_weights_path(path)) else None
+    config = hashlib.sha1(json.dumps(configs.get(model_name), sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return {'weights': fingerprint, 'config': config}
+
+""" Memory taken by the parameters and buffers of a model, in MB. Tensors sharing their storage (e.g. the query, key and
+    value weights viewing their packed projection, see packed_qkv of the BERT attention) are counted once. """
+def model_size_mb(model):
+    storages = {}
+    for t in list(model.parameters()) + list(model.buffers()):
+        storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+    return sum(storages.values()) / 2**20
@@ -0,0 +1,82 @@
+import logging
+import argparse
+import sys
+import os
+import glob
+import yaml
+import numpy as np
+import pandas as pd
+
+from experiments.metrics import ITMScores, CURVES_COLUMNS, itm_rows
+from experiments.results_store import open_results_store
+
+_logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--log_level', type=str, default='INFO')
+FLAGS, FIRE_FLAGS = parser.parse_known_args()
+logging.basicConfig(stream=sys.stdout, level=logging.getLevelName(FLAGS.log_level))
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Rebuild the scores files from the raw per-sample scores', add_help=False)
+    parser.add_argument('--experiment', default='all', type=str, choices=['pre', 'itm', 'all'])
+    parser.add_argument('--raw_scores_dir', default=None, type=str, help='defaults to raw_scores_dir of the general config')
+    parser.add_argument('--curves', action='store_true', help='also write the pairwise accuracy and precision vs threshold curves')
+    parser.add_argument('--num_thresholds', default=101, type=int, help='number of evenly spaced thresholds in [0, 1] of the curves')
+
+    return parser
+
+# Function to load yaml configuration file
+def load_config(config_path, config_name):
+    with open(os.path.join(config_path, config_name)) as file:
+        config = yaml.safe_load(file)
+
+    return config
+
+""" Recompute the metrics of every raw scores file written by zero_shot.py, replace the rows of each recomputed
+    (model, dataset, split) in the results store, keeping the other rows of the experiment, and export its scores CSV.
+    No model is loaded, so thresholds or new metrics can be applied to all the runs at once.
+    With --curves, the threshold curves of every model, dataset, split and category are written to a long table
+    (one row per threshold) ready to be plotted. """
+def main(args):
+    general_config = load_config('../config/general', 'general_config.yaml')
+    raw_scores_dir = args.raw_scores_dir if args.raw_scores_dir is not None else general_config['raw_scores_dir']
+    experiments = ['pre', 'itm'] if args.experiment == 'all' else [args.experiment]
+
+    thresholds = np.linspace(0, 1, args.num_thresholds)
+    results_store = open_results_store(general_config)
+
+    rows = {experiment: [] for experiment in experiments}
+    curve_rows = []
+    for path in sorted(glob.glob(os.path.join(raw_scores_dir, '*.npz'))):
+        scores, (model, experiment, dataset, split) = ITMScores.load(path)
+        if(experiment in rows):
+            rows[experiment].extend(itm_rows(model, experiment, dataset, split, scores.metrics()))
+            if(args.curves):
+                run = {'model': model, 'experiment': experiment, 'dataset': dataset, 'split': split}
+                curve_rows.extend({**run, **row} for row in scores.threshold_curve_rows(thresholds))
+            _logger.info(f" Recomputed {model} - {experiment} - {dataset} - {split} ({len(scores)} samples)")
+
+    for experiment, experiment_rows in rows.items():
+        if(not experiment_rows):
+            _logger.warning(f" No raw scores found for the \"{experiment}\" experiment in {raw_scores_dir}")
+            continue
+        num_rows = results_store.count(experiment)
+        deleted = results_store.replace(experiment, experiment_rows)
+        kept = num_rows - deleted
+        if(kept > 0):
+            _logger.info(f" Kept {kept} rows of the \"{experiment}\" experiment without raw scores (runs not recomputed)")
+        df = results_store.export_csv(experiment, general_config['scores_'+experiment+'_path'])
+        _logger.info(f" Saved {len(df)} rows in the results store and at location {general_config['scores_'+experiment+'_path']}")
+    results_store.close()
+
+    if(args.curves):
+        df = pd.DataFrame(curve_rows, columns=CURVES_COLUMNS)
+        df.to_csv(general_config['threshold_curves_path'], index=False)
+        _logger.info(f" Saved the threshold curves ({len(df)} rows) at location {general_config['threshold_curves_path']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('GLP Project', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
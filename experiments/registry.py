@@ -0,0 +1,45 @@
+import importlib
+from collections import namedtuple, OrderedDict
+
+""" Registry of the model families evaluated by the experiments. Each family is given by the paths of its model class,
+    of its eval module (load, score and eval of the ITM experiments, the first wrapping the model in its ITM adapter)
+    and of its similarities module (third experiment), which are imported on first use: running one model imports
+    only the stack of that model. config_keys are the configs (keys of the configs dict of the entry points) passed,
+    after the model and the loader, to the functions of its eval and similarities modules. """
+ModelFamily = namedtuple('ModelFamily', ['model_class', 'eval_module', 'similarities_module', 'config_keys'])
+
+MODEL_FAMILIES = OrderedDict([
+    ('ALBEF', ModelFamily('models.ALBEF.models.model_pretrain:ALBEF', 'experiments.ALBEF.eval', 'experiments.ALBEF.similarities', ('general',))),
+    ('XVLM', ModelFamily('models.XVLM.models.model_pretrain:XVLM', 'experiments.XVLM.eval', 'experiments.XVLM.similarities', ('general',))),
+    ('BLIP', ModelFamily('models.BLIP.models.blip_pretrain:BLIP_Pretrain', 'experiments.BLIP.eval', 'experiments.BLIP.similarities', ('general',))),
+    ('X2VLM', ModelFamily('models.X2VLM.models.model_pretrain:XVLM', 'experiments.X2VLM.eval', 'experiments.X2VLM.similarities', ('general', 'X2VLM'))),
+    ('NegCLIP', ModelFamily('models.NegCLIP.negclip:CLIPWrapper', 'experiments.NegCLIP.eval', 'experiments.NegCLIP.similarities', ())),
+])
+MODEL_NAMES = list(MODEL_FAMILIES)
+
+""" Add a model family, e.g. from a plugin module. Its name is then accepted by the entry points that list MODEL_NAMES
+    when they are imported after the registration; build_model (experiments/model_loading.py) has to know how to
+    construct it. """
+def register_model(name, model_class, eval_module, similarities_module, config_keys=('general',)):
+    MODEL_FAMILIES[name] = ModelFamily(model_class, eval_module, similarities_module, tuple(config_keys))
+    if(name not in MODEL_NAMES):
+        MODEL_NAMES.append(name)
+
+""" Import a module ('package.module') or an attribute of a module ('package.module:attribute') """
+def _import(path):
+    module_path, _, attribute = path.partition(':')
+    module = importlib.import_module(module_path)
+    return getattr(module, attribute) if attribute else module
+
+def model_class(model_name):
+    return _import(MODEL_FAMILIES[model_name].model_class)
+
+def eval_module(model_name):
+    return _import(MODEL_FAMILIES[model_name].eval_module)
+
+def similarities_module(model_name):
+    return _import(MODEL_FAMILIES[model_name].similarities_module)
+
+""" The configs passed to the eval and similarities functions of a model """
+def config_args(model_name, configs):
+    return [configs[key] for key in MODEL_FAMILIES[model_name].config_keys]
@@ -0,0 +1,132 @@
+import os
+import sqlite3
+import tempfile
+import logging
+
+import pandas as pd
+
+from experiments.metrics import ITM_METRICS, SIMILARITY_METRICS, SCORES_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+SIMILARITY_COLUMNS = [name + suffix for name in SIMILARITY_METRICS for suffix in ('_mean', '_std')]
+KEY_COLUMNS = ['experiment', 'model', 'dataset', 'split', 'category']
+VALUE_COLUMNS = ITM_METRICS + SIMILARITY_COLUMNS
+
+
+""" Results of all the experiments in one SQLite database, which replaces the read-concat-rewrite of the scores CSVs:
+    adding the rows of a split is a single transaction, whatever the number of rows already saved, and runs of several
+    models at once (several processes) can write to it concurrently without losing rows. The database is in WAL mode,
+    so the exports read it while the runs write, and it is indexed on (model, dataset, split, category, experiment).
+    Every row has all the metric columns; those an experiment does not compute are NULL. The CSVs are exported from it
+    with export_csv. """
+class ResultsStore:
+    def __init__(self, path, timeout=60):
+        self.path = path
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # autocommit mode: the transactions are opened explicitly, see _transaction
+        self.connection = sqlite3.connect(self.path, timeout=timeout, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        columns = ', '.join([f'{name} TEXT' for name in KEY_COLUMNS] + [f'{name} REAL' for name in VALUE_COLUMNS])
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns})')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS results_key ON results (model, dataset, split, category, experiment)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS results_experiment ON results (experiment)')
+
+    """ BEGIN IMMEDIATE takes the write lock up front, so two writers wait for each other (up to timeout) instead of
+        failing when both try to upgrade a read transaction. Each statement is a (sql, parameters) pair, or a function
+        of the connection returning the statements, for writes that depend on what is read in the same transaction. """
+    def _transaction(self, statements):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in statements:
+                for sql, parameters in (statement(self.connection) if callable(statement) else [statement]):
+                    self.connection.executemany(sql, parameters)
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def _insert(self, experiment, rows):
+        columns = KEY_COLUMNS + VALUE_COLUMNS
+        sql = f"INSERT INTO results ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        parameters = [[experiment if name == 'experiment' else _sql_value(row.get(name)) for name in columns] for row in rows]
+        return sql, parameters
+
+    """ Add the rows (dicts with the columns of SCORES_COLUMNS[experiment]) of an experiment, all or none of them """
+    def append(self, experiment, rows):
+        self._transaction([self._insert(experiment, rows)])
+
+    """ Replace the rows of an experiment of each (model, dataset, split) in rows by those rows, at once, e.g. with the
+        ones recomputed from the raw scores. The rows of the other runs (such as those imported from older CSVs, which
+        have no raw scores) are kept. Returns the number of rows deleted. """
+    def replace(self, experiment, rows):
+        runs = sorted({(row['model'], row['dataset'], row.get('split')) for row in rows}, key=repr)
+        deleted = sum(self.connection.execute('SELECT COUNT(*) FROM results WHERE experiment = ? AND model = ? AND dataset = ? AND split IS ?',
+                                              (experiment,) + run).fetchone()[0] for run in runs)
+        self._transaction([('DELETE FROM results WHERE experiment = ? AND model = ? AND dataset = ? AND split IS ?',
+                            [(experiment,) + run for run in runs]),
+                           self._insert(experiment, rows)])
+        return deleted
+
+    def count(self, experiment):
+        return self.connection.execute('SELECT COUNT(*) FROM results WHERE experiment = ?', (experiment,)).fetchone()[0]
+
+    """ Id of the last row added, to select the rows added after it with rows(after_id=...) """
+    def last_id(self):
+        return self.connection.execute('SELECT COALESCE(MAX(id), 0) FROM results').fetchone()[0]
+
+    """ The rows of an experiment in the order they were added, with the columns of its scores CSV, all of them or
+        those added after the row after_id """
+    def rows(self, experiment, after_id=0):
+        columns = SCORES_COLUMNS[experiment]
+        sql = f"SELECT {', '.join(columns)} FROM results WHERE experiment = ? AND id > ? ORDER BY id"
+        return pd.read_sql_query(sql, self.connection, params=(experiment, after_id))
+
+    """ Write the scores CSV of an experiment, atomically, so a reader never sees a partially written file. Each export
+        writes its own temporary file, so the runs exporting at the same time do not publish each other's files. """
+    def export_csv(self, experiment, path):
+        df = self.rows(experiment)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', newline='') as file:
+                df.to_csv(file, index=False)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if(os.path.exists(tmp_path)):
+                os.remove(tmp_path)
+            raise
+        return df
+
+    """ Add the rows of an existing scores CSV if the store has no row of the experiment yet, to carry the results
+        saved before the store existed over into it. Returns the number of rows imported. """
+    def import_csv(self, experiment, path):
+        df = pd.read_csv(path)
+        rows = df.astype(object).where(df.notna(), None).to_dict('records')
+        imported = []
+        def insert_if_empty(connection):
+            if(connection.execute('SELECT COUNT(*) FROM results WHERE experiment = ?', (experiment,)).fetchone()[0] > 0):
+                return []
+            imported.append(len(rows))
+            return [self._insert(experiment, rows)]
+        self._transaction([insert_if_empty])
+        return sum(imported)
+
+    def close(self):
+        self.connection.close()
+
+def _sql_value(value):
+    return value.item() if hasattr(value, 'item') else value
+
+""" Open the results store of the general config. The rows of the existing scores CSVs of the experiments that have no
+    row in the store are imported into it (once: the CSVs are then exports of the store), so exporting does not drop
+    the results saved before the store existed """
+def open_results_store(general_config):
+    store = ResultsStore(general_config['results_db_path'])
+    for experiment in SCORES_COLUMNS:
+        csv_path = general_config['scores_'+experiment+'_path']
+        if(os.path.exists(csv_path) and store.count(experiment) == 0):
+            num_rows = store.import_csv(experiment, csv_path)
+            if(num_rows > 0):
+                logger.info(f" Imported {num_rows} rows of {csv_path} into the results store {store.path}")
+    return store
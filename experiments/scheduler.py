@@ -0,0 +1,159 @@
+import logging
+import argparse
+import sys
+import os
+import json
+import time
+from collections import namedtuple, OrderedDict
+
+import yaml
+
+from datasets.dataset_utils import image_cache
+from datasets.datasets import ITMDataset, SimilaritiesDataset
+from models.AdaptedModels.vision_store import vision_store
+from experiments.model_loading import MODEL_NAMES, load_tokenizer, build_model
+from experiments.itm_runs import SPLIT_SOURCES, get_splits, evaluate_itm_split
+from experiments.similarity_runs import evaluate_similarities
+from experiments.results_store import open_results_store
+
+_logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--log_level', type=str, default='INFO')
+FLAGS, FIRE_FLAGS = parser.parse_known_args()
+logging.basicConfig(stream=sys.stdout, level=logging.getLevelName(FLAGS.log_level))
+
+EXPERIMENTS = ['pre', 'itm', 'third']
+
+""" One evaluation of the plan: a model on one split of a dataset for an experiment (split 'all' for the third
+    experiment, which has none) """
+Task = namedtuple('Task', ['model', 'experiment', 'dataset', 'split'])
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Run several experiments loading each model once', add_help=False)
+    parser.add_argument('--models', default=['all'], nargs='+', type=str, choices=MODEL_NAMES + ['all'])
+    parser.add_argument('--experiments', default=EXPERIMENTS, nargs='+', type=str, choices=EXPERIMENTS)
+    parser.add_argument('--dataset', default='all', type=str, choices=['VALSE', 'ARO', 'all'])
+    parser.add_argument('--split', default='all', type=str, choices=['active', 'passive', 'all'], help='split of the itm experiment')
+    parser.add_argument('--batch_size', default=16, type=int, help='number of (image, texts) samples scored together')
+    parser.add_argument('--dry_run', action='store_true', help='only log the plan')
+
+    return parser
+
+# Function to load yaml configuration file
+def load_config(config_path, config_name):
+    with open(os.path.join(config_path, config_name)) as file:
+        config = yaml.safe_load(file)
+
+    return config
+
+""" The tasks of the requested models, experiments, datasets and splits, grouped by model (each group is run with a
+    single load of the model) and, within a group, by dataset, so the tasks reading the same images run back to back
+    while the decoded images and the vision embeddings of the dataset are in the caches """
+def make_plan(models, experiments, datasets, split):
+    plan = OrderedDict()
+    for model in models:
+        plan[model] = []
+        for dataset in datasets:
+            for experiment in EXPERIMENTS:
+                if(experiment not in experiments):
+                    continue
+                splits = ['all'] if experiment == 'third' else get_splits(experiment, split)
+                plan[model].extend(Task(model, experiment, dataset, s) for s in splits)
+    return plan
+
+""" Dataset object of a task """
+def task_dataset(task, configs, tokenizer, image_preprocess):
+    if(task.experiment == 'third'):
+        return SimilaritiesDataset(dataset_file=configs['general']['full_dataset_path'], dataset_name=task.dataset,
+                                   tokenizer=tokenizer, general_config=configs['general'], model_name=task.model,
+                                   model_config=configs[task.model], image_preprocess=image_preprocess)
+    dataset_file, caption_split = SPLIT_SOURCES[task.split]
+    dataset_paths = {'combined': 'full_dataset_path', 'correct_subset': 'correct_subset_path', 'wrong_subset': 'wrong_subset_path'}
+    return ITMDataset(dataset_file=configs['general'][dataset_paths[dataset_file]], dataset_name=task.dataset,
+                      split=caption_split, tokenizer=tokenizer, model_name=task.model, image_preprocess=image_preprocess,
+                      model_config=configs[task.model], general_config=configs['general'])
+
+""" Run a task and return the number of samples it scored, without those resumed from its journal """
+def run_task(task, model, tokenizer, image_preprocess, configs, results_store, batch_size):
+    dataset = task_dataset(task, configs, tokenizer, image_preprocess)
+    if(task.experiment == 'third'):
+        return evaluate_similarities(configs, results_store, task.model, model, task.dataset, dataset, batch_size)
+    return evaluate_itm_split(configs, results_store, task.model, model, task.experiment, task.dataset, task.split, dataset, batch_size)
+
+""" Run a plan. Each model is built once and its weights loaded once, by its first task (the later ones find them
+    already loaded), and the caches of the run (dataset files, decoded images, preprocessed images, tokens, vision
+    embeddings) are shared by all the tasks. The time taken by each model load and each task goes to the run report,
+    written even if a task fails. """
+def run_plan(plan, configs, results_store, batch_size):
+    report = {'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'batch_size': batch_size, 'models': []}
+    run_start = time.perf_counter()
+    try:
+        for model_name, tasks in plan.items():
+            model_report = {'model': model_name, 'tasks': []}
+            report['models'].append(model_report)
+            start = time.perf_counter()
+            tokenizer = load_tokenizer(model_name, configs)
+            model, image_preprocess = build_model(model_name, configs, tokenizer)
+            model_report['build_seconds'] = time.perf_counter() - start
+            for task in tasks:
+                _logger.info(f" {model_name} - {task.experiment} - {task.dataset} - {task.split}")
+                task_report = {'experiment': task.experiment, 'dataset': task.dataset, 'split': task.split, 'status': 'failed'}
+                model_report['tasks'].append(task_report)
+                start = time.perf_counter()
+                num_samples = run_task(task, model, tokenizer, image_preprocess, configs, results_store, batch_size)
+                task_report['seconds'] = time.perf_counter() - start
+                task_report['samples'] = num_samples
+                task_report['samples_per_second'] = num_samples / task_report['seconds'] if task_report['seconds'] > 0 else None
+                task_report['status'] = 'done'
+            model_report['seconds'] = model_report['build_seconds'] + sum(t['seconds'] for t in model_report['tasks'])
+            del model
+    finally:
+        report['total_seconds'] = time.perf_counter() - run_start
+        report['image_cache'] = image_cache.report()
+        report['vision_store'] = vision_store.report()
+        report_path = configs['general']['run_report_path']
+        os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+        with open(report_path, 'w') as file:
+            json.dump(report, file, indent=2)
+        _logger.info(f" Run report saved at location {report_path}")
+    return report
+
+def log_report(report):
+    for model_report in report['models']:
+        _logger.info(f" {model_report['model']}: built in {model_report['build_seconds']:.1f}s")
+        for task in model_report['tasks']:
+            speed = f"{task['samples_per_second']:.1f} samples/s" if task['samples_per_second'] is not None else "- samples/s"
+            _logger.info(f"   {task['experiment']:<5} {task['dataset']:<5} {task['split']:<8} {task['samples']:>6} samples "
+                         f"in {task['seconds']:.1f}s ({speed})")
+    _logger.info(f" Total: {report['total_seconds']:.1f}s")
+
+def main(args):
+    configs = {'general': load_config('../config/general', 'general_config.yaml')}
+    for model_name in MODEL_NAMES:
+        configs[model_name] = load_config('../config/'+model_name, 'config.yaml')
+    image_cache.resize(configs['general']['image_cache_mb'])
+    vision_store.configure(configs['general']['vision_store_mb'], configs['general']['vision_store_dir'], configs['general'].get('vision_store_dir_mb'))
+
+    models = MODEL_NAMES if 'all' in args.models else list(OrderedDict.fromkeys(args.models))
+    datasets = ['ARO', 'VALSE'] if args.dataset == 'all' else [args.dataset]
+    plan = make_plan(models, args.experiments, datasets, args.split)
+    for model_name, tasks in plan.items():
+        _logger.info(f" {model_name}: {', '.join(f'{t.experiment}/{t.dataset}/{t.split}' for t in tasks)}")
+    if(args.dry_run):
+        return
+
+    results_store = open_results_store(configs['general'])
+    report = run_plan(plan, configs, results_store, args.batch_size)
+    log_report(report)
+    """ The scores files are exports of the results store, with the rows of every run so far """
+    for experiment in args.experiments:
+        results_store.export_csv(experiment, configs['general']['scores_'+experiment+'_path'])
+        _logger.info(f" Scores exported at location {configs['general']['scores_'+experiment+'_path']}")
+    results_store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('GLP Project', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,36 @@
+import logging
+
+from torch.utils.data import DataLoader, Subset
+
+from datasets.datasets import collate_fn
+from experiments.metrics import SimilarityStats, similarity_rows
+from experiments.journal import ScoreJournal, journal_path
+from experiments.registry import similarities_module, config_args
+from experiments.model_loading import scores_context
+
+_logger = logging.getLogger(__name__)
+
+""" Compute the embedding similarities of a model on one dataset (the third experiment), journaling the scores as they
+    are computed and skipping the samples a previous (killed) run already scored, then save the statistics in the
+    results store. Returns the number of samples scored. """
+def evaluate_similarities(configs, results_store, model_name, model, dataset, dataset_samples, batch_size, experiment='third'):
+    loader = DataLoader(dataset_samples, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+    num_samples = len(dataset_samples)
+    journal = None
+    if(configs['general']['journal_dir'] is not None):
+        journal = ScoreJournal(journal_path(configs['general']['journal_dir'], model_name, experiment, dataset, 'all'),
+                               dataset_samples.sample_ids, fsync_every=configs['general']['journal_fsync_every'],
+                               context=scores_context(model_name, configs))
+        if(journal.records):
+            _logger.info(f" Resuming from the journal: {len(journal.records)} of {len(dataset_samples)} samples already scored")
+        loader = DataLoader(Subset(dataset_samples, journal.pending), batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+        num_samples = len(journal.pending)
+    stats = similarities_module(model_name).similarities(model, loader, *config_args(model_name, configs), journal=journal)
+    if(journal is not None):
+        stats = SimilarityStats.from_records(journal.merged(), dataset_samples.categories, stats.metrics) # the resumed and the new samples
+
+    results_store.append(experiment, similarity_rows(model_name, dataset, stats.results()))
+    _logger.info(f" \"{dataset}\" dataset complete for model \"{model_name}\". Scores saved in the results store {results_store.path}")
+    if(journal is not None):
+        journal.close(remove=True)
+    return num_samples
@@ -0,0 +1,99 @@
+import logging
+import argparse
+import sys
+import os
+import json
+import time
+
+import numpy as np
+
+from experiments.metrics import SIMILARITY_METRICS, SimilarityStats
+
+_logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--log_level', type=str, default='INFO')
+FLAGS, FIRE_FLAGS = parser.parse_known_args()
+logging.basicConfig(stream=sys.stdout, level=logging.getLevelName(FLAGS.log_level))
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Check the streamed statistics of SimilarityStats against numpy over the concatenated scores', add_help=False)
+    parser.add_argument('--batches', default=20, type=int, help='number of batches added to the statistics')
+    parser.add_argument('--max_batch_size', default=64, type=int, help='batch sizes are drawn between 1 and this')
+    parser.add_argument('--categories', default=6, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--rtol', default=1e-9, type=float)
+    parser.add_argument('--atol', default=1e-12, type=float)
+    parser.add_argument('--output', default='../scores/similarity_stats_check.jsonl', type=str, help='one line is appended per run')
+
+    return parser
+
+""" Random batches of scores and categories: the batch sizes vary (down to one sample), the categories first appear in
+    later batches and not every batch holds every category, as in the runs of the third experiment """
+def random_batches(args):
+    rng = np.random.default_rng(args.seed)
+    categories = [f"category_{i}" for i in range(args.categories)]
+    batches = []
+    for i in range(args.batches):
+        batch_size = int(rng.integers(1, args.max_batch_size + 1))
+        seen = categories[:max(1, (i + 1) * len(categories) // args.batches)]
+        batch_categories = list(rng.choice(seen, size=batch_size))
+        # different offsets and scales per metric, so that a mix-up of the columns shows
+        scores = {name: rng.normal(loc=j, scale=1 + j, size=batch_size) for j, name in enumerate(SIMILARITY_METRICS)}
+        batches.append((batch_categories, scores))
+    return batches
+
+""" Expected '<metric>_mean'/'<metric>_std' of the samples selected by mask, computed by numpy in one pass """
+def numpy_summary(scores, mask):
+    return {name + suffix: float(function(scores[name][mask]))
+            for name in SIMILARITY_METRICS for suffix, function in (('_mean', np.mean), ('_std', np.std))}
+
+""" Largest absolute difference between two summaries and whether all their entries are close """
+def compare(summary, expected, args):
+    diffs = [abs(summary[key] - expected[key]) for key in expected]
+    close = all(np.isclose(summary[key], expected[key], rtol=args.rtol, atol=args.atol) for key in expected)
+    return max(diffs), close
+
+def check(stats, categories, scores, args):
+    results = stats.results()
+    overall = dict(zip([name + suffix for name in SIMILARITY_METRICS for suffix in ('_mean', '_std')], results[:-1]))
+    result = {}
+    result['overall_max_abs_diff'], close = compare(overall, numpy_summary(scores, np.ones(len(categories), dtype=bool)), args)
+    result['category_max_abs_diff'] = 0.0
+    for category, summary in results[-1].items():
+        diff, category_close = compare(summary, numpy_summary(scores, categories == category), args)
+        result['category_max_abs_diff'] = max(result['category_max_abs_diff'], diff)
+        close = close and category_close
+    result['categories'] = len(results[-1])
+    result['close'] = close and set(results[-1]) == set(categories)
+    return result
+
+def main(args):
+    batches = random_batches(args)
+    categories = np.array([category for batch_categories, _ in batches for category in batch_categories])
+    scores = {name: np.concatenate([batch_scores[name] for _, batch_scores in batches]) for name in SIMILARITY_METRICS}
+
+    streamed = SimilarityStats()
+    for batch_categories, batch_scores in batches:
+        streamed.add(batch_categories, **batch_scores)
+    record = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'samples': len(categories), 'batches': args.batches, 'seed': args.seed,
+              'streamed': check(streamed, categories, scores, args),
+              'from_records': check(SimilarityStats.from_records(scores, list(categories)), categories, scores, args)}
+    for mode in ('streamed', 'from_records'):
+        result = record[mode]
+        _logger.info(f" {mode}: {result['categories']} categories, max abs diff {result['overall_max_abs_diff']:.2e} overall, "
+                     f"{result['category_max_abs_diff']:.2e} per category")
+        if(not result['close']):
+            _logger.error(f" {mode}: the statistics do not match numpy over the concatenated scores")
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+    _logger.info(f" Check saved at location {args.output}")
+    if(not all(record[mode]['close'] for mode in ('streamed', 'from_records'))):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('GLP Project', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,73 @@
+import logging
+import argparse
+import sys
+import os
+import json
+import time
+import subprocess
+import statistics
+
+from experiments.registry import MODEL_NAMES
+
+_logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--log_level', type=str, default='INFO')
+FLAGS, FIRE_FLAGS = parser.parse_known_args()
+logging.basicConfig(stream=sys.stdout, level=logging.getLevelName(FLAGS.log_level))
+
+ENTRY_POINTS = ['zero_shot', 'third_experiment', 'scheduler', 'worker_client']
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Measure the startup time of the entry points and the imports of each model', add_help=False)
+    parser.add_argument('--repeats', default=5, type=int, help='runs of each measure (the median is kept)')
+    parser.add_argument('--output', default='../scores/startup_benchmark.jsonl', type=str, help='one line is appended per benchmark run')
+
+    return parser
+
+""" Python code importing what an evaluation of one model imports (the entry point, then the model class and the eval
+    and similarities modules of the registry), printing the time taken and the model stacks imported """
+MODEL_IMPORT_CODE = '''
+import sys, time, json
+start = time.perf_counter()
+import experiments.zero_shot
+from experiments.registry import MODEL_NAMES, model_class, eval_module, similarities_module
+model_class(sys.argv[1]); eval_module(sys.argv[1]); similarities_module(sys.argv[1])
+seconds = time.perf_counter() - start
+stacks = sorted(set(name.split('.')[1] for name in sys.modules if name.startswith('models.') and name.split('.')[1] in MODEL_NAMES))
+print(json.dumps({'seconds': seconds, 'stacks': stacks + ['open_clip'] * ('open_clip' in sys.modules)}))
+'''
+
+""" Each command is run in a new interpreter from the experiments folder, as the entry points are """
+def run(command):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.abspath('..'), os.environ.get('PYTHONPATH', '')]))
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable] + command, capture_output=True, text=True, env=env, check=True).stdout
+    return time.perf_counter() - start, output
+
+""" Wall time of `python -m <entry point> --help` for each entry point, and import time of the stack of each model
+    with the stacks it pulls in (only its own, and open_clip for NegCLIP, are expected). The results are logged and
+    appended to the output file, to track the startup time over the changes. """
+def main(args):
+    record = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'help_seconds': {}, 'model_import': {}}
+    for entry_point in ENTRY_POINTS:
+        seconds = statistics.median(run(['-m', entry_point, '--help'])[0] for _ in range(args.repeats))
+        record['help_seconds'][entry_point] = seconds
+        _logger.info(f" {entry_point} --help: {seconds:.2f}s")
+    for model_name in MODEL_NAMES:
+        results = [json.loads(run(['-c', MODEL_IMPORT_CODE, model_name])[1].strip().splitlines()[-1]) for _ in range(args.repeats)]
+        seconds = statistics.median(result['seconds'] for result in results)
+        record['model_import'][model_name] = {'seconds': seconds, 'stacks': results[0]['stacks']}
+        _logger.info(f" {model_name}: imported in {seconds:.2f}s, stacks imported: {', '.join(results[0]['stacks'])}")
+        if(set(results[0]['stacks']) - {model_name, 'open_clip' if model_name == 'NegCLIP' else model_name}):
+            _logger.warning(f" {model_name} imports the stacks of other models")
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+    _logger.info(f" Benchmark saved at location {args.output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('GLP Project', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -3,23 +3,14 @@ import argparse
 import sys
 import os
 import yaml
-import pandas as pd
-from transformers import AutoTokenizer
 from torch.utils.data import DataLoader
 
-from datasets.datasets import SimilaritiesDataset
-from models.ALBEF.models.model_pretrain import ALBEF
-from models.XVLM.models.model_pretrain import XVLM as XVLM
-from models.X2VLM.models.model_pretrain import XVLM as X2VLM
-from models.BLIP.models.blip_pretrain import BLIP_Pretrain
-from models.NegCLIP.negclip import CLIPWrapper
-from experiments.ALBEF.similarities import similarities as albef_similarities
-from experiments.XVLM.similarities import similarities as xvlm_similarities
-from experiments.X2VLM.similarities import similarities as x2vlm_similarities
-from experiments.BLIP.similarities import similarities as blip_similarities
-from experiments.NegCLIP.similarities import similarities as negclip_similarities
-from utils.utils import download_weights
-import open_clip
+from datasets.dataset_utils import image_cache
+from models.AdaptedModels.vision_store import vision_store
+from datasets.datasets import SimilaritiesDataset, collate_fn
+from experiments.model_loading import MODEL_NAMES, load_tokenizer, build_model
+from experiments.similarity_runs import evaluate_similarities
+from experiments.results_store import open_results_store
 
 _logger = logging.getLogger(__name__)
 
@@ -37,8 +28,9 @@ _logger.info(f"Running with args {FLAGS}, {FIRE_FLAGS}")
 """
 def get_args_parser():
     parser = argparse.ArgumentParser('Set parameters for the expriments', add_help=False)
-    parser.add_argument('--model', default='BLIP', type=str, choices=['ALBEF','XVLM','BLIP','X2VLM','NegCLIP'])
+    parser.add_argument('--model', default='BLIP', type=str, choices=MODEL_NAMES)
     parser.add_argument('--dataset', default='all', type=str, choices=['VALSE', 'ARO','all'])
+    parser.add_argument('--batch_size', default=16, type=int, help='number of (image, texts) samples scored together')
 
     return parser
 
@@ -52,6 +44,7 @@ def load_config(config_path, config_name):
 def main(args):
     model_name = args.model
     dataset = args.dataset
+    batch_size = args.batch_size
     experiment = 'third'
 
     configs = {
@@ -68,45 +61,14 @@ def main(args):
         'NegCLIP': load_config('../config/NegCLIP',
                              'config.yaml'),
     }
+    image_cache.resize(configs['general']['image_cache_mb'])
+    vision_store.configure(configs['general']['vision_store_mb'], configs['general']['vision_store_dir'], configs['general'].get('vision_store_dir_mb'))
+    results_store = open_results_store(configs['general'])
 
     # our tokenizer is initialized from the text encoder specified in the config file
-    if(model_name=='NegCLIP'):
-        tokenizer = open_clip.get_tokenizer('ViT-B-32')
-    else:
-        tokenizer = AutoTokenizer.from_pretrained(configs[model_name]['text_encoder'])
-
-    if(model_name=='XVLM'):
-        download_weights(model_name='swin',
-                         general_config=configs['general'])  # to download the vision encoder weights if not done already
-    if(model_name=='X2VLM'):
-        download_weights(model_name='beitv2_base_patch16_224_pt1k_ft21k',
-                         general_config=configs[
-                             'general'])  # to download the vision encoder weights if not done already
+    tokenizer = load_tokenizer(model_name, configs)
     # load the model
-    if(model_name == 'ALBEF'):
-        model= ALBEF(config=configs['ALBEF'], text_encoder=configs['ALBEF']['text_encoder'], tokenizer=tokenizer)
-        image_preprocess = None
-    elif(model_name == 'BLIP'):
-        model = BLIP_Pretrain(image_size=configs['BLIP']['image_res'], vit=configs['BLIP']['vit'],
-                      vit_grad_ckpt=configs['BLIP']['vit_grad_ckpt'],
-                      vit_ckpt_layer=configs['BLIP']['vit_ckpt_layer'], queue_size=configs['BLIP']['queue_size'],
-                      med_config=configs['BLIP']['bert_config'])
-        image_preprocess = None
-    elif(model_name == 'XVLM'):
-        model = XVLM(config=configs['XVLM'])
-        image_preprocess = None
-    elif(model_name == 'X2VLM'):
-        model = X2VLM(config=configs['X2VLM'], load_text_params=True, load_vision_params=True, pretraining=False)
-        image_preprocess = None
-    elif(model_name=='NegCLIP'):
-        path = os.path.join('../pretrained_weights', "NegCLIP_weights.pth")
-        if not os.path.exists(path):
-            print("Downloading the NegCLIP model...")
-            import gdown
-            gdown.download(id="1ooVVPxB-tvptgmHlIMMFGV3Cg-IrhbRZ", output=path, quiet=False)
-        model, _, image_preprocess = open_clip.create_model_and_transforms('ViT-B-32', pretrained=path, device='cpu')
-        model = CLIPWrapper(model, 'cpu')
-
+    model, image_preprocess = build_model(model_name, configs, tokenizer)
 
     dataset_files = {
         'combined': configs['general']['full_dataset_path']
@@ -132,73 +94,22 @@ def main(args):
 
     """ Define our loaders """
     loaders = {
-            'ARO': DataLoader(ARO_dataset, batch_size=1, shuffle=False),
-            'VALSE': DataLoader(VALSE_dataset, batch_size=1, shuffle=False)
+            'ARO': DataLoader(ARO_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn),
+            'VALSE': DataLoader(VALSE_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
         }
 
     _logger.info(f" Evaluation on the {dataset} benchmark. Model evaluated: {model_name}")
 
     """ Run the evaluation for each model """
-    if(dataset == 'all'):
-        for dataset in ['ARO','VALSE']:
-            if (model_name == 'ALBEF'):
-                tf_t_mean, tf_t_std, ap_t_mean, ap_t_std, diff_t_mean, diff_t_std, tf_vl_mean, tf_vl_std, ap_vl_mean, ap_vl_std, diff_vl_mean, diff_vl_std, perf_by_cat = albef_similarities(model,loaders[dataset],configs['general'])
-                
-            elif(model_name == 'XVLM'):
-                tf_t_mean, tf_t_std, ap_t_mean, ap_t_std, diff_t_mean, diff_t_std, tf_vl_mean, tf_vl_std, ap_vl_mean, ap_vl_std, diff_vl_mean, diff_vl_std, perf_by_cat = xvlm_similarities(model,loaders[dataset],configs['general'])    
-            
-            elif (model_name == 'BLIP'):
-                tf_t_mean, tf_t_std, ap_t_mean, ap_t_std, diff_t_mean, diff_t_std, tf_vl_mean, tf_vl_std, ap_vl_mean, ap_vl_std, diff_vl_mean, diff_vl_std, perf_by_cat = blip_similarities(model,loaders[dataset],configs['general'])    
-            
-            elif (model_name == 'X2VLM'):
-                tf_t_mean, tf_t_std, ap_t_mean, ap_t_std, diff_t_mean, diff_t_std, tf_vl_mean, tf_vl_std, ap_vl_mean, ap_vl_std, diff_vl_mean, diff_vl_std, perf_by_cat = x2vlm_similarities(model,loaders[dataset],configs['general'],configs['X2VLM'])    
-            
-            elif (model_name == 'NegCLIP'):
-                tf_t_mean, tf_t_std, ap_t_mean, ap_t_std, diff_t_mean, diff_t_std, tf_vl_mean, tf_vl_std, ap_vl_mean, ap_vl_std, diff_vl_mean, diff_vl_std, perf_by_cat = negclip_similarities(model,loaders[dataset])    
-
-            df = pd.read_csv(configs['general']['scores_'+experiment+'_path'])
-            rows = []
-            new_row = {
-                        'model': model_name,
-                        'dataset': dataset,
-                        'category': None, # because this is the row with the general results as we want in the pre and first experiments
-                        'true_foil_text_mean':tf_t_mean,
-                        'true_foil_text_std':tf_t_std,
-                        'active_passive_text_mean':ap_t_mean,
-                        'active_passive_text_std':ap_t_std,
-                        'difference_text_mean':diff_t_mean,
-                        'difference_text_std':diff_t_std,
-                        'true_foil_vl_mean':tf_vl_mean,
-                        'true_foil_vl_std':tf_vl_std,
-                        'active_passive_vl_mean':ap_vl_mean,
-                        'active_passive_vl_std':ap_vl_std,
-                        'difference_vl_mean':diff_vl_mean,
-                        'difference_vl_std':diff_vl_std
-                    }
-            rows.append(new_row)
-           
-            for key,value in perf_by_cat.items():
-                new_row = {
-                            'model': model_name,
-                            'dataset': dataset,
-                            'category': key,
-                            'true_foil_text_mean':value['true_foil_text_mean'],
-                            'true_foil_text_std':value['true_foil_text_std'],
-                            'active_passive_text_mean':value['active_passive_text_mean'],
-                            'active_passive_text_std':value['active_passive_text_std'],
-                            'difference_text_mean':value['difference_text_mean'],
-                            'difference_text_std':value['difference_text_std'],
-                            'true_foil_vl_mean':value['true_foil_vl_mean'],
-                            'true_foil_vl_std':value['true_foil_vl_std'],
-                            'active_passive_vl_mean':value['active_passive_vl_mean'],
-                            'active_passive_vl_std':value['active_passive_vl_std'],
-                            'difference_vl_mean':value['difference_vl_mean'],
-                            'difference_vl_std':value['difference_vl_std']
-                            }
-                rows.append(new_row)
-            rows = pd.DataFrame(rows)
-            df = pd.concat([df, rows], ignore_index=True)
-            df.to_csv(configs['general']['scores_'+experiment+'_path'], index=False)
+    datasets = ['ARO','VALSE'] if dataset == 'all' else [dataset]
+    for dataset in datasets:
+        evaluate_similarities(configs, results_store, model_name, model, dataset, loaders[dataset].dataset, batch_size, experiment)
+    """ The scores file is an export of the results store, with the rows of every run so far """
+    results_store.export_csv(experiment, configs['general']['scores_'+experiment+'_path'])
+    _logger.info(f" Scores exported at location {configs['general']['scores_'+experiment+'_path']}")
+    results_store.close()
+    _logger.info(f" Decoded image cache: {image_cache.report()}")
+    _logger.info(f" Vision embedding store: {vision_store.report()}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,180 @@
+import logging
+import argparse
+import sys
+import os
+import json
+import time
+import socket
+import traceback
+
+from datasets.dataset_utils import image_cache
+from models.AdaptedModels.vision_store import vision_store
+from experiments.model_loading import MODEL_NAMES, load_tokenizer, build_model, model_size_mb
+from experiments.scheduler import load_config, make_plan, run_task
+from experiments.results_store import open_results_store
+
+_logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--log_level', type=str, default='INFO')
+FLAGS, FIRE_FLAGS = parser.parse_known_args()
+logging.basicConfig(stream=sys.stdout, level=logging.getLevelName(FLAGS.log_level))
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Keep the models loaded and run the experiments submitted by worker_client.py', add_help=False)
+    parser.add_argument('--socket', default=None, type=str, help='defaults to worker_socket of the general config')
+    parser.add_argument('--preload', default=[], nargs='+', type=str, choices=MODEL_NAMES, help='models to build at start')
+
+    return parser
+
+""" One client connection: messages are JSON objects, one per line, in both directions. A client that goes away does
+    not stop the job it submitted, whose results are saved anyway; the messages to it are dropped. """
+class Connection:
+    def __init__(self, connection):
+        self.connection = connection
+        self.file = connection.makefile('rw', encoding='utf-8')
+        self.closed = False
+
+    def receive(self):
+        line = self.file.readline()
+        return json.loads(line) if line else None
+
+    def send(self, **message):
+        if(self.closed):
+            return
+        try:
+            self.file.write(json.dumps(message, default=str) + '\n')
+            self.file.flush()
+        except OSError:
+            self.closed = True
+
+    def close(self):
+        try:
+            self.file.close()
+            self.connection.close()
+        except OSError:
+            pass
+
+""" Forward the log messages of a job to its client, as its progress """
+class ConnectionLogHandler(logging.Handler):
+    def __init__(self, connection):
+        super().__init__()
+        self.connection = connection
+
+    def emit(self, record):
+        self.connection.send(type='log', level=record.levelname, message=record.getMessage())
+
+""" Long-lived process keeping the models it has built in memory, with their weights loaded, along with the caches of
+    the runs (decoded images, vision embeddings, dataset files). Each job submitted by a client runs the plan of
+    the scheduler (experiments/scheduler.py) with the resident models, building only those not built yet, so a job
+    costs only the scoring. Jobs run one at a time, in the order the clients connect. """
+class Worker:
+    def __init__(self, configs, socket_path):
+        self.configs = configs
+        self.socket_path = socket_path
+        self.models = {} # model name -> (tokenizer, model, image_preprocess)
+        self.results_store = open_results_store(configs['general'])
+        self.running = True
+
+    def model(self, model_name):
+        if(model_name not in self.models):
+            tokenizer = load_tokenizer(model_name, self.configs)
+            model, image_preprocess = build_model(model_name, self.configs, tokenizer)
+            self.models[model_name] = (tokenizer, model, image_preprocess)
+        return self.models[model_name]
+
+    def serve(self):
+        if(os.path.exists(self.socket_path)):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                raise RuntimeError(f"A worker is already listening on {self.socket_path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(self.socket_path) # left by a worker that was killed
+            finally:
+                probe.close()
+        os.makedirs(os.path.dirname(self.socket_path) or '.', exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen()
+        _logger.info(f" Worker listening on {self.socket_path}")
+        try:
+            while self.running:
+                connection, _ = server.accept()
+                connection = Connection(connection)
+                try:
+                    self.handle(connection, connection.receive())
+                finally:
+                    connection.close()
+        finally:
+            server.close()
+            os.remove(self.socket_path)
+            self.results_store.close()
+
+    def handle(self, connection, request):
+        if(request is None):
+            return
+        try:
+            if(request['command'] == 'run'):
+                self.run(connection, request)
+            elif(request['command'] == 'status'):
+                connection.send(type='status', models={name: model_size_mb(model) for name, (_, model, _) in self.models.items()},
+                                image_cache=image_cache.report(), vision_store=vision_store.report())
+            elif(request['command'] == 'unload'):
+                for model_name in request['models']:
+                    self.models.pop(model_name, None)
+                connection.send(type='done', models=list(self.models))
+            elif(request['command'] == 'shutdown'):
+                self.running = False
+                connection.send(type='done')
+            else:
+                connection.send(type='error', message=f"Unknown command {request['command']}")
+        except Exception:
+            _logger.exception(f" Request {request} failed")
+            connection.send(type='error', message=traceback.format_exc())
+
+    """ Run the plan of a job, sending the log messages, the end of each task with its time and the rows it added to
+        the results store, then export the scores CSVs of its experiments as the scheduler does """
+    def run(self, connection, request):
+        models = MODEL_NAMES if 'all' in request['models'] else request['models']
+        datasets = ['ARO', 'VALSE'] if request['dataset'] == 'all' else [request['dataset']]
+        plan = make_plan(models, request['experiments'], datasets, request['split'])
+        handler = ConnectionLogHandler(connection)
+        logging.getLogger().addHandler(handler)
+        try:
+            for model_name, tasks in plan.items():
+                start = time.perf_counter()
+                tokenizer, model, image_preprocess = self.model(model_name)
+                connection.send(type='model', model=model_name, seconds=time.perf_counter() - start)
+                for task in tasks:
+                    _logger.info(f" {model_name} - {task.experiment} - {task.dataset} - {task.split}")
+                    last_id = self.results_store.last_id()
+                    start = time.perf_counter()
+                    num_samples = run_task(task, model, tokenizer, image_preprocess, self.configs, self.results_store, request['batch_size'])
+                    rows = self.results_store.rows(task.experiment, after_id=last_id)
+                    rows = rows[rows['model'] == model_name]
+                    connection.send(type='task', task=task._asdict(), samples=num_samples, seconds=time.perf_counter() - start,
+                                    rows=rows.astype(object).where(rows.notna(), None).to_dict('records'))
+            for experiment in request['experiments']:
+                self.results_store.export_csv(experiment, self.configs['general']['scores_'+experiment+'_path'])
+        finally:
+            logging.getLogger().removeHandler(handler)
+        connection.send(type='done')
+
+def main(args):
+    configs = {'general': load_config('../config/general', 'general_config.yaml')}
+    for model_name in MODEL_NAMES:
+        configs[model_name] = load_config('../config/'+model_name, 'config.yaml')
+    image_cache.resize(configs['general']['image_cache_mb'])
+    vision_store.configure(configs['general']['vision_store_mb'], configs['general']['vision_store_dir'], configs['general'].get('vision_store_dir_mb'))
+
+    worker = Worker(configs, args.socket if args.socket is not None else configs['general']['worker_socket'])
+    for model_name in args.preload:
+        worker.model(model_name)
+    worker.serve()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('GLP Project', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
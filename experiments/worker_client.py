@@ -0,0 +1,89 @@
+import argparse
+import sys
+import os
+import json
+import socket
+import yaml
+
+from experiments.registry import MODEL_NAMES
+
+""" Thin client of the warm model worker (experiments/worker.py): it submits a job over the worker's Unix socket and
+    prints its progress and results as they come. It imports none of the model stacks, so it starts instantly: the
+    model names come from the registry, which imports its models only on first use. """
+
+EXPERIMENTS = ['pre', 'itm', 'third']
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Submit experiments to the warm model worker', add_help=False)
+    parser.add_argument('--models', default=['all'], nargs='+', type=str, choices=MODEL_NAMES + ['all'])
+    parser.add_argument('--experiments', default=EXPERIMENTS, nargs='+', type=str, choices=EXPERIMENTS)
+    parser.add_argument('--dataset', default='all', type=str, choices=['VALSE', 'ARO', 'all'])
+    parser.add_argument('--split', default='all', type=str, choices=['active', 'passive', 'all'], help='split of the itm experiment')
+    parser.add_argument('--batch_size', default=16, type=int, help='number of (image, texts) samples scored together')
+    parser.add_argument('--socket', default=None, type=str, help='defaults to worker_socket of the general config')
+    parser.add_argument('--status', action='store_true', help='print the models loaded by the worker and its caches')
+    parser.add_argument('--unload', default=None, nargs='+', type=str, choices=MODEL_NAMES, help='free these models')
+    parser.add_argument('--shutdown', action='store_true', help='stop the worker')
+
+    return parser
+
+# Function to load yaml configuration file
+def load_config(config_path, config_name):
+    with open(os.path.join(config_path, config_name)) as file:
+        config = yaml.safe_load(file)
+
+    return config
+
+""" Send a request and yield the messages of the worker until the end of the request """
+def submit(socket_path, request):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    with client, client.makefile('rw', encoding='utf-8') as file:
+        file.write(json.dumps(request) + '\n')
+        file.flush()
+        for line in file:
+            message = json.loads(line)
+            yield message
+            if(message['type'] in ('done', 'error')):
+                return
+    raise ConnectionError("The worker closed the connection before the end of the request")
+
+def print_message(message):
+    if(message['type'] == 'log'):
+        print(message['message'])
+    elif(message['type'] == 'model'):
+        print(f"{message['model']} ready in {message['seconds']:.1f}s")
+    elif(message['type'] == 'task'):
+        task = message['task']
+        print(f"{task['model']} - {task['experiment']} - {task['dataset']} - {task['split']}: {message['samples']} samples in {message['seconds']:.1f}s")
+        for row in message['rows']:
+            print('  ' + ', '.join(f"{key}={value:.4f}" if isinstance(value, float) else f"{key}={value}" for key, value in row.items()))
+    elif(message['type'] == 'status'):
+        for model_name, size_mb in message['models'].items():
+            print(f"{model_name}: {size_mb:.0f} MB")
+        print(f"image cache: {message['image_cache']}")
+        print(f"vision store: {message['vision_store']}")
+    elif(message['type'] == 'error'):
+        print(message['message'], file=sys.stderr)
+
+def main(args):
+    socket_path = args.socket if args.socket is not None else load_config('../config/general', 'general_config.yaml')['worker_socket']
+    if(args.shutdown):
+        request = {'command': 'shutdown'}
+    elif(args.status):
+        request = {'command': 'status'}
+    elif(args.unload is not None):
+        request = {'command': 'unload', 'models': args.unload}
+    else:
+        request = {'command': 'run', 'models': args.models, 'experiments': args.experiments, 'dataset': args.dataset,
+                   'split': args.split, 'batch_size': args.batch_size}
+    for message in submit(socket_path, request):
+        print_message(message)
+        if(message['type'] == 'error'):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('GLP Project', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -17,6 +17,7 @@ from torch.utils.data import DataLoader
 
 from models.model_retrieval import ALBEF
 from models.vit import interpolate_pos_embed
+from models.xbert import cross_attention_kv_cache
 from models.tokenization_bert import BertTokenizer
 
 import utils
@@ -124,15 +125,17 @@ def evaluation(model, data_loader, tokenizer, device, config):
     for i,sims in enumerate(metric_logger.log_every(sims_matrix[start:end], 50, header)): 
         topk_sim, topk_idx = sims.topk(k=config['k_test'], dim=0)
 
-        encoder_output = image_feats[start+i].repeat(config['k_test'],1,1)
+        # the image keys/values are projected once and shared by its k_test candidate texts
+        encoder_output = image_feats[start+i].unsqueeze(0)
         encoder_att = torch.ones(encoder_output.size()[:-1],dtype=torch.long).to(device)
-        output = model.text_encoder(encoder_embeds = text_feats[topk_idx], 
-                                    attention_mask = text_atts[topk_idx],
-                                    encoder_hidden_states = encoder_output,
-                                    encoder_attention_mask = encoder_att,                             
-                                    return_dict = True,
-                                    mode = 'fusion'
-                                   )
+        with cross_attention_kv_cache(model.text_encoder, encoder_output):
+            output = model.text_encoder(encoder_embeds = text_feats[topk_idx], 
+                                        attention_mask = text_atts[topk_idx],
+                                        encoder_hidden_states = encoder_output,
+                                        encoder_attention_mask = encoder_att,                             
+                                        return_dict = True,
+                                        mode = 'fusion'
+                                       )
         score = model.itm_head(output.last_hidden_state[:,0,:])[:,1]
         score_matrix_i2t[start+i,topk_idx] = score
         
@@ -23,10 +23,16 @@ class ALBEF(nn.Module):
                  tokenizer = None,
                  config = None,    
                  temp = 0.07,
-                 init_deit = True
+                 init_deit = True,
+                 inference = False
                  ):
+        """
+        inference (bool): build only the modules used to score image-text pairs (no momentum encoders and queues),
+            without initializing them from DeiT and BERT, as all their weights come from the checkpoint loaded next
+        """
         super().__init__()
         
+        self.inference = inference
         self.tokenizer = tokenizer 
         self.mlm_probability = config['mlm_probability']
         embed_dim = config['embed_dim']
@@ -35,7 +41,7 @@ class ALBEF(nn.Module):
             img_size=config['image_res'], patch_size=16, embed_dim=768, depth=12, num_heads=12, 
             mlp_ratio=4, qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6))   
         
-        if init_deit:
+        if init_deit and not inference:
             checkpoint = torch.hub.load_state_dict_from_url(
                 url="https://dl.fbaipublicfiles.com/deit/deit_base_patch16_224-b5f2ef4d.pth",
                 map_location="cpu", check_hash=True)
@@ -48,7 +54,10 @@ class ALBEF(nn.Module):
         vision_width = config['vision_width']       
         bert_config = BertConfig.from_json_file(config['bert_config'])
         
-        self.text_encoder = BertForMaskedLM.from_pretrained(text_encoder, config=bert_config)      
+        if inference:
+            self.text_encoder = BertForMaskedLM(config=bert_config)
+        else:
+            self.text_encoder = BertForMaskedLM.from_pretrained(text_encoder, config=bert_config)      
 
         text_width = self.text_encoder.config.hidden_size
         self.vision_proj = nn.Linear(vision_width, embed_dim)
@@ -59,6 +68,9 @@ class ALBEF(nn.Module):
         self.momentum = config['momentum']  
         self.itm_head = nn.Linear(text_width, 2)     
 
+        if inference:
+            return
+
         # create momentum models
         self.visual_encoder_m = VisionTransformer(
             img_size=config['image_res'], patch_size=16, embed_dim=768, depth=12, num_heads=12, 
@@ -2,48 +2,46 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
+from models.AdaptedModels.adapter_utils import stack_candidates, candidate_image_inputs
+from models.AdaptedModels.vision_store import vision_store
+
 
 class ALBEFForITM(nn.Module):
-    def __init__(self, base_model):
+    def __init__(self, base_model, cache_cross_attention=False):
         super().__init__()
         self.base_model = base_model
+        self.cache_cross_attention = cache_cross_attention
 
-
-    def forward(self, images, captions, foils):
+    """ ITM probabilities of K candidate texts for each image, as a tensor of shape (K, B, 2).
+        The candidates are stacked along the batch dimension, so the text and the fusion encoders run once.
+        With image_keys, the vision embeddings are taken from (and added to) the shared vision store. """
+    def score(self, images, candidate_texts, image_keys=None):
         """ Take the image embeddings and the attention mask """
-        image_embeds = self.base_model.visual_encoder(images)
+        image_embeds = vision_store.encode(self.base_model.visual_encoder, images, image_keys,
+                                           vision_store.model_key('ALBEF', self.base_model))
         image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long)
 
-        """ Take the textual embeddings for the captions and the foils """
-        captions.input_ids = torch.squeeze(captions.input_ids,dim=0)
-        foils.input_ids = torch.squeeze(foils.input_ids,dim=0)
-        captions_output = self.base_model.text_encoder.bert(captions.input_ids, attention_mask=captions.attention_mask,
-                                             return_dict=True, mode='text')
-        captions_embeds = captions_output.last_hidden_state
-
-        foils_output = self.base_model.text_encoder.bert(foils.input_ids, attention_mask=foils.attention_mask,
-                                                 return_dict=True, mode='text')
-        foils_embeds = foils_output.last_hidden_state
+        """ Take the textual embeddings for all the candidates """
+        input_ids, attention_mask = stack_candidates(candidate_texts)
+        text_embeds = self.base_model.text_encoder.bert(input_ids, attention_mask=attention_mask,
+                                             return_dict=True, mode='text').last_hidden_state
 
         """ Fuse together (the chosen mode is 'fusion' here) """
-        captions_vl_embeds = self.base_model.text_encoder.bert(encoder_embeds=captions_embeds,
-                                            attention_mask=captions.attention_mask,
-                                            encoder_hidden_states=image_embeds,
-                                            encoder_attention_mask=image_atts,
-                                            return_dict=True,
-                                            mode='fusion',
-                                            ).last_hidden_state[:,0,:]
-        foils_vl_embeds = self.base_model.text_encoder.bert(encoder_embeds=foils_embeds,
-                                                    attention_mask=foils.attention_mask,
-                                                    encoder_hidden_states=image_embeds,
-                                                    encoder_attention_mask=image_atts,
-                                                    return_dict=True,
-                                                    mode='fusion',
-                                                    ).last_hidden_state[:,0,:]
-        captions_vl_output = self.base_model.itm_head(captions_vl_embeds)
-        foils_vl_output = self.base_model.itm_head(foils_vl_embeds)
-
-        """ Each ITM head returns the probability for the caption to match the image. 
+        num_candidates = len(candidate_texts)
+        with candidate_image_inputs(self.base_model.text_encoder, image_embeds, image_atts, num_candidates,
+                                    self.cache_cross_attention) as (cross_image_embeds, cross_image_atts):
+            vl_embeds = self.base_model.text_encoder.bert(encoder_embeds=text_embeds,
+                                                attention_mask=attention_mask,
+                                                encoder_hidden_states=cross_image_embeds,
+                                                encoder_attention_mask=cross_image_atts,
+                                                return_dict=True,
+                                                mode='fusion',
+                                                ).last_hidden_state[:,0,:]
+        vl_output = self.base_model.itm_head(vl_embeds)
+        return F.softmax(vl_output, dim=1).view(num_candidates, images.size(0), -1)
+
+    def forward(self, images, captions, foils, image_keys=None):
+        """ Each ITM head returns the probability for the caption to match the image.
         We only take the probability for the image to match the caption """
-        prob_scores = [F.softmax(captions_vl_output, dim=1),F.softmax(foils_vl_output, dim=1)]
-        return prob_scores
+        prob_scores = self.score(images, [captions, foils], image_keys)
+        return [prob_scores[0], prob_scores[1]]
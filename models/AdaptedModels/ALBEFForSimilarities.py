@@ -1,58 +1,45 @@
 import torch
 from torch import nn
 
+from models.AdaptedModels.adapter_utils import stack_candidates, candidate_image_inputs
+from models.AdaptedModels.vision_store import vision_store
+
 
 class ALBEFForSimilarities(nn.Module):
-    def __init__(self, base_model):
+    def __init__(self, base_model, cache_cross_attention=False):
         super().__init__()
         self.base_model = base_model
+        self.cache_cross_attention = cache_cross_attention
 
-
-    def forward(self, images, true_actives, foil_actives, true_passives):
+    """ Textual and multimodal [CLS] embeddings of K candidate texts for each image, both of shape (K, B, D).
+        The candidates are stacked along the batch dimension, so the text and the fusion encoders run once.
+        With image_keys, the vision embeddings are taken from (and added to) the shared vision store. """
+    def encode(self, images, candidate_texts, image_keys=None):
         """ Take the image embeddings and the attention mask """
-        image_embeds = self.base_model.visual_encoder(images)
+        image_embeds = vision_store.encode(self.base_model.visual_encoder, images, image_keys,
+                                           vision_store.model_key('ALBEF', self.base_model))
         image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long)
 
-        """ Take the textual embeddings for the captions and the foils """
-        true_actives.input_ids = torch.squeeze(true_actives.input_ids, dim=0)
-        foil_actives.input_ids = torch.squeeze(foil_actives.input_ids, dim=0)
-        true_passives.input_ids = torch.squeeze(true_passives.input_ids, dim=0)
-        
-        true_actives_output = self.base_model.text_encoder.bert(true_actives.input_ids, attention_mask=true_actives.attention_mask,
-                                             return_dict=True, mode='text')
-        true_actives_embeds = true_actives_output.last_hidden_state
-
-        foil_actives_output = self.base_model.text_encoder.bert(foil_actives.input_ids, attention_mask=foil_actives.attention_mask,
-                                             return_dict=True, mode='text')
-        foil_actives_embeds = foil_actives_output.last_hidden_state
-
-        true_passives_output = self.base_model.text_encoder.bert(true_passives.input_ids, attention_mask=true_passives.attention_mask,
-                                             return_dict=True, mode='text')
-        true_passives_embeds = true_passives_output.last_hidden_state
-
+        """ Take the textual embeddings for all the candidates """
+        input_ids, attention_mask = stack_candidates(candidate_texts)
+        text_embeds = self.base_model.text_encoder.bert(input_ids, attention_mask=attention_mask,
+                                             return_dict=True, mode='text').last_hidden_state
 
         """ Fuse together (the chosen mode is 'fusion' here) """
-        true_actives_vl_embeds = self.base_model.text_encoder.bert(encoder_embeds=true_actives_embeds,
-                                            attention_mask=true_actives.attention_mask,
-                                            encoder_hidden_states=image_embeds,
-                                            encoder_attention_mask=image_atts,
-                                            return_dict=True,
-                                            mode='fusion',
-                                            ).last_hidden_state[:,0,:]
-        foil_actives_vl_embeds = self.base_model.text_encoder.bert(encoder_embeds=foil_actives_embeds,
-                                                    attention_mask=foil_actives.attention_mask,
-                                                    encoder_hidden_states=image_embeds,
-                                                    encoder_attention_mask=image_atts,
-                                                    return_dict=True,
-                                                    mode='fusion',
-                                                    ).last_hidden_state[:,0,:]
-        true_passives_vl_embeds = self.base_model.text_encoder.bert(encoder_embeds=true_passives_embeds,
-                                            attention_mask=true_passives.attention_mask,
-                                            encoder_hidden_states=image_embeds,
-                                            encoder_attention_mask=image_atts,
-                                            return_dict=True,
-                                            mode='fusion',
-                                            ).last_hidden_state[:,0,:]
-        
+        num_candidates = len(candidate_texts)
+        with candidate_image_inputs(self.base_model.text_encoder, image_embeds, image_atts, num_candidates,
+                                    self.cache_cross_attention) as (cross_image_embeds, cross_image_atts):
+            vl_embeds = self.base_model.text_encoder.bert(encoder_embeds=text_embeds,
+                                                attention_mask=attention_mask,
+                                                encoder_hidden_states=cross_image_embeds,
+                                                encoder_attention_mask=cross_image_atts,
+                                                return_dict=True,
+                                                mode='fusion',
+                                                ).last_hidden_state[:,0,:]
+        return (text_embeds[:,0,:].view(num_candidates, images.size(0), -1),
+                vl_embeds.view(num_candidates, images.size(0), -1))
+
+    def forward(self, images, true_actives, foil_actives, true_passives, image_keys=None):
+        text_embeds, vl_embeds = self.encode(images, [true_actives, foil_actives, true_passives], image_keys)
         #return the three textual embeddings and the three multimodal embeddings
-        return true_actives_embeds[:,0,:], foil_actives_embeds[:,0,:], true_passives_embeds[:,0,:], true_actives_vl_embeds, foil_actives_vl_embeds, true_passives_vl_embeds
\ No newline at end of file
+        return text_embeds[0], text_embeds[1], text_embeds[2], vl_embeds[0], vl_embeds[1], vl_embeds[2]
@@ -2,45 +2,41 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
+from models.AdaptedModels.adapter_utils import stack_candidates, candidate_image_inputs
+from models.AdaptedModels.vision_store import vision_store
+
 
 class BLIPForITM(nn.Module):
-    def __init__(self, base_model):
+    def __init__(self, base_model, cache_cross_attention=False):
         super().__init__()
         self.base_model = base_model
-
-
-    def forward(self, images, captions, foils):
-        image_embeds = self.base_model.visual_encoder(images)
+        self.cache_cross_attention = cache_cross_attention
+
+    """ ITM probabilities of K candidate texts for each image, as a tensor of shape (K, B, 2).
+        The candidates are stacked along the batch dimension, so the image-grounded text encoder runs once.
+        With image_keys, the vision embeddings are taken from (and added to) the shared vision store. """
+    def score(self, images, candidate_texts, image_keys=None):
+        image_embeds = vision_store.encode(self.base_model.visual_encoder, images, image_keys,
+                                           vision_store.model_key('BLIP', self.base_model))
         image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long)
 
-        c_encoder_input_ids = captions.input_ids.clone()
-        #c_encoder_input_ids[:, 0] = self.base_model.tokenizer.enc_token_id
-
-        f_encoder_input_ids = foils.input_ids.clone()
-        #f_encoder_input_ids[:, 0] = self.base_model.tokenizer.enc_token_id
-
-        c_encoder_input_ids = torch.squeeze(c_encoder_input_ids, dim=0)
-        f_encoder_input_ids = torch.squeeze(f_encoder_input_ids, dim=0)
-
-        captions_output_pos = self.base_model.text_encoder(c_encoder_input_ids,
-                                       attention_mask=captions.attention_mask,
-                                       encoder_hidden_states=image_embeds,
-                                       encoder_attention_mask=image_atts,
-                                       return_dict=True,
-                                       )
-
-        foils_output_pos = self.base_model.text_encoder(f_encoder_input_ids,
-                                                attention_mask=foils.attention_mask,
-                                                encoder_hidden_states=image_embeds,
-                                                encoder_attention_mask=image_atts,
-                                                return_dict=True,
-                                                )
-
-        captions_vl_embeddings = captions_output_pos.last_hidden_state[:, 0, :]
-        captions_vl_output = self.base_model.itm_head(captions_vl_embeddings)
-
-        foils_vl_embeddings = foils_output_pos.last_hidden_state[:, 0, :]
-        foils_vl_output = self.base_model.itm_head(foils_vl_embeddings)
-
-        prob_scores = [F.softmax(captions_vl_output), F.softmax(foils_vl_output)]
-        return prob_scores
+        encoder_input_ids, attention_mask = stack_candidates(candidate_texts)
+        #encoder_input_ids[:, 0] = self.base_model.tokenizer.enc_token_id
+
+        num_candidates = len(candidate_texts)
+        with candidate_image_inputs(self.base_model.text_encoder, image_embeds, image_atts, num_candidates,
+                                    self.cache_cross_attention) as (cross_image_embeds, cross_image_atts):
+            output_pos = self.base_model.text_encoder(encoder_input_ids,
+                                           attention_mask=attention_mask,
+                                           encoder_hidden_states=cross_image_embeds,
+                                           encoder_attention_mask=cross_image_atts,
+                                           return_dict=True,
+                                           )
+
+        vl_embeddings = output_pos.last_hidden_state[:, 0, :]
+        vl_output = self.base_model.itm_head(vl_embeddings)
+        return F.softmax(vl_output, dim=1).view(num_candidates, images.size(0), -1)
+
+    def forward(self, images, captions, foils, image_keys=None):
+        prob_scores = self.score(images, [captions, foils], image_keys)
+        return [prob_scores[0], prob_scores[1]]
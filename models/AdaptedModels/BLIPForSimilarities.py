@@ -2,52 +2,39 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
+from models.AdaptedModels.adapter_utils import stack_candidates, candidate_image_inputs
+from models.AdaptedModels.vision_store import vision_store
+
 
 class BLIPForSimilarities(nn.Module):
-    def __init__(self, base_model):
+    def __init__(self, base_model, cache_cross_attention=False):
         super().__init__()
         self.base_model = base_model
+        self.cache_cross_attention = cache_cross_attention
+
+    """ Multimodal [CLS] embeddings of K candidate texts for each image, of shape (K, B, D).
+        The candidates are stacked along the batch dimension, so the image-grounded text encoder runs once.
+        With image_keys, the vision embeddings are taken from (and added to) the shared vision store. """
+    def encode(self, images, candidate_texts, image_keys=None):
+        image_embeds = vision_store.encode(self.base_model.visual_encoder, images, image_keys,
+                                           vision_store.model_key('BLIP', self.base_model))
+        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long)
 
+        encoder_input_ids, attention_mask = stack_candidates(candidate_texts)
+        #encoder_input_ids[:, 0] = self.base_model.tokenizer.enc_token_id
 
-    def forward(self, images, true_actives, foil_actives, true_passives):
-        image_embeds = self.base_model.visual_encoder(images)
-        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long)
+        num_candidates = len(candidate_texts)
+        with candidate_image_inputs(self.base_model.text_encoder, image_embeds, image_atts, num_candidates,
+                                    self.cache_cross_attention) as (cross_image_embeds, cross_image_atts):
+            output_pos = self.base_model.text_encoder(encoder_input_ids,
+                                           attention_mask=attention_mask,
+                                           encoder_hidden_states=cross_image_embeds,
+                                           encoder_attention_mask=cross_image_atts,
+                                           return_dict=True,
+                                           )
+
+        return output_pos.last_hidden_state[:, 0, :].view(num_candidates, images.size(0), -1)
 
-        ta_encoder_input_ids = true_actives.input_ids.clone()
-        #c_encoder_input_ids[:, 0] = self.base_model.tokenizer.enc_token_id
-
-        fa_encoder_input_ids = foil_actives.input_ids.clone()
-        #f_encoder_input_ids[:, 0] = self.base_model.tokenizer.enc_token_id
-
-        tp_encoder_input_ids = true_passives.input_ids.clone()
-        #f_encoder_input_ids[:, 0] = self.base_model.tokenizer.enc_token_id
-
-        ta_encoder_input_ids = torch.squeeze(ta_encoder_input_ids, dim=0)
-        fa_encoder_input_ids = torch.squeeze(fa_encoder_input_ids, dim=0)
-        tp_encoder_input_ids = torch.squeeze(tp_encoder_input_ids, dim=0)
-
-        ta_output_pos = self.base_model.text_encoder(ta_encoder_input_ids,
-                                       attention_mask=true_actives.attention_mask,
-                                       encoder_hidden_states=image_embeds,
-                                       encoder_attention_mask=image_atts,
-                                       return_dict=True,
-                                       )
-
-        fa_output_pos = self.base_model.text_encoder(fa_encoder_input_ids,
-                                                attention_mask=foil_actives.attention_mask,
-                                                encoder_hidden_states=image_embeds,
-                                                encoder_attention_mask=image_atts,
-                                                return_dict=True,
-                                                )
-        
-        tp_output_pos = self.base_model.text_encoder(tp_encoder_input_ids,
-                                       attention_mask=true_passives.attention_mask,
-                                       encoder_hidden_states=image_embeds,
-                                       encoder_attention_mask=image_atts,
-                                       return_dict=True,
-                                       )
-
-        ta_vl_embeddings = ta_output_pos.last_hidden_state[:, 0, :]
-        fa_vl_embeddings = fa_output_pos.last_hidden_state[:, 0, :]
-        tp_vl_embeddings = tp_output_pos.last_hidden_state[:, 0, :]
-        return ta_vl_embeddings,  fa_vl_embeddings, tp_vl_embeddings
+    def forward(self, images, true_actives, foil_actives, true_passives, image_keys=None):
+        vl_embeddings = self.encode(images, [true_actives, foil_actives, true_passives], image_keys)
+        return vl_embeddings[0], vl_embeddings[1], vl_embeddings[2]
@@ -2,28 +2,36 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
+from models.AdaptedModels.adapter_utils import stack_candidates, candidate_image_inputs
+from models.AdaptedModels.vision_store import vision_store
+
 
 class X2VLMForITM(nn.Module):
-    def __init__(self, base_model):
+    def __init__(self, base_model, cache_cross_attention=False):
         super().__init__()
         self.base_model = base_model
+        self.cache_cross_attention = cache_cross_attention
 
+    """ ITM probabilities of K candidate texts for each image, as a tensor of shape (K, B, 2).
+        The candidates are stacked along the batch dimension, so the text and the cross encoders run once.
+        With image_keys, the vision embeddings are taken from (and added to) the shared vision store. """
+    def score(self, images, candidate_texts, image_keys=None):
+        image_embeds = vision_store.encode(lambda x: self.base_model.get_vision_embeds(x)[0], images, image_keys,
+                                           vision_store.model_key('X2VLM', self.base_model))
+        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(images.device)
+        input_ids, attention_mask = stack_candidates(candidate_texts)
+        text_embeds = self.base_model.get_text_embeds(input_ids, attention_mask)
 
-    def forward(self, images, captions, foils):
-        image_embeds, image_atts = self.base_model.get_vision_embeds(images)
-        captions.input_ids = torch.squeeze(captions.input_ids, dim=0)
-        foils.input_ids = torch.squeeze(foils.input_ids, dim=0)
-        caption_embeds = self.base_model.get_text_embeds(captions.input_ids, captions.attention_mask)
-        foil_embeds = self.base_model.get_text_embeds(foils.input_ids, foils.attention_mask)
+        num_candidates = len(candidate_texts)
+        with candidate_image_inputs(self.base_model.text_encoder, image_embeds, image_atts, num_candidates,
+                                    self.cache_cross_attention) as (cross_image_embeds, cross_image_atts):
+            cross_embeds = self.base_model.get_cross_embeds(cross_image_embeds, cross_image_atts,
+                                                            text_embeds=text_embeds, text_atts=attention_mask)[:, 0, :]
+        vl_output = self.base_model.itm_head(cross_embeds)
+        return F.softmax(vl_output, dim=1).view(num_candidates, images.size(0), -1)
 
-        cross_captions = self.base_model.get_cross_embeds(image_embeds, image_atts, text_embeds=caption_embeds, text_atts=captions.attention_mask)[:, 0,
-                    :]
-        cross_foils = self.base_model.get_cross_embeds(image_embeds, image_atts, text_embeds=foil_embeds,
-                                               text_atts=foils.attention_mask)[:, 0,
-                         :]
-        captions_vl_output = self.base_model.itm_head(cross_captions)
-        foils_vl_output = self.base_model.itm_head(cross_foils)
+    def forward(self, images, captions, foils, image_keys=None):
         """ Each ITM head returns the probability for the caption to match the image.
         We only take the probability for the image to match the caption """
-        prob_scores = [F.softmax(captions_vl_output, dim=1),F.softmax(foils_vl_output, dim=1)]
-        return prob_scores
+        prob_scores = self.score(images, [captions, foils], image_keys)
+        return [prob_scores[0], prob_scores[1]]
@@ -2,30 +2,34 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
+from models.AdaptedModels.adapter_utils import stack_candidates, candidate_image_inputs
+from models.AdaptedModels.vision_store import vision_store
+
 
 class XVLMForSimilarities(nn.Module):
-    def __init__(self, base_model):
+    def __init__(self, base_model, cache_cross_attention=False):
         super().__init__()
         self.base_model = base_model
+        self.cache_cross_attention = cache_cross_attention
 
+    """ Textual and multimodal [CLS] embeddings of K candidate texts for each image, both of shape (K, B, D).
+        The candidates are stacked along the batch dimension, so the text and the cross encoders run once.
+        With image_keys, the vision embeddings are taken from (and added to) the shared vision store. """
+    def encode(self, images, candidate_texts, image_keys=None):
+        image_embeds = vision_store.encode(lambda x: self.base_model.get_vision_embeds(x)[0], images, image_keys,
+                                           vision_store.model_key('XVLM', self.base_model))
+        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(images.device)
+        input_ids, attention_mask = stack_candidates(candidate_texts)
+        text_embeds = self.base_model.get_text_embeds(input_ids, attention_mask)
 
-    def forward(self, images, true_actives, foil_actives, true_passives):
-        image_embeds, image_atts = self.base_model.get_vision_embeds(images)
-
-        true_actives.input_ids = torch.squeeze(true_actives.input_ids, dim=0)
-        foil_actives.input_ids = torch.squeeze(foil_actives.input_ids, dim=0)
-        true_passives.input_ids = torch.squeeze(true_passives.input_ids, dim=0)
-
-        true_actives_embeds = self.base_model.get_text_embeds(true_actives.input_ids, true_actives.attention_mask)
-        foil_actives_embeds = self.base_model.get_text_embeds(foil_actives.input_ids, foil_actives.attention_mask)
-        true_passives_embeds = self.base_model.get_text_embeds(true_passives.input_ids, true_passives.attention_mask)
+        num_candidates = len(candidate_texts)
+        with candidate_image_inputs(self.base_model.text_encoder, image_embeds, image_atts, num_candidates,
+                                    self.cache_cross_attention) as (cross_image_embeds, cross_image_atts):
+            cross_embeds = self.base_model.get_cross_embeds(cross_image_embeds, cross_image_atts,
+                                                            text_embeds=text_embeds, text_atts=attention_mask)[:, 0, :]
+        return (text_embeds[:, 0, :].view(num_candidates, images.size(0), -1),
+                cross_embeds.view(num_candidates, images.size(0), -1))
 
-        cross_true_actives = self.base_model.get_cross_embeds(image_embeds, image_atts, text_embeds=true_actives_embeds,
-                                                              text_atts=true_actives.attention_mask)[:, 0,:]
-        
-        cross_foil_actives = self.base_model.get_cross_embeds(image_embeds, image_atts, text_embeds=foil_actives_embeds,
-                                               text_atts=foil_actives.attention_mask)[:, 0, :]
-        cross_true_passives = self.base_model.get_cross_embeds(image_embeds, image_atts, text_embeds=true_passives_embeds,
-                                                              text_atts=true_passives.attention_mask)[:, 0,:]
-        
-        return true_actives_embeds[:,0,:], foil_actives_embeds[:,0,:], true_passives_embeds[:,0,:], cross_true_actives, cross_foil_actives, cross_true_passives
+    def forward(self, images, true_actives, foil_actives, true_passives, image_keys=None):
+        text_embeds, cross_embeds = self.encode(images, [true_actives, foil_actives, true_passives], image_keys)
+        return text_embeds[0], text_embeds[1], text_embeds[2], cross_embeds[0], cross_embeds[1], cross_embeds[2]
@@ -0,0 +1,43 @@
+from contextlib import contextmanager
+
+import torch
+import torch.nn.functional as F
+
+
+""" Stack K batches of candidate texts (each with input_ids/attention_mask of shape (B, L_k)) into a single batch of
+    K*B texts padded to the longest one. The order is candidate-major: row k*B + b is the k-th candidate of sample b. """
+def stack_candidates(candidate_texts):
+    max_len = max(texts.input_ids.size(1) for texts in candidate_texts)
+    input_ids = torch.cat([F.pad(texts.input_ids, (0, max_len - texts.input_ids.size(1))) for texts in candidate_texts])
+    attention_mask = torch.cat([F.pad(texts.attention_mask, (0, max_len - texts.attention_mask.size(1))) for texts in candidate_texts])
+    return input_ids, attention_mask
+
+""" Repeat the per-image tensors (embeddings or attention masks) for the K candidates, in the same candidate-major
+    order as stack_candidates. The reshape into the batch dimension copies them K times: this is only the fallback of
+    candidate_image_inputs for the encoders whose cross-attention cannot broadcast the images over the candidates. """
+def expand_for_candidates(image_tensor, num_candidates):
+    return image_tensor.unsqueeze(0).expand(num_candidates, *image_tensor.shape).reshape(-1, *image_tensor.shape[1:])
+
+""" Image inputs of the cross-attention for K candidate texts per image. The cross-attention layers of the BERT
+    encoders broadcast (B, ...) image states over the K*B candidate texts (see num_candidates in BertSelfAttention),
+    so the un-repeated (image_embeds, image_atts) are yielded, without copying them. With use_cache, the keys and
+    values of the image embeddings are also projected once per layer instead of once per forward, the caches being
+    cleared when the block exits. Only for the encoders without such layers are the inputs repeated for the
+    candidates. """
+@contextmanager
+def candidate_image_inputs(encoder, image_embeds, image_atts, num_candidates, use_cache=False):
+    layers = [module for module in encoder.modules()
+              if getattr(module, 'is_cross_attention', False) and hasattr(module, 'cache_cross_key_value')]
+    if(not layers):
+        yield expand_for_candidates(image_embeds, num_candidates), expand_for_candidates(image_atts, num_candidates)
+        return
+    if(not use_cache):
+        yield image_embeds, image_atts
+        return
+    for layer in layers:
+        layer.cache_cross_key_value(image_embeds)
+    try:
+        yield image_embeds, image_atts
+    finally:
+        for layer in layers:
+            layer.cache_cross_key_value(None)
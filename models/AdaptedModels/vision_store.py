@@ -0,0 +1,150 @@
+import os
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+""" Fingerprint of the code of a model: the size and modification time of the source files of all its module classes,
+    so that the embeddings computed before a change of the encoder code are not reused. A model that is not itself a
+    torch module (the NegCLIP wrapper) is covered through the modules it holds. """
+def code_fingerprint(model):
+    modules = [model] if isinstance(model, torch.nn.Module) else [value for value in vars(model).values() if isinstance(value, torch.nn.Module)]
+    files = set()
+    for module in modules:
+        for submodule in module.modules():
+            source = getattr(sys.modules.get(type(submodule).__module__), '__file__', None)
+            if(source is not None):
+                files.add(source)
+    stats = sorted((os.path.basename(source), os.stat(source).st_size, os.stat(source).st_mtime_ns) for source in files)
+    return hashlib.sha1(repr(stats).encode()).hexdigest()[:16]
+
+""" Store of vision-encoder outputs keyed by (model name, weights fingerprint, code fingerprint, image key, image
+    resolution), so that each unique image is encoded once per model, even when it is shared by several samples, splits
+    or experiments. The image key includes the fingerprint of the images and of their preprocessing (see
+    ImageSamplesDataset._image_key), so no key outlives a change of the weights, the encoder code or the images.
+    Entries are held in memory up to max_mb, least recently used first out. With a spill_dir, the evicted entries are
+    written to one .npy file each, which lets later runs reuse them; a spilled entry is read back into memory on its
+    first hit. The spill directory is kept under spill_max_mb (None for no bound) by deleting its least recently used
+    files. The entries are guarded by a lock, so models scoring batches in parallel threads share the store. """
+class VisionEmbeddingStore:
+    def __init__(self, max_mb=2048, spill_dir=None, spill_max_mb=None):
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.spill_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self.configure(max_mb, spill_dir, spill_max_mb)
+
+    def configure(self, max_mb, spill_dir=None, spill_max_mb=None):
+        with self.lock:
+            self.max_bytes = max_mb * 2**20
+            self.spill_dir = spill_dir
+            self.spill_max_bytes = None if spill_max_mb is None else spill_max_mb * 2**20
+            self.spill_bytes = 0
+            if(self.spill_dir is not None):
+                os.makedirs(self.spill_dir, exist_ok=True)
+                self.spill_bytes = sum(entry.stat().st_size for entry in os.scandir(self.spill_dir) if entry.name.endswith('.npy'))
+                self._trim_spill_dir()
+            self._evict()
+
+    """ Key of a model in the store, or None if its weights have no fingerprint (its embeddings are then not reused) """
+    def model_key(self, model_name, model):
+        fingerprint = getattr(model, 'weights_fingerprint', None)
+        if(fingerprint is None):
+            return None
+        if(getattr(model, 'code_fingerprint', None) is None):
+            model.code_fingerprint = code_fingerprint(model)
+        return (model_name, fingerprint, model.code_fingerprint)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key).encode()).hexdigest()[:24] + '.npy')
+
+    """ Delete the least recently used spilled files (by modification time, refreshed on each hit) until the spill
+        directory is under its bound """
+    def _trim_spill_dir(self):
+        if(self.spill_max_bytes is None or self.spill_bytes <= self.spill_max_bytes):
+            return
+        spilled = sorted((entry for entry in os.scandir(self.spill_dir) if entry.name.endswith('.npy')), key=lambda entry: entry.stat().st_mtime_ns)
+        for entry in spilled:
+            if(self.spill_bytes <= self.spill_max_bytes):
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self.spill_bytes -= size
+
+    def _evict(self):
+        while(self.num_bytes > self.max_bytes and self.entries):
+            key, embeds = self.entries.popitem(last=False)
+            self.num_bytes -= embeds.element_size() * embeds.nelement()
+            if(self.spill_dir is not None and not os.path.exists(self._spill_path(key))):
+                tmp_path = self._spill_path(key) + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, embeds.numpy())
+                os.replace(tmp_path, self._spill_path(key))
+                self.spill_bytes += os.path.getsize(self._spill_path(key))
+                self._trim_spill_dir()
+
+    def get(self, key):
+        with self.lock:
+            if(key in self.entries):
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            if(self.spill_dir is not None and os.path.exists(self._spill_path(key))):
+                # read once and re-admitted, the later hits are served from memory; the file stays as the spilled copy
+                embeds = torch.from_numpy(np.load(self._spill_path(key)))
+                os.utime(self._spill_path(key))
+                self.entries[key] = embeds
+                self.num_bytes += embeds.element_size() * embeds.nelement()
+                self._evict()
+                return embeds
+        return None
+
+    def put(self, key, embeds):
+        embeds = embeds.detach().cpu().clone()  # a copy, so the row does not keep the whole batch alive
+        with self.lock:
+            if(key in self.entries):
+                self.num_bytes -= self.entries[key].element_size() * self.entries[key].nelement()
+            self.entries[key] = embeds
+            self.num_bytes += embeds.element_size() * embeds.nelement()
+            self._evict()
+
+    """ Vision embeddings of a batch of images: the images whose key is not in the store (each unique one once) are
+        encoded together with encoder, the others are taken from the store. Without image_keys or a model_key the
+        batch is just encoded. """
+    def encode(self, encoder, images, image_keys=None, model_key=None):
+        if(image_keys is None or model_key is None):
+            return encoder(images)
+        keys = [model_key + (image_key, tuple(images.shape[-2:])) for image_key in image_keys]
+        embeds = [self.get(key) for key in keys]
+        missing = OrderedDict()
+        for i, key in enumerate(keys):
+            if(embeds[i] is None and key not in missing):
+                missing[key] = i
+        new_embeds = {}
+        if(missing):
+            for key, embed in zip(missing, encoder(images[list(missing.values())])):
+                self.put(key, embed)
+                new_embeds[key] = embed
+        with self.lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        return torch.stack([(embed if embed is not None else new_embeds[key]).to(images.device)
+                            for key, embed in zip(keys, embeds)])
+
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests > 0 else 0.
+
+    def report(self):
+        return (f"{self.hits} hits, {self.misses} misses (hit rate {self.hit_rate():.1%}), "
+                f"{len(self.entries)} embeddings / {self.num_bytes / 2**20:.1f} MB held in memory")
+
+vision_store = VisionEmbeddingStore()  # shared by all the adapters of a run, so each image is encoded once per model
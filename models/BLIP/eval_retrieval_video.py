@@ -23,6 +23,7 @@ import torch.distributed as dist
 from torch.utils.data import DataLoader
 
 from models.blip_retrieval import blip_retrieval
+from models.med import cross_attention_kv_cache
 import utils
 from data.video_dataset import VideoDataset
 
@@ -89,14 +90,16 @@ def evaluation(model, data_loader, tokenizer, device, config):
     for i,sims in enumerate(metric_logger.log_every(sims_matrix[start:end], 50, header)): 
         topk_sim, topk_idx = sims.topk(k=config['k_test'], dim=0)
         
-        encoder_output = video_feats[start+i].repeat(config['k_test'],1,1).to(device,non_blocking=True) 
+        # the video keys/values are projected once and shared by its k_test candidate texts
+        encoder_output = video_feats[start+i].unsqueeze(0).to(device,non_blocking=True) 
         encoder_att = torch.ones(encoder_output.size()[:-1],dtype=torch.long).to(device,non_blocking=True) 
-        output = model.text_encoder(text_ids[topk_idx], 
-                                    attention_mask = text_atts[topk_idx],
-                                    encoder_hidden_states = encoder_output,
-                                    encoder_attention_mask = encoder_att,                             
-                                    return_dict = True,
-                                   )
+        with cross_attention_kv_cache(model.text_encoder, encoder_output):
+            output = model.text_encoder(text_ids[topk_idx], 
+                                        attention_mask = text_atts[topk_idx],
+                                        encoder_hidden_states = encoder_output,
+                                        encoder_attention_mask = encoder_att,                             
+                                        return_dict = True,
+                                       )
         score = model.itm_head(output.last_hidden_state[:,0,:])[:,1]
         score_matrix_v2t[start+i,topk_idx] = score + topk_sim
         
@@ -26,18 +26,25 @@ class BLIP_Pretrain(nn.Module):
                  embed_dim = 256,     
                  queue_size = 57600,
                  momentum = 0.995,
+                 inference = False,
                  ):
         """
         Args:
             med_config (str): path for the mixture of encoder-decoder model's configuration file
             image_size (int): input image size
             vit (str): model size of vision transformer
+            inference (bool): build only the modules used to score image-text pairs (no momentum encoders, queues
+                and text decoder), without initializing them from DeiT and BERT, as all their weights come from the
+                checkpoint loaded next
         """               
         super().__init__()
         
+        self.inference = inference
         self.visual_encoder, vision_width = create_vit(vit,image_size, vit_grad_ckpt, vit_ckpt_layer, 0)
         
-        if vit=='base':
+        if inference:
+            pass
+        elif vit=='base':
             checkpoint = torch.hub.load_state_dict_from_url(
                 url="https://dl.fbaipublicfiles.com/deit/deit_base_patch16_224-b5f2ef4d.pth",
                 map_location="cpu", check_hash=True)
@@ -54,7 +61,10 @@ class BLIP_Pretrain(nn.Module):
         self.tokenizer = init_tokenizer()   
         encoder_config = BertConfig.from_json_file(med_config)
         encoder_config.encoder_width = vision_width
-        self.text_encoder = BertModel.from_pretrained('bert-base-uncased',config=encoder_config, add_pooling_layer=False)
+        if inference:
+            self.text_encoder = BertModel(config=encoder_config, add_pooling_layer=False)
+        else:
+            self.text_encoder = BertModel.from_pretrained('bert-base-uncased',config=encoder_config, add_pooling_layer=False)
         self.text_encoder.resize_token_embeddings(len(self.tokenizer)) 
 
         text_width = self.text_encoder.config.hidden_size
@@ -64,6 +74,10 @@ class BLIP_Pretrain(nn.Module):
 
         self.itm_head = nn.Linear(text_width, 2) 
         
+        if inference:
+            self.temp = nn.Parameter(0.07*torch.ones([]))
+            return
+
         # create momentum encoders  
         self.visual_encoder_m, vision_width = create_vit(vit,image_size)              
         self.vision_proj_m = nn.Linear(vision_width, embed_dim)
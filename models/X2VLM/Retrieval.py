@@ -20,6 +20,7 @@ import torch.distributed as dist
 import utils
 from utils.checkpointer import Checkpointer
 from utils.hdfs_io import hmkdir
+from models.xbert import cross_attention_kv_cache
 
 from dataset import create_dataset, create_sampler, create_loader, build_tokenizer
 from scheduler import create_scheduler
@@ -126,11 +127,17 @@ def evaluation(model, data_loader, tokenizer, device, config):
     for i, sims in enumerate(metric_logger.log_every(sims_matrix[start:end], 50, header)):
         topk_sim, topk_idx = sims.topk(k=config['k_test'], dim=0)
 
-        encoder_output = image_feats[start + i].repeat(config['k_test'], 1, 1)
+        # the image keys/values are projected once and shared by its k_test candidate texts
+        # (a RoBERTa cross encoder has no cache, so the image is repeated there as before)
+        encoder_output = image_feats[start + i].unsqueeze(0)
         encoder_att = torch.ones(encoder_output.size()[:-1], dtype=torch.long).to(device)
 
-        output = model.get_cross_embeds(image_embeds=encoder_output, image_atts=encoder_att,
-                                        text_embeds=text_feats[topk_idx], text_atts=text_atts[topk_idx])
+        with cross_attention_kv_cache(getattr(model, 'cross_encoder', model.text_encoder), encoder_output) as cached:
+            if not cached:
+                encoder_output = encoder_output.repeat(config['k_test'], 1, 1)
+                encoder_att = encoder_att.repeat(config['k_test'], 1)
+            output = model.get_cross_embeds(image_embeds=encoder_output, image_atts=encoder_att,
+                                            text_embeds=text_feats[topk_idx], text_atts=text_atts[topk_idx])
 
         score = model.itm_head(output[:, 0, :])[:, 1]
 
@@ -68,6 +68,18 @@ class Mlp(nn.Module):
         return x
 
 
+def cache_relative_position_bias(module):
+    """In eval mode, the relative position bias gathered from the table is kept in a non-persistent buffer (the window
+    size, hence the resolution, is fixed at construction) and dropped when new weights are loaded."""
+    module.cache_bias = True
+    module.register_buffer("cached_relative_position_bias", None, persistent=False)
+    module.register_load_state_dict_post_hook(clear_relative_position_bias)
+
+
+def clear_relative_position_bias(module, incompatible_keys=None):
+    module.cached_relative_position_bias = None
+
+
 class Attention(nn.Module):
     def __init__(
             self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0.,
@@ -121,6 +133,24 @@ class Attention(nn.Module):
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(all_head_dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
+        self.use_sdpa = True  # see forward
+        cache_relative_position_bias(self)
+
+    def get_relative_position_bias(self):
+        if self.cache_bias and not self.training and self.cached_relative_position_bias is not None:
+            return self.cached_relative_position_bias
+        relative_position_bias = \
+            self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+                self.window_size[0] * self.window_size[1] + 1,
+                self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
+        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        if self.cache_bias and not self.training:
+            self.cached_relative_position_bias = relative_position_bias.detach()
+        return relative_position_bias
+
+    def train(self, mode=True):
+        self.cached_relative_position_bias = None  # the bias table changes while training
+        return super().train(mode)
 
     def forward(self, x, rel_pos_bias=None, return_attention=False, return_qkv=False, image_atts=None, output_attentions=None):
         B, N, C = x.shape
@@ -132,16 +162,26 @@ class Attention(nn.Module):
         qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple) (B, H, N, C)
 
+        if self.use_sdpa and not return_attention and not output_attentions:
+            # fused attention, the relative position biases and the image mask being added as one additive mask
+            attn_bias = None
+            if self.relative_position_bias_table is not None:
+                attn_bias = self.get_relative_position_bias().unsqueeze(0)
+            for bias in (rel_pos_bias, image_atts):
+                if bias is not None:
+                    attn_bias = bias if attn_bias is None else attn_bias + bias
+            if attn_bias is not None:
+                attn_bias = attn_bias.to(q.dtype)
+            x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias,
+                                               dropout_p=self.attn_drop.p if self.training else 0., scale=self.scale)
+            x = self.proj_drop(self.proj(x.transpose(1, 2).reshape(B, N, -1)))
+            return (x, qkv) if return_qkv else (x, None)
+
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
 
         if self.relative_position_bias_table is not None:
-            relative_position_bias = \
-                self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-                    self.window_size[0] * self.window_size[1] + 1,
-                    self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
-            relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-            attn = attn + relative_position_bias.unsqueeze(0)
+            attn = attn + self.get_relative_position_bias().unsqueeze(0)
 
         if rel_pos_bias is not None:
             attn = attn + rel_pos_bias
@@ -260,15 +300,25 @@ class RelativePositionBias(nn.Module):
         relative_position_index[0, 0] = self.num_relative_distance - 1
 
         self.register_buffer("relative_position_index", relative_position_index)
+        cache_relative_position_bias(self)
 
         # trunc_normal_(self.relative_position_bias_table, std=.02)
 
     def forward(self):
+        if self.cache_bias and not self.training and self.cached_relative_position_bias is not None:
+            return self.cached_relative_position_bias
         relative_position_bias = \
             self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
                 self.window_size[0] * self.window_size[1] + 1,
                 self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
-        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        if self.cache_bias and not self.training:
+            self.cached_relative_position_bias = relative_position_bias.detach()
+        return relative_position_bias
+
+    def train(self, mode=True):
+        self.cached_relative_position_bias = None  # the bias table changes while training
+        return super().train(mode)
 
 
 class VisionTransformer(nn.Module):
@@ -92,6 +92,7 @@ class CLIPAttention(nn.Module):
         self.v_proj = nn.Linear(self.embed_dim, self.embed_dim)
         self.q_proj = nn.Linear(self.embed_dim, self.embed_dim)
         self.out_proj = nn.Linear(self.embed_dim, self.embed_dim)
+        self.use_sdpa = True  # fused attention when the attention weights are not returned
 
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return tensor.view(bsz, seq_len, self.num_heads, self.head_dim).transpose(1, 2).contiguous()
@@ -107,6 +108,18 @@ class CLIPAttention(nn.Module):
 
         bsz, tgt_len, embed_dim = hidden_states.size()
 
+        if self.use_sdpa and not output_attentions:
+            attn_mask = None
+            for mask in (causal_attention_mask, attention_mask):  # both (bsz, 1, tgt_len, src_len), additive
+                if mask is not None:
+                    attn_mask = mask if attn_mask is None else attn_mask + mask
+            attn_output = nn.functional.scaled_dot_product_attention(
+                self._shape(self.q_proj(hidden_states), tgt_len, bsz), self._shape(self.k_proj(hidden_states), -1, bsz),
+                self._shape(self.v_proj(hidden_states), -1, bsz), attn_mask=attn_mask,
+                dropout_p=self.dropout if self.training else 0.0, scale=self.scale)
+            attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, embed_dim)
+            return self.out_proj(attn_output), None
+
         # get query proj
         query_states = self.q_proj(hidden_states) * self.scale
         key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
@@ -22,10 +22,18 @@ from models.X2VLM.models.xvlm import XVLMBase, XVLMPlusBase, VanillaConfig
 
 
 class XVLM(XVLMBase):
-    def __init__(self, config, load_vision_params=True, load_text_params=True, pretraining=True):
-        super().__init__(config, load_vision_params=load_vision_params, load_text_params=load_text_params,
-                         use_contrastive_loss=True, use_matching_loss=True, use_mlm_loss=True, use_bbox_loss=True,
-                         config_text=None, pretraining=pretraining)
+    def __init__(self, config, load_vision_params=True, load_text_params=True, pretraining=True, inference=False):
+        """
+        inference (bool): build only the modules used to score image-text pairs (no bbox head), without initializing
+            the encoders from their pretrained weights, as all the weights come from the checkpoint loaded next.
+            The text encoder keeps its MLM wrapper: the bare BertModel of xvlm.py is the transformers one, which has
+            no fusion mode.
+        """
+        super().__init__(config, load_vision_params=load_vision_params and not inference,
+                         load_text_params=load_text_params and not inference,
+                         use_contrastive_loss=True, use_matching_loss=True, use_mlm_loss=True,
+                         use_bbox_loss=not inference, config_text=None, pretraining=pretraining)
+        self.inference = inference
 
     def forward_multimodal(self, image, text_ids, text_atts, text_ids_masked=None, masked_pos=None, masked_ids=None,
                 image_atts=None, idx_to_group_img=None, target_bbox=None, is_image=None,
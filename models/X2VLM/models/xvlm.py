@@ -581,9 +581,29 @@ class XVLMBase(nn.Module):
             if n not in named_parameters:
                 self.init_params.remove(n)
 
+    def check_inference_keys(self, missing_keys):
+        """The models built for inference may be built without initialization (see skip_init), so a parameter not in
+        the checkpoint would be left as raw memory: they load their parameters strictly, as load_weights does for the
+        other models. The buffers missing from it are computed at construction."""
+        parameters = dict(self.named_parameters())
+        missing_parameters = [k for k in missing_keys if k in parameters]
+        if missing_parameters:
+            raise RuntimeError(f"{len(missing_parameters)} parameters of the model built for inference are not in the "
+                               f"checkpoint: {missing_parameters}")
+
     def load_pretrained(self, ckpt_rpath, config, is_eval=False, is_domain_pretrain=False):
         print('load checkpoint from %s' % ckpt_rpath)
-        if is_domain_pretrain:
+        from utils.utils import converted_weights_path, load_safetensors
+        converted = is_eval and not is_domain_pretrain and os.path.exists(converted_weights_path(ckpt_rpath))
+        if converted:  # see experiments/convert_weights.py
+            # only the entries processed below are read here, load_safetensors loads the others one module at a time
+            state_dict = {}
+            if hasattr(self, 'absolute_frame_pos_embed'):
+                from safetensors import safe_open
+                with safe_open(converted_weights_path(ckpt_rpath), framework='pt', device='cpu') as file:
+                    if 'absolute_frame_pos_embed' in file.keys():
+                        state_dict['absolute_frame_pos_embed'] = file.get_tensor('absolute_frame_pos_embed')
+        elif is_domain_pretrain:
             checkpoint = torch.load(ckpt_rpath, map_location='cpu')
             state_dict = checkpoint['model'] if 'model' in checkpoint.keys() else checkpoint
         
@@ -603,6 +623,11 @@ class XVLMBase(nn.Module):
         else:
             state_dict = load_pretrained(self, ckpt_rpath, config, is_eval=is_eval, load_text=True)
 
+        if getattr(self, 'inference', False) and not converted:  # only the entries of the modules built, see XVLM(inference=True)
+            from utils.utils import inference_state_dict
+            state_dict = inference_state_dict(self, state_dict)
+
+        resized_keys = []  # loaded here, so missing from the load below
         if hasattr(self, 'absolute_frame_pos_embed') and ('absolute_frame_pos_embed' in state_dict.keys()):
             pretrained = state_dict['absolute_frame_pos_embed']
             if pretrained.shape != self.absolute_frame_pos_embed.shape:
@@ -610,12 +635,20 @@ class XVLMBase(nn.Module):
                 self.absolute_frame_pos_embed.data[:, :frame_len, :, :] = pretrained.data[:, :frame_len, :, :]
                 print(f"load absolute_frame_pos_embed[:{frame_len}] ({pretrained.shape[1]}/{self.absolute_frame_pos_embed.shape[1]})", flush=True)
                 del state_dict['absolute_frame_pos_embed']
+                resized_keys.append('absolute_frame_pos_embed')
 
-        msg = self.load_state_dict(state_dict, strict=False)
+        if converted:
+            msg = load_safetensors(self, converted_weights_path(ckpt_rpath), strict=False,
+                                   assign=getattr(self, 'inference', False), skip_keys=resized_keys,
+                                   hash_once=config.get('weights_hash_once', False))
+        else:
+            msg = self.load_state_dict(state_dict, strict=False)
         print("unexpected_keys: ", msg.unexpected_keys)
         missing_keys = [p for p in msg.missing_keys]  # if 'vision_encoder' not in p
         self.update_init_params(missing_keys)
         print("train from scratch: ", sorted(self.init_params))
+        if getattr(self, 'inference', False):
+            self.check_inference_keys([k for k in missing_keys if k not in resized_keys])
 
     def _encode_frames(self, frames, output_hidden_states=None, output_attentions=None):
         assert frames.dim() == 5  # (bsz, frame_len, c, h, w)
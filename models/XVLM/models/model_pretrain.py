@@ -3,9 +3,16 @@ from models.XVLM.models import XVLMBase
 
 
 class XVLM(XVLMBase):
-    def __init__(self, config):
-        super().__init__(config, load_vision_params=True, load_text_params=True,
-                         use_contrastive_loss=True, use_matching_loss=True, use_mlm_loss=True, use_bbox_loss=True, config_text=None)
+    def __init__(self, config, inference=False):
+        """
+        inference (bool): build only the modules used to score image-text pairs (no MLM and bbox heads), without
+            initializing the encoders from their pretrained weights, as all the weights come from the checkpoint
+            loaded next
+        """
+        super().__init__(config, load_vision_params=not inference, load_text_params=not inference,
+                         use_contrastive_loss=True, use_matching_loss=True, use_mlm_loss=not inference,
+                         use_bbox_loss=not inference, config_text=None)
+        self.inference = inference
 
     def forward(self, image, text_ids, text_atts, text_ids_masked=None, masked_pos=None, masked_ids=None,
                 image_atts=None, idx_to_group_img=None, target_bbox=None, is_image=None, ret_bbox_loss=False):
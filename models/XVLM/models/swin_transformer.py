@@ -65,6 +65,11 @@ def window_reverse(windows, window_size, H, W):
     return x
 
 
+def clear_attn_bias_cache(module, incompatible_keys=None):
+    """Drop the attention biases cached by a module (load_state_dict post-hook: they depend on the loaded weights)."""
+    module.clear_attn_bias_cache()
+
+
 class WindowAttention(nn.Module):
     r""" Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -113,6 +118,39 @@ class WindowAttention(nn.Module):
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
 
+        # relative position bias and window mask summed once in eval mode, see attn_bias
+        self.cache_bias = True
+        self.register_buffer("cached_attn_bias", None, persistent=False)
+        self.cached_attn_bias_key = None
+        self.register_load_state_dict_post_hook(clear_attn_bias_cache)
+
+    def clear_attn_bias_cache(self):
+        self.cached_attn_bias = None
+        self.cached_attn_bias_key = None
+
+    def train(self, mode=True):
+        self.clear_attn_bias_cache()  # the bias table changes while training
+        return super().train(mode)
+
+    def attn_bias(self, mask=None):
+        """
+        Relative position bias plus the (shifted) window mask, (num_windows or 1, nH, Wh*Ww, Wh*Ww). In eval mode it is
+        computed once per mask, i.e. per input resolution of the block, and kept until new weights are loaded.
+        """
+        key = None if mask is None else (mask.data_ptr(), tuple(mask.shape))
+        caching = self.cache_bias and not self.training
+        if caching and self.cached_attn_bias is not None and self.cached_attn_bias_key == key:
+            return self.cached_attn_bias
+        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+        attn_bias = relative_position_bias.permute(2, 0, 1).contiguous().unsqueeze(0)  # 1, nH, Wh*Ww, Wh*Ww
+        if mask is not None:
+            attn_bias = attn_bias + mask.unsqueeze(1)  # nW, nH, Wh*Ww, Wh*Ww
+        if caching:
+            self.cached_attn_bias = attn_bias.detach()
+            self.cached_attn_bias_key = key
+        return attn_bias
+
     def forward(self, x, mask=None):
         """
         Args:
@@ -126,18 +164,11 @@ class WindowAttention(nn.Module):
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
 
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)
-
-        if mask is not None:
-            nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
+        attn_bias = self.attn_bias(mask)
+        nW = attn_bias.shape[0]
+        attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + attn_bias.unsqueeze(0)
+        attn = attn.view(-1, self.num_heads, N, N)
+        attn = self.softmax(attn)
 
         attn = self.attn_drop(attn)
 
@@ -18,6 +18,7 @@
 import math
 import os
 import warnings
+from contextlib import contextmanager
 from dataclasses import dataclass
 from typing import Optional, Tuple
 
@@ -215,6 +216,13 @@ class BertEmbeddings(nn.Module):
         return embeddings
 
 
+def clear_fused_qkv(module, incompatible_keys=None):
+    """Load state dict post-hook of BertSelfAttention: the weights loaded with assign=True are no longer views of the
+    packed projection, which is packed again from them at the next eval forward (see packed_qkv)."""
+    module.fused_qkv_weight = None
+    module.fused_qkv_bias = None
+
+
 class BertSelfAttention(nn.Module):
     def __init__(self, config, is_cross_attention):
         super().__init__()
@@ -245,6 +253,13 @@ class BertSelfAttention(nn.Module):
             self.max_position_embeddings = config.max_position_embeddings
             self.distance_embedding = nn.Embedding(2 * config.max_position_embeddings - 1, self.attention_head_size)
         self.save_attention = False   
+        self.is_cross_attention = is_cross_attention
+        self.cross_key_value = None
+        self.use_sdpa = True  # see fused_attention
+        self.fuse_qkv = True  # see packed_qkv
+        self.register_buffer("fused_qkv_weight", None, persistent=False)
+        self.register_buffer("fused_qkv_bias", None, persistent=False)
+        self.register_load_state_dict_post_hook(clear_fused_qkv)
             
     def save_attn_gradients(self, attn_gradients):
         self.attn_gradients = attn_gradients
@@ -258,6 +273,64 @@ class BertSelfAttention(nn.Module):
     def get_attention_map(self):
         return self.attention_map
 
+    def cache_cross_key_value(self, encoder_hidden_states):
+        """Project the encoder states (e.g. the image embeddings) into keys and values once and reuse them in every
+        forward call until cleared with ``None``. Only meaningful for cross-attention layers."""
+        if encoder_hidden_states is None:
+            self.cross_key_value = None
+        else:
+            self.cross_key_value = self.project_encoder_states(encoder_hidden_states)
+
+    def packed_qkv(self):
+        """The query, key and value projections packed into one weight and bias, so that in eval mode they cost one
+        matmul instead of three (key and value only for cross-attention, whose queries come from the text). The three
+        Linear layers become views of the packed tensors: state_dict is unchanged and the weights are in memory once.
+        Returns None in training mode or when disabled."""
+        if not self.fuse_qkv or self.training:
+            return None
+        if self.fused_qkv_weight is None:
+            layers = [self.key, self.value] if self.is_cross_attention else [self.query, self.key, self.value]
+            with torch.no_grad():
+                weight = torch.cat([layer.weight for layer in layers])
+                bias = torch.cat([layer.bias for layer in layers])
+            for layer, layer_weight, layer_bias in zip(layers, weight.split(self.all_head_size), bias.split(self.all_head_size)):
+                layer.weight = nn.Parameter(layer_weight, requires_grad=layer.weight.requires_grad)
+                layer.bias = nn.Parameter(layer_bias, requires_grad=layer.bias.requires_grad)
+            self.fused_qkv_weight, self.fused_qkv_bias = weight, bias
+        return self.fused_qkv_weight, self.fused_qkv_bias
+
+    def project_encoder_states(self, encoder_hidden_states):
+        """Keys and values of the encoder states, from one matmul when packed."""
+        packed_qkv = self.packed_qkv() if self.is_cross_attention else None
+        if packed_qkv is not None:
+            key, value = F.linear(encoder_hidden_states, *packed_qkv).split(self.all_head_size, dim=-1)
+        else:
+            key, value = self.key(encoder_hidden_states), self.value(encoder_hidden_states)
+        return self.transpose_for_scores(key), self.transpose_for_scores(value)
+
+    def train(self, mode=True):
+        self.fused_qkv_weight = None  # the weights change while training
+        self.fused_qkv_bias = None
+        return super().train(mode)
+
+    def fused_attention(self, query_layer, key_layer, value_layer, attention_mask, num_candidates):
+        """Attention computed by ``F.scaled_dot_product_attention``, which does not materialize the attention
+        probabilities. The queries of several candidates per encoder sample attend to the same keys, so they are
+        concatenated along the sequence; returns None when the mask differs per candidate."""
+        if num_candidates > 1:
+            if attention_mask is not None and attention_mask.dim() > 4:
+                return None
+            batch_size, query_length = key_layer.size(0), query_layer.size(-2)
+            query_layer = query_layer.permute(1, 2, 0, 3, 4).flatten(2, 3)
+        scale = 1.0 if getattr(self, 'fp16', False) else None  # the fp16 queries are already scaled
+        context_layer = F.scaled_dot_product_attention(query_layer, key_layer, value_layer, attn_mask=attention_mask,
+                                                       dropout_p=self.dropout.p if self.training else 0.0, scale=scale)
+        if num_candidates > 1:
+            context_layer = context_layer.view(batch_size, self.num_attention_heads, num_candidates, query_length, -1)
+            context_layer = context_layer.permute(2, 0, 1, 3, 4).flatten(0, 1)
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        return context_layer.view(*context_layer.size()[:-2], self.all_head_size)
+
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         x = x.view(*new_x_shape)
@@ -273,25 +346,33 @@ class BertSelfAttention(nn.Module):
         past_key_value=None,
         output_attentions=False,
     ):
-        mixed_query_layer = self.query(hidden_states)
+        packed_qkv = self.packed_qkv()
+        if packed_qkv is not None and not self.is_cross_attention and encoder_hidden_states is None:
+            mixed_query_layer, mixed_key_layer, mixed_value_layer = \
+                F.linear(hidden_states, *packed_qkv).split(self.all_head_size, dim=-1)
+        else:
+            mixed_query_layer = self.query(hidden_states)
+            mixed_key_layer = mixed_value_layer = None
 
         # If this is instantiated as a cross-attention module, the keys
         # and values come from an encoder; the attention mask needs to be
         # such that the encoder's padding tokens are not attended to.
         is_cross_attention = encoder_hidden_states is not None
 
-        if is_cross_attention:
-            key_layer = self.transpose_for_scores(self.key(encoder_hidden_states))
-            value_layer = self.transpose_for_scores(self.value(encoder_hidden_states))
+        if is_cross_attention and self.cross_key_value is not None:
+            key_layer, value_layer = self.cross_key_value
+            attention_mask = encoder_attention_mask
+        elif is_cross_attention:
+            key_layer, value_layer = self.project_encoder_states(encoder_hidden_states)
             attention_mask = encoder_attention_mask
         elif past_key_value is not None:
-            key_layer = self.transpose_for_scores(self.key(hidden_states))
-            value_layer = self.transpose_for_scores(self.value(hidden_states))
+            key_layer = self.transpose_for_scores(self.key(hidden_states) if mixed_key_layer is None else mixed_key_layer)
+            value_layer = self.transpose_for_scores(self.value(hidden_states) if mixed_value_layer is None else mixed_value_layer)
             key_layer = torch.cat([past_key_value[0], key_layer], dim=2)
             value_layer = torch.cat([past_key_value[1], value_layer], dim=2)
         else:
-            key_layer = self.transpose_for_scores(self.key(hidden_states))
-            value_layer = self.transpose_for_scores(self.value(hidden_states))
+            key_layer = self.transpose_for_scores(self.key(hidden_states) if mixed_key_layer is None else mixed_key_layer)
+            value_layer = self.transpose_for_scores(self.value(hidden_states) if mixed_value_layer is None else mixed_value_layer)
 
         if not self.fp16:
             query_layer = self.transpose_for_scores(mixed_query_layer)
@@ -302,6 +383,22 @@ class BertSelfAttention(nn.Module):
 
         past_key_value = (key_layer, value_layer)
 
+        # When the encoder states (or their cached keys and values) are not repeated for the K candidate texts of each
+        # encoder sample (candidate-major), the queries are viewed as (K, B, ...) and broadcast against the (B, ...) keys.
+        num_candidates = query_layer.size(0) // key_layer.size(0)
+        if num_candidates > 1:
+            query_layer = query_layer.view(num_candidates, key_layer.size(0), *query_layer.shape[1:])
+            if attention_mask is not None and attention_mask.size(0) == num_candidates * key_layer.size(0):
+                attention_mask = attention_mask.view(num_candidates, key_layer.size(0), *attention_mask.shape[1:])
+
+        # Fused attention, unless the attention probabilities are needed (returned, saved with their gradients for
+        # Grad-CAM, masked per head) or relative position scores have to be added to them
+        if self.use_sdpa and not output_attentions and head_mask is None and self.position_embedding_type == "absolute" \
+                and not (is_cross_attention and self.save_attention):
+            context_layer = self.fused_attention(query_layer, key_layer, value_layer, attention_mask, num_candidates)
+            if context_layer is not None:
+                return (context_layer, past_key_value)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
 
@@ -344,6 +441,9 @@ class BertSelfAttention(nn.Module):
             attention_probs_dropped = attention_probs_dropped * head_mask
 
         context_layer = torch.matmul(attention_probs_dropped, value_layer)
+        if num_candidates > 1:
+            context_layer = context_layer.flatten(0, 1)
+            attention_probs = attention_probs.flatten(0, 1)
 
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
@@ -355,6 +455,23 @@ class BertSelfAttention(nn.Module):
         return outputs
 
 
+@contextmanager
+def cross_attention_kv_cache(model, encoder_hidden_states):
+    """Cache the cross-attention keys and values of ``encoder_hidden_states`` in every cross-attention layer of
+    ``model`` for the duration of the block. Inside the block the text batch may hold K candidates per encoder
+    sample (candidate-major, row k*B + b), and the encoder states and mask are passed un-repeated with batch B.
+    Yields whether any layer supports the cache, so callers can fall back to repeating the encoder states."""
+    layers = [module for module in model.modules()
+              if getattr(module, 'is_cross_attention', False) and hasattr(module, 'cache_cross_key_value')]
+    for layer in layers:
+        layer.cache_cross_key_value(encoder_hidden_states)
+    try:
+        yield len(layers) > 0
+    finally:
+        for layer in layers:
+            layer.cache_cross_key_value(None)
+
+
 class BertSelfOutput(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -1029,6 +1146,9 @@ class BertModel(BertPreTrainedModel):
             
             if type(encoder_attention_mask) == list:
                 encoder_extended_attention_mask = [self.invert_attention_mask(mask) for mask in encoder_attention_mask]
+            elif type(encoder_hidden_states) != list and (encoder_attention_mask is None or bool(encoder_attention_mask.all())):
+                # every encoder position (e.g. image patch) is attended to, the mask would only add zeros
+                encoder_extended_attention_mask = None
             elif encoder_attention_mask is None:
                 encoder_attention_mask = torch.ones(encoder_hidden_shape, device=device)
                 encoder_extended_attention_mask = self.invert_attention_mask(encoder_attention_mask)
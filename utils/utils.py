@@ -1,6 +1,10 @@
 import gdown
 import os
+import hashlib
 import zipfile
+import json
+import tempfile
+import contextlib
 import torch
 
 def download_weights(model_name, general_config):
@@ -14,11 +18,202 @@ def download_weights(model_name, general_config):
         gdown.download(weights_url, output=downloaded_zip_path,
                        fuzzy=True)  # download image folder zip associated with the desired dataset
 
+""" Load the pretrained weights of a model, unless it already holds them (same weights fingerprint), e.g. when it is
+    evaluated by several experiments in one run. The safetensors conversion of the checkpoint is loaded when it exists
+    (see experiments/convert_weights.py), the .pth file otherwise. """
 def load_weights(model, model_name, general_config):
     path = '../pretrained_weights/'+model_name+"_weights.pth"
-    if (not os.path.exists(path)):
+    if (not os.path.exists(path) and not os.path.exists(converted_weights_path(path))):
         download_weights(model_name, general_config)
+    if(getattr(model, 'weights_fingerprint', None) == weights_fingerprint(path)):
+        return
+    if(os.path.exists(converted_weights_path(path))):
+        load_safetensors(model, converted_weights_path(path), assign=getattr(model, 'inference', False),
+                         hash_once=general_config.get('weights_hash_once', False))
+        model.weights_fingerprint = weights_fingerprint(path)
+        return
     #if(model_name == 'BLIP'):
     #    model.load_state_dict(torch.load(path, map_location='cpu')['model'], strict=False)
     #else:
-    model.load_state_dict(torch.load(path, map_location='cpu')['model'])
\ No newline at end of file
+    state_dict = load_checkpoint(path)['model']
+    if(getattr(model, 'inference', False)):
+        state_dict = inference_state_dict(model, state_dict)
+        # the tensors of the checkpoint become the parameters, instead of being copied into the uninitialized ones
+        model.load_state_dict(state_dict, assign=True)
+    else:
+        model.load_state_dict(state_dict)
+    model.weights_fingerprint = weights_fingerprint(path)
+
+""" Path of the safetensors conversion of a .pth checkpoint, and of its manifest """
+def converted_weights_path(path):
+    return os.path.splitext(path)[0] + '.safetensors'
+
+def manifest_path(path):
+    return os.path.splitext(path)[0] + '.manifest.json'
+
+def file_sha256(path, chunk_size=2**24):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+""" Convert a .pth checkpoint to safetensors, keeping only the model tensors (not the optimizer state and the other
+    entries of a training checkpoint), and write its manifest: the SHA-256 of the source and of the converted file and
+    the name, shape and dtype of each tensor. The source is first checked against expected_sha256, the digest pinned
+    for it in the general config, so a corrupted download that still unpickles is not converted (and then verified
+    against a manifest computed from it). Returns the path of the converted file. """
+def convert_weights(path, expected_sha256=None):
+    from safetensors.torch import save_file
+    source_sha256 = file_sha256(path)
+    if(expected_sha256 is not None and source_sha256 != expected_sha256.lower()):
+        raise RuntimeError(f"{path} does not match its pinned SHA-256 (corrupted or different download): expected "
+                           f"{expected_sha256}, got {source_sha256}. Remove it and download it again")
+    checkpoint = torch.load(path, map_location='cpu')
+    state_dict = checkpoint['model'] if 'model' in checkpoint.keys() else checkpoint
+    tensors = {}
+    storages = set()
+    for key, value in state_dict.items():
+        value = value.detach().contiguous()
+        # safetensors does not store tensors sharing memory (e.g. tied embeddings): each gets its own copy
+        if(value.untyped_storage().data_ptr() in storages):
+            value = value.clone()
+        storages.add(value.untyped_storage().data_ptr())
+        tensors[key] = value
+    del checkpoint, state_dict
+    converted_path = converted_weights_path(path)
+    tmp_path = converted_path + '.tmp'
+    save_file(tensors, tmp_path, metadata={'source': os.path.basename(path)})
+    manifest = {'source': os.path.basename(path), 'source_sha256': source_sha256, 'sha256': file_sha256(tmp_path),
+                'tensors': {key: {'shape': list(value.shape), 'dtype': str(value.dtype)} for key, value in tensors.items()}}
+    with open(manifest_path(path) + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(tmp_path, converted_path)
+    os.replace(manifest_path(path) + '.tmp', manifest_path(path))
+    return converted_path
+
+""" Check a converted checkpoint against its manifest, so a corrupted or truncated file is reported before the model
+    is run with it: the names, shapes and dtypes of the tensors in the file header, then the SHA-256 of the whole
+    file. The check of a file is done once per process. Hashing a multi-GB file takes seconds: with hash_once
+    (weights_hash_once in the general config, off by default), the fingerprint of the file verified is recorded in
+    the manifest ('verified') and the later processes skip the hash while the size and modification time of the file
+    are unchanged, which does not catch a file corrupted in place. """
+_verified_files = set()
+
+_SAFETENSORS_DTYPES = {'F64': 'torch.float64', 'F32': 'torch.float32', 'F16': 'torch.float16', 'BF16': 'torch.bfloat16',
+                       'I64': 'torch.int64', 'I32': 'torch.int32', 'I16': 'torch.int16', 'I8': 'torch.int8',
+                       'U8': 'torch.uint8', 'BOOL': 'torch.bool'}
+
+def verify_manifest(path, hash_once=False):
+    from safetensors import safe_open
+    fingerprint = weights_fingerprint(path)
+    if(fingerprint in _verified_files):
+        return
+    if(not os.path.exists(manifest_path(path))):
+        raise RuntimeError(f"No manifest for {path}, convert the checkpoint again with experiments/convert_weights.py")
+    with open(manifest_path(path)) as file:
+        manifest = json.load(file)
+    with safe_open(path, framework='pt', device='cpu') as file:
+        tensors = {}
+        for key in file.keys():
+            tensor_slice = file.get_slice(key)
+            tensors[key] = {'shape': list(tensor_slice.get_shape()), 'dtype': _SAFETENSORS_DTYPES.get(tensor_slice.get_dtype(), tensor_slice.get_dtype())}
+    if(tensors != manifest['tensors']):
+        raise RuntimeError(f"The tensors of {path} do not match those of its manifest, convert the checkpoint again "
+                           f"with experiments/convert_weights.py")
+    if(not hash_once or manifest.get('verified') != fingerprint):
+        if(file_sha256(path) != manifest['sha256']):
+            raise RuntimeError(f"{path} does not match the hash of its manifest (corrupted file), convert the checkpoint "
+                               f"again with experiments/convert_weights.py")
+    if(hash_once and manifest.get('verified') != fingerprint):
+        manifest['verified'] = fingerprint
+        try:
+            # a temporary file of its own, for the processes verifying the same file at the same time
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(manifest_path(path)) or '.', suffix='.tmp')
+            with os.fdopen(fd, 'w') as file:
+                json.dump(manifest, file, indent=1)
+            os.replace(tmp_path, manifest_path(path))
+        except OSError:
+            pass # read-only weights folder: the file is hashed again by the next process
+    _verified_files.add(fingerprint)
+
+""" Load a converted checkpoint into a model after checking it against its manifest. The file is memory-mapped and the
+    tensors are read one top-level module at a time, so only the model and the tensors of one module are in memory at
+    once, instead of the model and the whole checkpoint. The entries are selected as by inference_state_dict for the
+    models built for inference; the model entries in skip_keys, loaded by the caller, are left as they are. With
+    strict, the parameters and buffers not in the file are an error; the missing and unexpected keys are returned
+    otherwise, as by load_state_dict. """
+def load_safetensors(model, path, strict=True, assign=False, skip_keys=(), hash_once=False):
+    from safetensors import safe_open
+    verify_manifest(path, hash_once=hash_once)
+    with safe_open(path, framework='pt', device='cpu') as file:
+        keys = {key: key for key in file.keys()}
+        if(getattr(model, 'inference', False)):
+            keys = inference_state_dict(model, keys)
+        keys = {key: file_key for key, file_key in keys.items() if key not in skip_keys}
+        model_keys = set(model.state_dict().keys())
+        unexpected_keys = sorted(key for key in keys if key not in model_keys)
+        modules = {}
+        for key in keys:
+            if(key in model_keys):
+                modules.setdefault(key.split('.', 1)[0], []).append(key)
+        for module_keys in modules.values():
+            model.load_state_dict({key: file.get_tensor(keys[key]) for key in module_keys}, strict=False, assign=assign)
+    missing_keys = sorted(model_keys - set(key for module_keys in modules.values() for key in module_keys))
+    if(strict and (missing_keys or unexpected_keys)):
+        raise RuntimeError(f"Error(s) in loading {path}: missing keys {missing_keys}, unexpected keys {unexpected_keys}")
+    return torch.nn.modules.module._IncompatibleKeys(missing_keys, unexpected_keys)
+
+""" Read a checkpoint memory-mapped, so its tensors are paged in from the file as they are used instead of being
+    read into memory up front. Checkpoints in the legacy (non-zip) format cannot be mapped and are read normally. """
+def load_checkpoint(path):
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except RuntimeError:
+        return torch.load(path, map_location='cpu')
+
+""" Build modules without initializing their weights, for models whose weights all come from a checkpoint loaded right
+    after: the random initializations (torch.nn.init, the _init_weights of the transformers and timm models, which
+    draw with normal_ and uniform_, trunc_normal_ then erfinv_) leave the allocated tensors as they are. This is most
+    of the construction time of the models. The weights not in the checkpoint are left uninitialized, so the models
+    built with it must load a checkpoint covering all their parameters (load_weights loads strictly). """
+_INIT_METHODS = ['normal_', 'uniform_', 'erfinv_']
+
+@contextlib.contextmanager
+def skip_init():
+    originals = {name: getattr(torch.Tensor, name) for name in _INIT_METHODS}
+    def no_init(tensor, *args, **kwargs):
+        return tensor
+    try:
+        for name in _INIT_METHODS:
+            setattr(torch.Tensor, name, no_init)
+        yield
+    finally:
+        for name, method in originals.items():
+            setattr(torch.Tensor, name, method)
+
+""" Cheap fingerprint of a weights file (its path, size and modification time), identifying the weights a model was
+    loaded with, e.g. to key the cached vision embeddings. That of its safetensors conversion if it has one. """
+def weights_fingerprint(path):
+    if(path.endswith('.pth') and os.path.exists(converted_weights_path(path))):
+        path = converted_weights_path(path)
+    stat = os.stat(path)
+    return hashlib.sha1(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+
+""" Entries of a training checkpoint matching the modules of a model built for inference (inference=True): those of
+    the modules it does not build (momentum encoders, queues, text decoder, MLM and bbox heads) are dropped, and the
+    encoders saved inside their MLM wrapper ('text_encoder.bert.*') are mapped to the bare encoder when the model
+    has one ('text_encoder.*'). The model keeps its strict load, which still reports its own missing entries. """
+def inference_state_dict(model, state_dict):
+    model_keys = set(model.state_dict().keys())
+    selected = {}
+    for key, value in state_dict.items():
+        if(key in model_keys):
+            selected[key] = value
+            continue
+        for wrapper in ('.bert.', '.roberta.'):
+            encoder_key = key.replace(wrapper, '.', 1)
+            if(wrapper in key and encoder_key in model_keys and encoder_key not in state_dict):
+                selected[encoder_key] = value
+                break
+    return selected